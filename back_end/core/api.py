@@ -1,5 +1,10 @@
+import os
 import json
 import time
+import atexit
+import random
+import threading
+from collections import OrderedDict
 import requests
 from . misc import NPArrayEncoder
 from . conf import settings
@@ -8,29 +13,68 @@ from . import get_logger
 
 log = get_logger('ersatz.api')
 
-def post(slug, params):
-    params['worker_key'] = settings.WORKER_KEY
+# slugs which can be sent in one request to /api/bulk/
+BATCHED = {'/api/stats/': 'stats', '/api/logs/': 'logs'}
+
+_session = threading.local()
+
+
+def get_session():
+    """
+    Returns requests session of the calling thread, connections
+    to api server are kept alive and reused.
+    """
+    pid = os.getpid()
+    if getattr(_session, 'pid', None) != pid:
+        _session.session = requests.Session()
+        _session.pid = pid
+    return _session.session
+
+
+def backoff(attempt):
+    """
+    Returns seconds to wait before retry, exponential with jitter,
+    so workers don't come back to restarted server at once.
+    """
+    delay = min(settings.API_RETRY_DELAY * 2 ** attempt,
+                settings.API_RETRY_MAX_DELAY)
+    return delay / 2. + random.uniform(0, delay / 2.)
+
+
+def request(method, url, **kwargs):
+    """
+    Sends request, retries until api server is available.
+    """
+    attempt = 0
     while True:
         try:
-            response = requests.post(settings.API_SERVER + slug,
-                                     json.dumps(params, cls=NPArrayEncoder))
-            log.debug(response.text)
-            break
-        except requests.ConnectionError:
-            time.sleep(2)
-            log.critical('Api server not available, trying again')
+            return get_session().request(method, url,
+                                         timeout=settings.API_TIMEOUT,
+                                         **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            delay = backoff(attempt)
+            attempt += 1
+            log.critical('Api server not available (%s), trying again '
+                         'in %.1f seconds' % (e, delay))
+            time.sleep(delay)
+
+
+def post(slug, params):
+    params['worker_key'] = settings.WORKER_KEY
+    if settings.API_BATCH and slug in BATCHED:
+        return get_batch().add(BATCHED[slug], params)
+    # keeps order of batched and direct requests
+    flush()
+    response = request('POST', settings.API_SERVER + slug,
+                       data=json.dumps(params, cls=NPArrayEncoder))
+    log.debug(response.text)
     return True if response.status_code == 200 else False
 
 
 def get(slug, params={}, server=None):
     params['worker_key'] = settings.WORKER_KEY
     server = server or settings.API_SERVER
-    while True:
-        try:
-            response = requests.get(server + slug, params=params)
-            break
-        except requests.ConnectionError:
-            pass
+    response = request('GET', server + slug, params=params)
     if response.status_code == 200:
         try:
             data = json.loads(response.text)
@@ -41,13 +85,118 @@ def get(slug, params={}, server=None):
 
 
 def rest_patch(slug, data):
-    while True:
+    flush()
+    response = request('POST', settings.API_SERVER + slug + '?worker_key=' +
+                       settings.WORKER_KEY,
+                       data=json.dumps(data, cls=NPArrayEncoder))
+    log.debug(response.text)
+    return True if response.status_code == 200 else False
+
+
+class ApiBatch(object):
+    """
+    Coalesces stats and logs of models into one request to /api/bulk/.
+
+    Background thread sends pending payloads every interval seconds.
+    add() returns at once, False if the last sent batch of the model
+    was refused (training canceled or user out of time), so callers
+    learn about it one batch later than with direct requests.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        # model id -> {'model': id, 'stats': [], 'logs': None}
+        self.pending = OrderedDict()
+        self.failed = set()
+        self.cond = threading.Condition()
+        self.sending = False
+        self.requests = 0
+        self.payloads = 0
+        self.thread = threading.Thread(target=self._run, name='api-batch')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, kind, payload):
+        model = payload['model']
+        with self.cond:
+            item = self.pending.setdefault(
+                    model, {'model': model, 'stats': [], 'logs': None})
+            if kind == 'stats':
+                item['stats'].append(payload)
+            else:
+                logs = item['logs']
+                if logs is None or payload.get('is_new'):
+                    item['logs'] = {'data': payload.get('data', ''),
+                                    'is_new': payload.get('is_new', False)}
+                else:
+                    logs['data'] += payload.get('data', '')
+            self.payloads += 1
+            return model not in self.failed
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.send()
+            except Exception:
+                log.exception('Sending batch failed.')
+
+    def send(self):
+        """
+        Sends pending payloads, waits for send in progress.
+        """
+        with self.cond:
+            while self.sending:
+                self.cond.wait()
+            if not self.pending:
+                return
+            items, self.pending = self.pending.values(), OrderedDict()
+            self.sending = True
         try:
-            response = requests.post(settings.API_SERVER + slug + '?worker_key=' + settings.WORKER_KEY,
-                                     json.dumps(data, cls=NPArrayEncoder))
+            response = request('POST', settings.API_SERVER + '/api/bulk/',
+                               data=json.dumps({
+                                   'worker_key': settings.WORKER_KEY,
+                                   'models': items}, cls=NPArrayEncoder))
             log.debug(response.text)
-            break
-        except requests.ConnectionError:
-            time.sleep(2)
-            log.critical('Api server not available, trying again')
-    return True if response.status_code == 200 else False
+            if response.status_code == 200:
+                results = json.loads(response.text)['models']
+            else:
+                results = dict((str(item['model']), response.status_code)
+                               for item in items)
+            with self.cond:
+                self.requests += 1
+                for item in items:
+                    result = results.get(str(item['model']), 'success')
+                    if result != 'success':
+                        log.critical('Api refused batch of model %s: %s'
+                                     % (item['model'], result))
+                        self.failed.add(item['model'])
+        finally:
+            with self.cond:
+                self.sending = False
+                self.cond.notify_all()
+
+
+_batch = {}
+_batch_lock = threading.Lock()
+
+
+def get_batch():
+    """
+    Returns ApiBatch of this process.
+    """
+    pid = os.getpid()
+    with _batch_lock:
+        if _batch.get('pid') != pid:
+            _batch['batch'] = ApiBatch(settings.API_BATCH_INTERVAL)
+            _batch['pid'] = pid
+        return _batch['batch']
+
+
+@atexit.register
+def flush():
+    """
+    Sends batched payloads of this process.
+    """
+    if _batch.get('pid') == os.getpid():
+        _batch['batch'].send()
@@ -4,43 +4,66 @@ import string
 import time
 import gzip
 import StringIO
+import threading
+import tempfile
 from random import choice
+from multiprocessing.pool import ThreadPool
 from boto import log as boto_log
 from . import get_logger
 from .conf import settings
-from .misc import NPArrayEncoder, str_to_gzip, gzip_to_str, fp_md5
+from .misc import NPArrayEncoder, str_to_gzip, gzip_to_str
 from .exception import AWSError
+from .s3_cache import S3Cache
 
 
 if getattr(settings, 'LOCAL_SETUP', False):
-    from .s3_local import S3Connection, Key
+    from .s3_local import S3Connection, Key, MultiPartUpload
 else:
     from boto.s3.connection import S3Connection
     from boto.s3.key import Key
+    from boto.s3.multipart import MultiPartUpload
 
 
 log = get_logger('ersatz.aws')
 boto_log.setLevel(settings.LOGLEVEL)
 
 
+_cache = None
+
+
+def get_cache():
+    """
+    Returns S3Cache for settings.S3_CACHEDIR, one per process.
+    """
+    global _cache
+    if _cache is None or _cache.cachedir != settings.S3_CACHEDIR:
+        _cache = S3Cache(settings.S3_CACHEDIR, settings.S3_CACHE_SIZE)
+    return _cache
+
+
 class S3Key(object):
     def __init__(self, key):
         self.key = key
 
-    def download(self, local_filename):
+    def download(self, key, local_filename):
         log.debug('Downloading %s from S3.' % self.key)
-        local_filename.ancestor(1).mkdir(parents=True)
-        save_to_file(self.key, local_filename, interactive=True)
-
-    def get(self):
+        dirname = os.path.dirname(local_filename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        save_to_file(key, local_filename, interactive=True)
+
+    def get(self, pin=False):
+        """
+        Returns filename of local copy, with pin=True file is not
+        evicted from cache until unpin() or end of process.
+        """
         key = get_key(self.key)
-        local = os.path.join(settings.S3_CACHEDIR, self.key.strip('/')) #strip leading /
+        if key is None:
+            raise AWSError('S3 key doesn\'t exists.')
+        return get_cache().get(key, self.download, pin=pin)
 
-        if os.path.exists(local) and fp_md5(local) == key.etag.strip('"'):
-            log.debug('Using cached version of %s.' % self.key)
-        else:
-            self.download(local)
-        return local
+    def unpin(self):
+        get_cache().unpin(self.key)
 
     def get_file(self):
         local = self.get()
@@ -63,18 +86,128 @@ def upload_modeldata(data, load_file, model_id):
     return s3_data
 
 
+_bucket = threading.local()
+
+
+def get_bucket():
+    """
+    Returns bucket of the calling thread. boto connections are not
+    thread safe, so every thread keeps its own one and reuses it.
+    """
+    pid = os.getpid()
+    if getattr(_bucket, 'pid', None) != pid:
+        conn = S3Connection(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_KEY)
+        _bucket.bucket = conn.get_bucket(settings.S3_BUCKET)
+        _bucket.pid = pid
+    return _bucket.bucket
+
+
+_pool = {}
+
+
+def get_pool():
+    """
+    Returns thread pool for parallel transfers, one per process.
+    """
+    pid = os.getpid()
+    if _pool.get('pid') != pid:
+        _pool['pool'] = ThreadPool(settings.S3_TRANSFER_THREADS)
+        _pool['pid'] = pid
+    return _pool['pool']
+
+
+def split_parts(size):
+    """
+    Returns list of (offset, length) of parts for multipart transfer.
+    """
+    part_size = settings.S3_PART_SIZE
+    return [(offset, min(part_size, size - offset))
+            for offset in xrange(0, size, part_size)]
+
+
+def is_multipart(size):
+    return size > settings.S3_MULTIPART_THRESHOLD
+
+
+def _download_part(args):
+    key_name, local_file, offset, length = args
+    k = Key(get_bucket())
+    k.key = key_name
+    headers = {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}
+    with open(local_file, 'r+b') as f:
+        f.seek(offset)
+        k.get_contents_to_file(f, headers=headers)
+    return length
+
+
+def download_parallel(key, local_file, cb=None):
+    """
+    Downloads key with ranged requests in S3_TRANSFER_THREADS threads.
+    """
+    with open(local_file, 'wb') as f:
+        f.truncate(key.size)
+    parts = [(key.key, local_file, offset, length)
+             for offset, length in split_parts(key.size)]
+    done = 0
+    for length in get_pool().imap_unordered(_download_part, parts):
+        done += length
+        if cb is not None:
+            cb(done, key.size)
+
+
+def _upload_part(args):
+    key_name, upload_id, part_num, read_part, offset, length = args
+    mp = MultiPartUpload(get_bucket())
+    mp.key_name = key_name
+    mp.id = upload_id
+    mp.upload_part_from_file(read_part(offset, length), part_num, size=length)
+    return length
+
+
+def _file_part(filename):
+    def read_part(offset, length):
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            return StringIO.StringIO(f.read(length))
+    return read_part
+
+
+def _string_part(data):
+    def read_part(offset, length):
+        return StringIO.StringIO(data[offset:offset + length])
+    return read_part
+
+
+def upload_parallel(key_name, read_part, size, cb=None):
+    """
+    Uploads size bytes as multipart upload with parts sent
+    in S3_TRANSFER_THREADS threads. read_part(offset, length)
+    returns file-like object with the part.
+    """
+    mp = get_bucket().initiate_multipart_upload(key_name)
+    parts = [(key_name, mp.id, num + 1, read_part, offset, length)
+             for num, (offset, length) in enumerate(split_parts(size))]
+    done = 0
+    try:
+        for length in get_pool().imap_unordered(_upload_part, parts):
+            done += length
+            if cb is not None:
+                cb(done, size)
+    except:
+        mp.cancel_upload()
+        raise
+    mp.complete_upload()
+    return done
+
+
 def get_key(key):
     if key is None or key == '':
         raise AWSError
-    conn = S3Connection(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_KEY)
-    bucket = conn.get_bucket(settings.S3_BUCKET)
-    return bucket.get_key(key)
+    return get_bucket().get_key(key)
 
 
 def create_key(key):
-    conn = S3Connection(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_KEY)
-    bucket = conn.get_bucket(settings.S3_BUCKET)
-    k = Key(bucket)
+    k = Key(get_bucket())
     k.key = key
     return k
 
@@ -87,7 +220,11 @@ def save_modeldata_to_filename(s3_filename, modeldata):
         if not isinstance(modeldata, str):
             modeldata = json.dumps(modeldata, cls=NPArrayEncoder)
         start_time = time.time()
-        bts = k.set_contents_from_string(modeldata)
+        if is_multipart(len(modeldata)):
+            bts = upload_parallel(k.key, _string_part(modeldata),
+                                  len(modeldata))
+        else:
+            bts = k.set_contents_from_string(modeldata)
         log.debug('S3 uploading time: %s' % (time.time() - start_time, ))
     if bts == len(modeldata):
         log.debug('Saved %s Mb to S3.' % round(bts / 1024. / 1024., 2))
@@ -128,7 +265,10 @@ def save_to_file(key, local_file, interactive=False):
         key = get_key(key)
         if key is None:
             raise AWSError('S3 key doesn\'t exists.')
-    if interactive:
+    cb = print_progress if interactive else None
+    if is_multipart(key.size):
+        download_parallel(key, local_file, cb=cb)
+    elif interactive:
         key.get_contents_to_filename(local_file, cb=print_progress, num_cb=11)
     else:
         key.get_contents_to_filename(local_file)
@@ -141,22 +281,73 @@ def save_to_s3(local_file, key, rewrite=False, interactive=False):
             k = create_key(key)
         elif not rewrite:
             raise AWSError('S3 already has this key.')
-    if interactive:
+    else:
+        k = key
+    size = os.path.getsize(local_file)
+    if is_multipart(size):
+        cb = print_progress if interactive else None
+        upload_parallel(k.key, _file_part(local_file), size, cb=cb)
+    elif interactive:
         k.set_contents_from_filename(local_file, cb=print_progress, num_cb=11)
     else:
         k.set_contents_from_filename(local_file)
 
 
 def get_list_files():
-    conn = S3Connection(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_KEY)
-    bucket = conn.get_bucket(settings.S3_BUCKET)
-    return bucket.list()
+    return get_bucket().list()
+
+
+class GzipUpload(object):
+    """
+    Gzip file on local disk which is uploaded to s3_key on close(),
+    data is compressed as it is written, so only the compressed
+    file is ever whole. Used as context manager the file is uploaded
+    on success and removed in any case.
+    """
+
+    def __init__(self, s3_key):
+        self.s3_key = s3_key
+        fd, self.filename = tempfile.mkstemp(suffix='.gz')
+        # no temporary name in gzip header
+        self.file = gzip.GzipFile(filename='', mode='wb',
+                                  fileobj=os.fdopen(fd, 'wb'))
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        """
+        Uploads the file, parts are sent in parallel for large files.
+        """
+        self._close_file()
+        try:
+            save_to_s3(self.filename, self.s3_key, rewrite=True)
+        finally:
+            self.abort()
+        return self.s3_key
+
+    def abort(self):
+        self._close_file()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def _close_file(self):
+        if not self.file.closed:
+            fileobj = self.file.fileobj
+            self.file.close()
+            fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        if type_ is None:
+            self.close()
+        else:
+            self.abort()
 
 
 def save_as_s3_file(rval, s3_key):
-    gz = StringIO.StringIO()
-    f = gzip.GzipFile(fileobj=gz, mode='w')
-    f.write(rval)
-    f.close()
-    save_modeldata_to_filename(s3_key, gz.getvalue())
+    with GzipUpload(s3_key) as f:
+        f.write(rval)
     return s3_key
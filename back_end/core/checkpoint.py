@@ -0,0 +1,219 @@
+import sys
+import json
+import time
+import struct
+import threading
+import cStringIO
+import numpy as np
+from . import get_logger, aws
+
+
+log = get_logger('ersatz.checkpoint')
+
+NPZ_MAGIC = 'PK\x03\x04'
+
+# binary model data format:
+#   MODELDATA_MAGIC, uint8 version, uint32 header length,
+#   json header with scalars and layout of arrays, padding,
+#   raw arrays each aligned to MODELDATA_ALIGN bytes
+MODELDATA_MAGIC = '\x93ERSATZ'
+MODELDATA_VERSION = 1
+MODELDATA_SUFFIX = '.weights'
+MODELDATA_ALIGN = 64
+PREFIX = struct.Struct('<%dsBI' % len(MODELDATA_MAGIC))
+
+
+def _align(offset):
+    return -(-offset // MODELDATA_ALIGN) * MODELDATA_ALIGN
+
+
+def dumps_modeldata(modeldata, float_dtype=None):
+    """
+    Serializes dict of arrays and scalars into binary string,
+    floating point arrays are stored as float_dtype if it is given.
+    Resume checkpoints keep their dtype, so training continues from
+    the same parameters.
+    """
+    header = {'scalars': {}, 'arrays': {}}
+    arrays = []
+    offset = 0
+    for name, value in sorted(modeldata.items()):
+        if isinstance(value, np.generic):
+            value = value.item()
+        if not isinstance(value, (np.ndarray, list, tuple)):
+            header['scalars'][name] = value
+            continue
+        value = np.asarray(value)
+        if float_dtype is not None and value.dtype.kind == 'f':
+            value = value.astype(float_dtype)
+        value = np.ascontiguousarray(value)
+        header['arrays'][name] = {'dtype': value.dtype.str,
+                                  'shape': value.shape,
+                                  'offset': offset}
+        arrays.append((offset, value))
+        offset = _align(offset + value.nbytes)
+    header = json.dumps(header)
+    start = _align(PREFIX.size + len(header))
+    out = cStringIO.StringIO()
+    out.write(PREFIX.pack(MODELDATA_MAGIC, MODELDATA_VERSION, len(header)))
+    out.write(header)
+    for array_offset, value in arrays:
+        out.write('\0' * (start + array_offset - out.tell()))
+        out.write(value.tostring())
+    return out.getvalue()
+
+
+def _parse_header(prefix, read):
+    magic, version, length = PREFIX.unpack(prefix)
+    if version > MODELDATA_VERSION:
+        raise ValueError('Unsupported model data version %d' % version)
+    header = json.loads(read(length))
+    return header, _align(PREFIX.size + length)
+
+
+def _unpack(header, start, get_array):
+    modeldata = dict(header['scalars'])
+    for name, layout in header['arrays'].items():
+        modeldata[name] = get_array(np.dtype(layout['dtype']),
+                                    tuple(layout['shape']),
+                                    start + layout['offset'])
+    return modeldata
+
+
+def loads_modeldata(data):
+    """
+    Returns modeldata dict from binary, npz or json string.
+    """
+    if data.startswith(MODELDATA_MAGIC):
+        header, start = _parse_header(
+            data[:PREFIX.size],
+            lambda length: data[PREFIX.size:PREFIX.size + length])
+        def get_array(dtype, shape, offset):
+            count = int(np.prod(shape))
+            if not count:
+                return np.zeros(shape, dtype)
+            return np.frombuffer(data, dtype, count, offset).reshape(shape)
+        return _unpack(header, start, get_array)
+    if not data.startswith(NPZ_MAGIC):
+        return json.loads(data)
+    npz = np.load(cStringIO.StringIO(data))
+    try:
+        return dict((k, v.item() if v.ndim == 0 else v)
+                    for k, v in npz.items())
+    finally:
+        npz.close()
+
+
+def load_modeldata_file(filename):
+    """
+    Returns modeldata dict from binary file, arrays are memory-mapped.
+    """
+    with open(filename, 'rb') as f:
+        prefix = f.read(PREFIX.size)
+        if not prefix.startswith(MODELDATA_MAGIC):
+            f.seek(0)
+            return loads_modeldata(f.read())
+        header, start = _parse_header(prefix, f.read)
+    def get_array(dtype, shape, offset):
+        if not int(np.prod(shape)):
+            return np.zeros(shape, dtype)
+        return np.memmap(filename, dtype, 'r', offset, shape)
+    return _unpack(header, start, get_array)
+
+
+def load_modeldata(s3_data):
+    """
+    Returns modeldata saved to s3, binary model data is taken
+    from local cache and memory-mapped.
+    """
+    if s3_data.endswith(MODELDATA_SUFFIX):
+        return load_modeldata_file(aws.S3Key(s3_data).get())
+    return loads_modeldata(aws.get_data(s3_data))
+
+
+class CheckpointUploader(object):
+    """
+    Sends training reports from background thread.
+
+    submit(report, upload) returns at once, worker calls upload() which
+    returns s3 key of uploaded model data and then report(s3_data).
+    Reports are sent in order. If worker falls behind, only the newest
+    pending upload is done, older reports get key of the last uploaded
+    model data, as reports without model data do.
+    Exception raised by worker is raised by the next submit() or flush().
+    Reports before the first upload get s3_data given to reset().
+    """
+
+    def __init__(self, s3_data=None):
+        self.pending = []
+        self.cond = threading.Condition()
+        self.busy = False
+        self.error = None
+        self.s3_data = s3_data
+        self.time_saved = 0.
+        self.skipped = 0
+        self.thread = threading.Thread(target=self._run, name='checkpoints')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, report, upload=None):
+        self.check()
+        with self.cond:
+            if upload is not None:
+                for job in self.pending:
+                    if job[1] is not None:
+                        job[1] = None
+                        self.skipped += 1
+            self.pending.append([report, upload])
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                report, upload = self.pending.pop(0)
+                self.busy = True
+            start_time = time.time()
+            try:
+                if upload is not None:
+                    self.s3_data = upload()
+                report(self.s3_data)
+            except Exception:
+                log.exception('Sending report failed.')
+                with self.cond:
+                    if self.error is None:
+                        self.error = sys.exc_info()
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.time_saved += time.time() - start_time
+                    self.cond.notify_all()
+
+    def check(self):
+        """
+        Raises exception of failed report.
+        """
+        with self.cond:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def reset(self, s3_data=None):
+        """
+        Waits for submitted reports, then reports without upload get
+        s3_data until the next upload, e.g. when next model starts.
+        """
+        self.flush()
+        with self.cond:
+            self.s3_data = s3_data
+
+    def flush(self, check=True):
+        """
+        Waits until all submitted reports are sent.
+        """
+        with self.cond:
+            while self.pending or self.busy:
+                self.cond.wait()
+        if check:
+            self.check()
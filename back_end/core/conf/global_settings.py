@@ -1,11 +1,22 @@
 TEST_RUN = False
 API_SERVER = 'http://localhost:8000'
+# seconds to wait for api server response
+API_TIMEOUT = 60
+# seconds between retries of unavailable api server, doubled up to the max
+API_RETRY_DELAY = 1
+API_RETRY_MAX_DELAY = 60
+# send stats and logs of models together every API_BATCH_INTERVAL seconds
+API_BATCH = False
+API_BATCH_INTERVAL = 2
 WORKER_KEY = ''
 BROKER_HOST = "localhost"
 BROKER_PORT = 5672
 BROKER_USER = "ersatz"
 BROKER_PASSWORD = ""
 BROKER_VHOST = "ersatz"
+# seconds between reconnects to broker, doubled up to the max delay
+BROKER_RECONNECT_DELAY = .5
+BROKER_RECONNECT_MAX_DELAY = 30
 AWS_ACCESS_KEY = ""
 AWS_SECRET_KEY = ""
 S3_BUCKET = ''
@@ -17,10 +28,54 @@ SPEARMINT = None
 CONVNET = None
 WORKING_DIR = None
 S3_CACHEDIR = None
+# max size of S3_CACHEDIR in bytes, None - unlimited
+S3_CACHE_SIZE = None
+S3_TRANSFER_THREADS = 4
+# S3 minimum part size is 5MB
+S3_PART_SIZE = 8 * 1024 * 1024
+# files larger than this are transferred in parallel parts
+S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+# max bytes of logs buffered by RabbitPipe, the oldest are dropped
+LOGS_BUFFER_SIZE = 1024 * 1024
 RUN_IN_SUBPROCESS = False
+# concurrent jobs of ApiListener, run only with RUN_IN_SUBPROCESS
+LISTENER_MAX_JOBS = 1
+# cpu slots, None - number of cores; gpu ids are ERSATZ_MRNN_GPUS
+LISTENER_CPUS = None
+# memory budget in MB, None - not limited
+LISTENER_MEMORY = None
+# slots taken by a job of the queue, job with 'gpu': n gets its own n
+# of ERSATZ_MRNN_GPUS, job without gpu slots sees all of them
+LISTENER_RESOURCES = {
+    'train': {'cpu': 1},
+    'predict': {'cpu': 1},
+}
+# per phase timings of HF training in iteration stats
+PROFILE_TRAINING = False
+# directory for chrome trace files of training, None - no trace
+PROFILE_TRACE_DIR = None
 MRNN_DP_START_PORT = 8008
 MRNN_DP_MAX_PORT = 8100
 DATASET_VERSION = 1
+# bytes of deserialized models kept by predict process, 0 - no cache
+PREDICT_MODEL_CACHE_SIZE = 512 * 1024 * 1024
+# samples of dataset predicted at once, results are written by chunks
+PREDICT_CHUNK_SIZE = 1024
+# workspaces of MRNN passes kept per process, one per batch size and
+# model shape; grad, test and last partial batches of an iteration
+MRNN_WORKSPACE_CACHE_SIZE = 4
+# bytes of forward states of batches kept by a training worker for
+# Gauss-Newton products during CG, 0 - no cache. They are held on the
+# gpu on top of the data, a batch of 100 samples of 100 timesteps of
+# a model with h = f = 200 takes about 40MB in float32
+GAUSS_NEWTON_CACHE_SIZE = 256 * 1024 * 1024
+DATASET_STORAGE = 'gzip'
+DATASET_CHUNK_ROWS = 4096
+DATASET_LAZY_LOAD = False
+TIMESERIES_RAGGED = False
 
 LOCAL_SETUP = False
 S3_ROOT = None
+# throttling of s3_local, seconds per request and bytes per second
+S3_LOCAL_LATENCY = 0
+S3_LOCAL_BANDWIDTH = None
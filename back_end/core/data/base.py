@@ -1,25 +1,133 @@
 from ..conf import settings
+import numpy as np
 import h5py
 
 
+# storage modes for datasets in hdf5 file:
+# gzip - default, best ratio, every read pays full decompression
+# lzf  - row-chunked lzf, much faster to read
+# raw  - contiguous, no compression, can be memory-mapped
+STORAGE_MODES = ('gzip', 'lzf', 'raw')
+
+
+def storage_options(shape, storage, chunk_rows=None):
+    """
+    Returns kwargs for h5py create_dataset for the given storage mode.
+    """
+    if storage not in STORAGE_MODES:
+        raise ValueError('Unknown dataset storage %s' % storage)
+    if storage == 'raw' or not shape or not shape[0]:
+        return {}
+    chunk_rows = settings.DATASET_CHUNK_ROWS if chunk_rows is None else chunk_rows
+    chunks = (min(chunk_rows, shape[0]),) + tuple(shape[1:])
+    return {'compression': storage, 'chunks': chunks}
+
+
+def lazy_array(dset):
+    """
+    Returns np.memmap over contiguous uncompressed dataset or dataset
+    itself, both read only rows which are sliced.
+    """
+    offset = dset.id.get_offset()
+    if offset is None or not dset.size:
+        return dset
+    return np.memmap(dset.file.filename, mode='r', dtype=dset.dtype,
+                     offset=offset, shape=dset.shape)
+
+
+class HStackView(object):
+    """
+    Read-only view on two 2d arrays stacked horizontally.
+
+    Behaves as np.hstack((left, right)) for row access and simple
+    column slices, but never copies the parts until rows are requested.
+    Column slices which fall into one part return rows of that part only.
+    """
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.split = left.shape[1]
+        self.shape = (left.shape[0], left.shape[1] + right.shape[1])
+        self.dtype = np.result_type(left.dtype, right.dtype)
+        self.ndim = 2
+        self.size = self.shape[0] * self.shape[1]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for i in xrange(self.shape[0]):
+            yield self[i]
+
+    def __array__(self, dtype=None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, cols = key
+        else:
+            rows, cols = key, slice(None)
+        if isinstance(cols, slice):
+            start, stop, step = cols.indices(self.shape[1])
+            if step == 1 and stop <= self.split:
+                return self._rows(self.left, rows, slice(start, stop))
+            if step == 1 and start >= self.split:
+                return self._rows(self.right, rows, slice(start - self.split,
+                                                          stop - self.split))
+        left = np.asarray(self.left[rows])
+        right = np.asarray(self.right[rows])
+        if left.ndim == 1:
+            data = np.concatenate((left, right))
+            return data[cols]
+        return np.hstack((left, right))[:, cols]
+
+    def _rows(self, part, rows, cols):
+        whole = cols.indices(part.shape[1]) == (0, part.shape[1], 1)
+        all_rows = isinstance(rows, slice) and rows == slice(None)
+        if all_rows and whole:
+            return part
+        if whole:
+            return part[rows]
+        return part[rows, cols]
+
+
 class BaseDataset(object):
     def __init__(self):
         self.data = None
         self.is_loaded = False
+        self.lazy = False
+        self._file = None
 
-    def load(self, dataset_file):
+    def load(self, dataset_file, lazy=False):
         """
         Unpack dataset from hdf5 file into self
-        """
-        with h5py.File(dataset_file, 'r') as f:
-            self._load(f)
+
+        With lazy=True arrays are not read, but replaced with memmap or
+        h5py views, the file stays open until close() is called.
+        """
+        self.close()
+        self.lazy = lazy
+        if lazy:
+            self._file = h5py.File(dataset_file, 'r')
+            self._load(self._file)
+        else:
+            with h5py.File(dataset_file, 'r') as f:
+                self._load(f)
         self.is_loaded = True
 
-    def save(self, dataset_file):
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def save(self, dataset_file, storage=None):
         """
         Save all dataset data into hdf5 file
         """
         assert self.is_loaded
+        self._storage = settings.DATASET_STORAGE if storage is None else storage
         with h5py.File(dataset_file, 'w', libver='latest') as f:
             self._dump(f)
 
@@ -48,12 +156,28 @@ class BaseDataset(object):
                 pass
         return data
 
+    def _read(self, dset):
+        """
+        Returns content of hdf5 dataset, lazy view if self.lazy.
+        """
+        if self.lazy:
+            return lazy_array(dset)
+        return dset[...]
+
+    def _create_dataset(self, dfile, name, data):
+        """
+        Creates hdf5 dataset with storage selected in save().
+        """
+        storage = getattr(self, '_storage', settings.DATASET_STORAGE)
+        return dfile.create_dataset(name, data.shape, data=data,
+                                    **storage_options(data.shape, storage))
+
     def _load(self, dfile):
         """
         Loads data from hdf5 into self.
         """
         dset = dfile['data']
-        self.data = dset[...]
+        self.data = self._read(dset)
         self.source_data_type = dset.attrs['source_data_type']
         self.version = dset.attrs['version']
 
@@ -61,11 +185,16 @@ class BaseDataset(object):
         """
         Stores data from self to hdf5.
         """
-        dset = dfile.create_dataset('data', self.data.shape,
-                                    compression='gzip', data=self.data)
+        dset = self._create_dataset(dfile, 'data', self._data_array())
         dset.attrs['source_data_type'] = self.source_data_type
         dset.attrs['version'] = settings.DATASET_VERSION
 
+    def _data_array(self):
+        """
+        Returns array which is stored as 'data' in hdf5.
+        """
+        return self.data
+
     def _load_source(self, source_file):
         """
         Returns data from data file.
@@ -1,8 +1,8 @@
 import cStringIO
 import numpy as np
 from scipy import sparse
-from . base import BaseDataset
-from .formats import CsvDataFile
+from . base import BaseDataset, HStackView
+from .formats import CsvDataFile, ChunkedCsvDataFile
 from ..aws import S3Key
 from ..shared.fileutils import TempFile
 from utils import ProcessCall, open_datafile
@@ -145,7 +145,213 @@ def filter_normalize(data, norm_min_max=None):
     return data, norm_min_max
 
 
+class FilterPlanError(Exception):
+    pass
+
+
+class FilterPlan(object):
+    """
+    Compiled form of GeneralDataset filters pipeline.
+
+    Column filters (ignore, outputs, permute) are folded into one list
+    of source columns plus one-hot blocks, row filters (balance, shuffle,
+    split) into one index of source rows. The result is then written
+    once, block by block, into a preallocated array, normalization and
+    one-hot expansion included. Functions filter_* above remain the
+    reference implementation, FilterPlanError means that the pipeline
+    should be run through them instead.
+    """
+    BLOCK_ROWS = 4096
+    filters_order = ('ignore', 'outputs', 'balance', 'permute', 'normalize',
+                     'shuffle', 'merge', 'binarize', 'split',)
+
+    def __init__(self, dataset, data):
+        if data.ndim != 2:
+            raise FilterPlanError('Only 2d data can be planned')
+        self.dataset = dataset
+        self.source = data
+        self.dtype = data.dtype
+        self.columns = range(data.shape[1])
+        self.onehot = []
+        self.rows = np.arange(data.shape[0])
+        self.output = dataset.output
+        self.norm = None
+
+    @property
+    def width(self):
+        return len(self.columns) + sum(ncat for _, ncat in self.onehot)
+
+    def compile(self, filters):
+        if any('name' not in f or f['name'] == 'merge' for f in filters):
+            raise FilterPlanError('Filters can\'t be planned')
+        for flt_name in self.filters_order:
+            flt = [f for f in filters if f['name'] == flt_name]
+            if flt:
+                self._compile_filter(flt_name, flt[0])
+        return self
+
+    def _compile_filter(self, name, params):
+        if 'columns' in params:
+            try:
+                columns = sorted([int(x) for x in params['columns']])
+            except (TypeError, ValueError):
+                raise FilterPlanError('Invalid columns')
+            self.dataset.columns = self.dataset.adjust_columns(columns,
+                                                               self.width)
+        columns = self.dataset.columns
+        if name == 'ignore':
+            self._check_columns(columns)
+            self._drop_columns(columns)
+        elif name == 'outputs':
+            self._outputs(params, columns)
+        elif name == 'balance':
+            self._balance(params)
+        elif name == 'permute':
+            self._permute(columns)
+        elif name == 'normalize':
+            self._normalize()
+        elif name == 'shuffle':
+            self._take(self._shuffled(len(self.rows)))
+        elif name == 'split':
+            self._split(params)
+
+    def _check_columns(self, columns):
+        if any(col < 0 or col >= len(self.columns) for col in columns):
+            raise FilterPlanError('Column index out of range')
+
+    def _drop_columns(self, columns):
+        drop = set(columns)
+        self.columns = [col for i, col in enumerate(self.columns)
+                        if i not in drop]
+
+    def _column(self, col):
+        return self.source[:, col][self.rows]
+
+    def _take(self, index):
+        self.rows = self.rows[index]
+        if self.output is not None:
+            self.output = self.output[index]
+
+    def _shuffled(self, size):
+        # the same permutation filter_shuffle applies to data and output
+        index = np.arange(size)
+        np.random.RandomState(777).shuffle(index)
+        return index
+
+    def _outputs(self, params, columns):
+        self.dataset.filter_output = [params]
+        if not columns:
+            self.output = None
+            return
+        self._check_columns(columns)
+        if not len(self.rows):
+            raise FilterPlanError('Empty data')
+        out_cols = [self.columns[col] for col in columns]
+        self.output = self.source[:, out_cols][self.rows]
+        self._drop_columns(columns)
+
+    def _balance(self, params):
+        if self.output is None:
+            # filter_balance raises, pipeline skips the filter
+            return
+        # balancing row numbers instead of rows makes the same
+        # random choices filter_balance makes on the whole data
+        index = np.arange(len(self.rows), dtype=float).reshape((-1, 1))
+        try:
+            index, output = filter_balance(index, self.output,
+                                           params['sample'])
+        except Exception:
+            return
+        self.rows = self.rows[index[:, 0].astype(int)]
+        self.output = output.astype(np.result_type(self.dtype,
+                                                   self.output.dtype))
+
+    def _permute(self, columns):
+        self._check_columns(columns)
+        if not len(self.rows):
+            raise FilterPlanError('Empty data')
+        for col in columns:
+            cat = self._column(self.columns[col]).astype(int)
+            if cat.min() < 0:
+                raise FilterPlanError('Negative category')
+            self.onehot.append((self.columns[col], cat.max()))
+        self._drop_columns(columns)
+        self.dtype = np.result_type(self.dtype, np.float64)
+
+    def _normalize(self):
+        norm_min_max = self.dataset.norm_min_max
+        if norm_min_max is None:
+            if not len(self.rows):
+                raise FilterPlanError('Empty data')
+            data_min, data_max = self._column_range()
+        else:
+            data_min, data_max = norm_min_max[0], norm_min_max[1]
+            self.dataset.norm_min_max = np.vstack((data_min, data_max))
+            self.dtype = np.result_type(self.dtype, np.asarray(data_min).dtype,
+                                        np.asarray(data_max).dtype)
+        delta = data_max - data_min
+        delta[delta == 0] = 1
+        self.norm = (data_min, delta)
+
+    def _column_range(self):
+        data_min = np.empty(self.width, dtype=self.dtype)
+        data_max = np.empty(self.width, dtype=self.dtype)
+        for i, col in enumerate(self.columns):
+            values = self._column(col)
+            data_min[i], data_max[i] = values.min(), values.max()
+        offset = len(self.columns)
+        for col, ncat in self.onehot:
+            cat = self._column(col).astype(int)
+            counts = np.bincount(cat, minlength=ncat + 1)[1:]
+            data_min[offset:offset + ncat] = counts == len(cat)
+            data_max[offset:offset + ncat] = counts > 0
+            offset += ncat
+        return data_min, data_max
+
+    def _split(self, params):
+        try:
+            start, end = params['start'], params['end']
+        except KeyError:
+            return
+        length = len(self.rows)
+        start = int(round(length * (start / 100.0)))
+        end = int(round(length * (end / 100.0)))
+        self._take(slice(start, end))
+
+    def materialize(self):
+        """
+        Writes planned data into a new array and output into dataset.
+        """
+        data = np.empty((len(self.rows), self.width), dtype=self.dtype)
+        for start in xrange(0, len(self.rows), self.BLOCK_ROWS):
+            index = self.rows[start:start + self.BLOCK_ROWS]
+            self._fill(data[start:start + len(index)], index)
+        self.dataset.output = self.output
+        return data
+
+    def _fill(self, block, index):
+        plain = len(self.columns)
+        if plain:
+            block[:, :plain] = self.source[index][:, self.columns]
+        offset = plain
+        for col, ncat in self.onehot:
+            onehot = block[:, offset:offset + ncat]
+            onehot[...] = 0
+            cat = self.source[index, col].astype(int)
+            hit = np.nonzero(cat > 0)[0]
+            onehot[hit, cat[hit] - 1] = 1
+            offset += ncat
+        if self.norm is not None:
+            data_min, delta = self.norm
+            block -= data_min
+            block /= delta
+            block[block < 0] = 0
+            block[block > 1] = 1
+
+
 class GeneralDataset(BaseDataset):
+    filter_plan = True
+
     def __init__(self):
         self.norm_min_max = None
         self.output = None
@@ -175,16 +381,40 @@ class GeneralDataset(BaseDataset):
                 raise Exception(error['descr'])
         return target
 
-    def _load_source(self, source_file, **kwargs):
-        csvdatafile = CsvDataFile(source_file, **kwargs)
+    def _apply_filters_pipeline(self, data, filters):
+        """
+        Applies filters through FilterPlan, so the result is built in
+        one pass, falls back to per-filter pipeline if filters can't
+        be planned.
+        """
+        if not filters or not self.filter_plan:
+            return super(GeneralDataset, self)._apply_filters_pipeline(
+                data, filters)
+        state = (self.columns, self.output, self.filter_output,
+                 self.norm_min_max, np.random.get_state())
+        try:
+            plan = FilterPlan(self, data).compile(filters)
+        except FilterPlanError:
+            (self.columns, self.output, self.filter_output,
+             self.norm_min_max, random_state) = state
+            np.random.set_state(random_state)
+            return super(GeneralDataset, self)._apply_filters_pipeline(
+                data, filters)
+        return plan.materialize()
+
+    def _load_source(self, source_file, chunked=False, **kwargs):
+        DataFile = ChunkedCsvDataFile if chunked else CsvDataFile
+        csvdatafile = DataFile(source_file, **kwargs)
         data = csvdatafile.load_to_ndarray(False)
         self.error_lines = csvdatafile.error_lines
         return data
 
-    def load_from_lines(self, data, norm_min_max=None, **kwargs):
+    def load_from_lines(self, data, norm_min_max=None, chunked=False,
+                        **kwargs):
         self.norm_min_max = norm_min_max
         data = cStringIO.StringIO(data)
-        csvdatafile = CsvDataFile(data, **kwargs)
+        DataFile = ChunkedCsvDataFile if chunked else CsvDataFile
+        csvdatafile = DataFile(data, **kwargs)
         data = csvdatafile.load_to_ndarray(False)
         if norm_min_max:
             data = self._apply_filter(data, 'normalize', None)
@@ -197,7 +427,7 @@ class GeneralDataset(BaseDataset):
         if 'norm_min_max' in dfile:
             self.norm_min_max = dfile['norm_min_max'][...]
         if 'output' in dfile:
-            self.output = dfile['output'][...]
+            self.output = self._read(dfile['output'])
 
 
     def _dump(self, dfile):
@@ -206,8 +436,7 @@ class GeneralDataset(BaseDataset):
             dfile.create_dataset('norm_min_max', self.norm_min_max.shape,
                                  compression='gzip', data=self.norm_min_max)
         if self.output is not None:
-            dfile.create_dataset('output', self.output.shape,
-                                 compression='gzip', data=self.output)
+            self._create_dataset(dfile, 'output', self.output)
 
     def adjust_columns(self, columns, columns_total):
         if not self.columns:
@@ -249,6 +478,8 @@ class GeneralDataset(BaseDataset):
     def get_training_data(self):
         if self.output is None:
             return self.data
+        if self.lazy:
+            return HStackView(self.data, self.output)
         return np.hstack((self.data, self.output))
 
     def get_predict_data(self):
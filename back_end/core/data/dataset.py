@@ -33,8 +33,10 @@ def load(train_dataset, test_dataset, valid_dataset):
 
 
 def load_dataset(dataset, key):
-    dataset_file = S3Key(key).get()
-    dataset.load(dataset_file=dataset_file)
+    lazy = settings.DATASET_LAZY_LOAD
+    # lazy dataset reads file until the end of process
+    dataset_file = S3Key(key).get(pin=lazy)
+    dataset.load(dataset_file=dataset_file, lazy=lazy)
     return dataset
 
 
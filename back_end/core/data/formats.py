@@ -8,6 +8,7 @@ from ..aws import S3Key
 
 log = get_logger('erstaz.data.formats')
 STR_TYPES = ('S', 'a', 'b', 'U',)
+CHUNK_SIZE = 65536
 FORMAT_ERROR_MSG = '''
                    Data file has invalid format.
                    File should contain data columns delimited with a space or a comma.
@@ -180,3 +181,156 @@ class CsvDataFile(object):
         except StopIteration:
             raise DataFileError(FORMAT_ERROR_MSG, show_to_user=True)
         return parser
+
+
+class ChunkedCsvDataFile(CsvDataFile):
+    """
+    Streaming version of CsvDataFile.
+
+    Lines are parsed in blocks of ``chunk_size`` directly into a
+    preallocated output buffer of ``dtype``, which grows geometrically,
+    so the whole file is never held in memory as text or as an
+    intermediate string array. Class columns are resolved through
+    dicts built once from ``classes``.
+    """
+
+    def __init__(self, dataset, chunk_size=CHUNK_SIZE, dtype=np.float32,
+                 **kwargs):
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+        super(ChunkedCsvDataFile, self).__init__(dataset, **kwargs)
+
+    def _do_load_to_ndarray(self):
+        if isinstance(self.data, (str, unicode)):
+            lines = open_datafile(self.data)
+        else:
+            lines = iter(self.data)
+        for _ in range(self.skip_header):
+            next(lines, None)
+        converters = None
+        out_ = None
+        size = 0
+        for chunk in self._iter_chunks(lines):
+            if converters is None:
+                chunk = self._init_columns(chunk)
+                if not chunk:
+                    continue
+                converters = self._make_converters()
+                out_ = np.empty((self.chunk_size, self.num_columns),
+                                dtype=self.dtype)
+            if size + len(chunk) > out_.shape[0]:
+                capacity = max(out_.shape[0] * 2, size + len(chunk))
+                out_ = self._grow(out_, size, capacity)
+            size += self._parse_chunk(chunk, converters, out_[size:])
+        if out_ is None:
+            raise DataFileError(FORMAT_ERROR_MSG, show_to_user=True)
+        out_.resize((size, self.num_columns), refcheck=False)
+        mask = np.isnan(out_).any(1)
+        self.error_lines = np.where(mask)[0].tolist()
+        if self.error_lines:
+            return out_[~mask]
+        return out_
+
+    def _iter_chunks(self, lines):
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _split(self, line):
+        values = line.rstrip('\r\n').split(self.delimiter)
+        if self.delimiter is not None:
+            values = [val.strip() for val in values]
+            if len(values) > 1 and values[-1] == '':
+                values.pop()
+        return values
+
+    def _init_columns(self, chunk):
+        """
+        Detects number of columns and drops header from the first chunk.
+        """
+        chunk = [line for line in chunk if line.strip()]
+        if not chunk:
+            return chunk
+        first = self._split(chunk[0])
+        if not self.num_columns:
+            self.num_columns = len(first)
+        if not self.skip_header and self._is_header(first):
+            chunk = chunk[1:]
+        return chunk
+
+    def _is_header(self, values):
+        # mirrors CsvDataFile._double_check_header: a first row is a header
+        # when none of its numeric columns holds a number
+        numeric = [val for i, val in enumerate(values)
+                   if self._dtype(i) not in STR_TYPES + ('-',)]
+        if not numeric:
+            return False
+        for val in numeric:
+            try:
+                float(val)
+                return False
+            except ValueError:
+                pass
+        return True
+
+    def _dtype(self, col):
+        try:
+            return self.dtypes[col]
+        except IndexError:
+            return None
+
+    def _make_converters(self):
+        converters = []
+        for col in range(self.num_columns):
+            dtype = self._dtype(col)
+            if dtype in STR_TYPES:
+                converters.append(dict((val, float(i)) for i, val in
+                                       enumerate(self.classes[col])))
+            elif dtype == '-':
+                converters.append(0)
+            else:
+                converters.append(None)
+        return converters
+
+    def _parse_chunk(self, chunk, converters, out_):
+        rows = []
+        for line in chunk:
+            values = self._split(line)
+            if len(values) == self.num_columns:
+                rows.append(values)
+            # rows with wrong number of columns are dropped, the same
+            # way genfromtxt does with invalid_raise=False
+        if not rows:
+            return 0
+        block = out_[:len(rows)]
+        columns = zip(*rows)
+        for col, conv in enumerate(converters):
+            values = columns[col]
+            if conv is None:
+                try:
+                    block[:, col] = np.array(values, dtype='S').astype(
+                        self.dtype)
+                except ValueError:
+                    block[:, col] = [_to_float(val) for val in values]
+            elif conv == 0:
+                block[:, col] = 0
+            else:
+                block[:, col] = [conv.get(val, np.nan) for val in values]
+        return len(rows)
+
+    def _grow(self, out_, size, capacity):
+        grown = np.empty((capacity, out_.shape[1]), dtype=out_.dtype)
+        grown[:size] = out_[:size]
+        return grown
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
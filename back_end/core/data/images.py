@@ -29,6 +29,8 @@ def get_data_size(archive, members):
 
 
 class ImageDataset(GeneralDataset):
+    filter_plan = False
+
     def __init__(self, **kwargs):
         super(ImageDataset, self).__init__()
         self.source_data_type = "IMAGES"
@@ -0,0 +1,89 @@
+import numpy as np
+
+
+class RaggedSequences(object):
+    """
+    Variable-length sequences stored without padding.
+
+    Timesteps of all samples are concatenated into 2d ``values``,
+    sample i occupies ``values[offsets[i]:offsets[i + 1]]``.
+    ``shape`` reports the equivalent NaN-padded (N, T, F) shape.
+    """
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lengths = np.diff(self.offsets)
+        max_len = self.lengths.max() if len(self.lengths) else 0
+        self.shape = (len(self.lengths), int(max_len), values.shape[1])
+        self.dtype = values.dtype
+
+    @classmethod
+    def from_lengths(cls, values, lengths):
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(values, offsets)
+
+    @classmethod
+    def from_padded(cls, data):
+        """
+        Builds store from (N, T, F) array padded with NaN timesteps.
+        """
+        mask = ~np.isnan(data).all(axis=2)
+        return cls.from_lengths(data[mask], mask.sum(axis=1))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        """
+        Returns timesteps of sample for int index and
+        RaggedSequences view on a run of samples for slice.
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self.take(np.arange(start, stop, step))
+            stop = max(start, stop)
+            offsets = self.offsets[start:stop + 1]
+            values = self.values[offsets[0]:offsets[-1]]
+            return RaggedSequences(values, offsets - offsets[0])
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def take(self, index):
+        """
+        Returns new store with samples in order of index.
+        """
+        index = np.asarray(index, dtype=np.int64)
+        lengths = self.lengths[index]
+        rows = np.repeat(self.offsets[index] - np.cumsum(lengths) + lengths,
+                         lengths) + np.arange(lengths.sum())
+        return RaggedSequences.from_lengths(self.values[rows], lengths)
+
+    def length_order(self):
+        """
+        Returns indexes of samples from longest to shortest.
+        """
+        return np.argsort(-self.lengths, kind='mergesort')
+
+    def to_padded(self, max_len=None):
+        """
+        Returns (N, T, F) array with missing timesteps filled with NaN.
+        """
+        max_len = self.shape[1] if max_len is None else max_len
+        data = np.empty((len(self), max_len, self.shape[2]), dtype=self.dtype)
+        data.fill(np.nan)
+        mask = np.arange(max_len) < self.lengths[:, np.newaxis]
+        data[mask] = self.values
+        return data
+
+    def timesteps(self):
+        """
+        Yields rows of every timestep of samples sorted from longest
+        to shortest, samples which already ended are not included.
+        """
+        lengths = self.lengths
+        starts = self.offsets[:-1]
+        for t in xrange(self.shape[1]):
+            active = np.searchsorted(-lengths, -t, side='left')
+            yield self.values[starts[:active] + t]
@@ -138,6 +138,49 @@ def test_csv_load_from_lines():
     assert dataset.data.shape == (8, 4)
 
 
+def test_csv_load_from_lines_chunked():
+    dataset = data_csv.GeneralDataset()
+    dataset.load_from_lines(LINES, chunked=True)
+    reference = data_csv.GeneralDataset()
+    reference.load_from_lines(LINES)
+    assert dataset.data.shape == (8, 4)
+    assert dataset.data.dtype == np.float32
+    assert np.allclose(dataset.data, reference.data)
+
+
+def test_csv_load_from_lines_chunked_invalid():
+    lines = "x1,x2,x3,y\n30,37,67,50\n93,error,55,24\n90,68,72,59\n23,35,76,8"
+    kwargs = {'num_columns': 4, 'dtypes': ['i', 'i', 'i', 'i']}
+    dataset = data_csv.GeneralDataset()
+    dataset.load_from_lines(lines, chunked=True, **kwargs)
+    assert dataset.data.shape == (3, 4)
+    assert dataset.error_lines == [1]
+    assert np.all(dataset.data[:, 0] == [30, 90, 23])
+
+
+def test_csv_load_from_lines_chunked_text_data():
+    lines = "2000,Mercury,0.5,in\n3400,Mars,0.8,in\n120,Venus,0.1,out\n" + \
+      "800,Pluto,0.2,in\n2100,Jupiter,0.8,na\n200,Mars,0.4,na"
+    kwargs = {
+        'num_columns': 4,
+        'dtypes': ['i', 'S', 'f', 'S'],
+        'classes': [[], ['Earth', 'Jupiter', 'Mars', 'Mercury', 'Venus'],
+                    [], ['in', 'na', 'out']],
+        'chunk_size': 2,
+    }
+    dataset = data_csv.GeneralDataset()
+    dataset.load_from_lines(lines, chunked=True, **kwargs)
+    result = np.array([
+        [2000, 3, 0.5, 0],
+        [3400, 2, 0.8, 0],
+        [ 120, 4, 0.1, 2],
+        [2100, 1, 0.8, 1],
+        [ 200, 2, 0.4, 1]
+    ])
+    assert np.allclose(dataset.data, result)
+    assert dataset.error_lines == [3]
+
+
 def test_csv_load_from_source(filename):
     dataset = data_csv.GeneralDataset()
     dataset_file = dataset.load_from_source(filename, **dataset_params)
@@ -507,3 +550,28 @@ def test_csv_load_from_source_merge_with_output(monkeypatch, filename, filename_
     dataset_file = dataset.load_from_source(filename, **params)
     assert dataset.data.shape == (14, 2)
     assert dataset.output.shape == (14, 2)
+
+
+@pytest.mark.parametrize('storage', ['gzip', 'lzf', 'raw'])
+def test_csv_save_load_lazy(storage):
+    filename = os.path.join(DIR, 'tmp_lazy.hdf5')
+    dataset = data_csv.GeneralDataset()
+    dataset.load_from_lines(LINES)
+    dataset.data, dataset.output = data_csv.filter_output(dataset.data, [3])
+    dataset.save(filename, storage=storage)
+    try:
+        lazy = data_csv.GeneralDataset()
+        lazy.load(filename, lazy=True)
+        assert isinstance(lazy.data, np.memmap) == (storage == 'raw')
+        training = lazy.get_training_data()
+        expected = np.hstack((dataset.data, dataset.output))
+        assert training.shape == (8, 4)
+        assert np.allclose(training[2:5], expected[2:5])
+        assert np.allclose(np.asarray(training), expected)
+        # splitting into input and output doesn't touch the other part
+        assert training[:, :-1] is lazy.data
+        assert training[:, -1:] is lazy.output
+        assert np.allclose(training[1:3, 1:], expected[1:3, 1:])
+        lazy.close()
+    finally:
+        os.remove(filename)
@@ -0,0 +1,108 @@
+import pytest
+import numpy as np
+from ersatz.data import csv as data_csv
+from ersatz.data.base import BaseDataset
+
+
+def make_data(rows=50, seed=11):
+    rng = np.random.RandomState(seed)
+    data = rng.rand(rows, 6) * 10
+    data[:, 2] = rng.randint(0, 4, rows)
+    data[:, 4] = rng.randint(1, 3, rows)
+    data[:, 5] = rng.randint(0, 3, rows)
+    return data
+
+
+def run(filters, data, planned):
+    dataset = data_csv.GeneralDataset()
+    np.random.seed(5)
+    if planned:
+        result = dataset._apply_filters_pipeline(data.copy(), filters)
+    else:
+        result = BaseDataset._apply_filters_pipeline(dataset, data.copy(),
+                                                     filters)
+    return result, dataset
+
+
+def assert_equivalent(filters, data=None):
+    data = make_data() if data is None else data
+    expected, reference = run(filters, data, planned=False)
+    result, dataset = run(filters, data, planned=True)
+    assert result.shape == expected.shape
+    assert result.dtype == expected.dtype
+    assert np.allclose(result, expected, equal_nan=True)
+    if reference.output is None:
+        assert dataset.output is None
+    else:
+        assert np.allclose(dataset.output, reference.output)
+    assert dataset.columns == reference.columns
+    assert dataset.filter_output == reference.filter_output
+    assert np.all(dataset.norm_min_max == reference.norm_min_max)
+
+
+@pytest.mark.parametrize('filters', [
+    [{'name': 'outputs', 'columns': []}],
+    [{'name': 'outputs', 'columns': [5]}],
+    [{'name': 'ignore', 'columns': [1, 3]}],
+    [{'name': 'ignore', 'columns': [1, 3]},
+     {'name': 'outputs', 'columns': [3]}],
+    [{'name': 'permute', 'columns': [2]}],
+    [{'name': 'permute', 'columns': [2, 4]}],
+    [{'name': 'ignore', 'columns': [0, 1]},
+     {'name': 'permute', 'columns': [2]}],
+    [{'name': 'normalize'}],
+    [{'name': 'permute', 'columns': [2]}, {'name': 'normalize'}],
+    [{'name': 'shuffle'}],
+    [{'name': 'outputs', 'columns': [5]}, {'name': 'shuffle'},
+     {'name': 'normalize'}],
+    [{'name': 'split', 'start': 20, 'end': 70}],
+    [{'name': 'outputs', 'columns': [5]}, {'name': 'split', 'start': 0,
+                                           'end': 80}],
+    [{'name': 'outputs', 'columns': [5]},
+     {'name': 'permute', 'columns': [2]},
+     {'name': 'normalize'},
+     {'name': 'shuffle'},
+     {'name': 'split', 'start': 10, 'end': 90}],
+])
+def test_filter_plan_equivalence(filters):
+    assert_equivalent(filters)
+
+
+@pytest.mark.parametrize('sample', ['oversampling', 'undersampling',
+                                    'uniform'])
+def test_filter_plan_balance_equivalence(sample):
+    assert_equivalent([{'name': 'outputs', 'columns': [5]},
+                       {'name': 'balance', 'sample': sample},
+                       {'name': 'permute', 'columns': [2]},
+                       {'name': 'normalize'},
+                       {'name': 'shuffle'},
+                       {'name': 'split', 'start': 0, 'end': 75}])
+
+
+def test_filter_plan_balance_without_output():
+    assert_equivalent([{'name': 'balance', 'sample': 'oversampling'},
+                       {'name': 'normalize'}])
+
+
+def test_filter_plan_float32_data():
+    assert_equivalent([{'name': 'outputs', 'columns': [5]},
+                       {'name': 'normalize'}],
+                      data=make_data().astype(np.float32))
+
+
+def test_filter_plan_fallback():
+    data = make_data()
+    data[3, 2] = -1
+    # negative category can't be planned, reference pipeline is used
+    assert_equivalent([{'name': 'permute', 'columns': [2]},
+                       {'name': 'shuffle'}], data=data)
+    assert_equivalent([{'name': 'ignore', 'columns': [10]},
+                       {'name': 'shuffle'}])
+
+
+def test_filter_plan_blocks(monkeypatch):
+    monkeypatch.setattr(data_csv.FilterPlan, 'BLOCK_ROWS', 7)
+    assert_equivalent([{'name': 'outputs', 'columns': [5]},
+                       {'name': 'permute', 'columns': [2, 4]},
+                       {'name': 'normalize'},
+                       {'name': 'shuffle'}])
@@ -3,7 +3,11 @@ import pytest
 import cStringIO
 import numpy as np
 from ersatz.data import timeseries as ts
+from ersatz.data.ragged import RaggedSequences
 from ersatz.mrnn.util import calculate_batch_size
+from ersatz.mrnn.ersatz_dp import DP
+from ersatz.mrnn.opt.d.generic import Generic3dData
+from ersatz.mrnn.opt.utils import nonlin
 
 
 LINES = ("32,1,12,345|0,1;3,1,1,0|0,1;3,12,2,12|0,1\n"
@@ -13,6 +17,8 @@ LINES = ("32,1,12,345|0,1;3,1,1,0|0,1;3,12,2,12|0,1\n"
          "2,2,-1,-50|0,1;2,1,-10,14|0,1;1,1,3,7|1,0\n"
          "-1,0,3,0|0,1;5,5,-5,0|0,1")
 FILENAME = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'tmp.ts')
+HDF5_FILENAME = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             'tmp_ragged.hdf5')
 
 
 def io(data):
@@ -94,6 +100,229 @@ def test_timeseries_load_from_source_multiple_filters(filename):
     assert timeseries.in_mrnn_format
 
 
+def reference_construct_array(data, len_output, len_input, splitter,
+                              binarize):
+    max_sample_size = max(len(x) for x in data)
+    if binarize:
+        timestep_size = 2 * len_input + len_output
+    else:
+        timestep_size = len_input + len_output
+    rval = np.empty((len(data), max_sample_size, timestep_size),
+                    dtype=np.float32)
+    for i, x in enumerate(data):
+        x = ts.sample_preprocess(x, len_output, len_input, splitter,
+                                 binarize)
+        x = np.array(x, dtype=np.float32)
+        shape = (max_sample_size - len(x), timestep_size)
+        if shape[0]:
+            x = np.vstack((x, np.tile(np.nan, shape)))
+        rval[i] = x
+    return rval
+
+
+def reference_calculate_quantiles(data, len_output):
+    quantiles = []
+    for column in range(0, data.shape[2] - len_output, 2):
+        data_ = data[:, :, column]
+        quantiles.append((np.percentile(data_[~np.isnan(data_)], 25),
+                          np.percentile(data_[~np.isnan(data_)], 50),
+                          np.percentile(data_[~np.isnan(data_)], 75)))
+    return quantiles
+
+
+def reference_convert_to_2bit_binary(data, len_output, quantiles):
+    iquantiles = iter(quantiles)
+    for column in range(0, data.shape[2] - len_output, 2):
+        quarter1, quarter2, quarter3 = iquantiles.next()
+        for i in xrange(data.shape[0]):
+            for j in xrange(data.shape[1]):
+                value = data[i][j][column]
+                if np.isnan(value):
+                    data[i][j][column:column + 2] = [np.NaN, np.NaN]
+                elif value <= quarter1:
+                    data[i][j][column:column + 2] = [0, 0]
+                elif value <= quarter2:
+                    data[i][j][column:column + 2] = [0, 1]
+                elif value <= quarter3:
+                    data[i][j][column:column + 2] = [1, 0]
+                else:
+                    data[i][j][column:column + 2] = [1, 1]
+    return data
+
+
+def random_lines(samples=40, len_input=3, len_output=2, seed=3):
+    rng = np.random.RandomState(seed)
+    lines = []
+    for _ in range(samples):
+        steps = []
+        for _ in range(rng.randint(1, 12)):
+            inputs = ','.join('%d' % x for x in rng.randint(-20, 20, len_input))
+            outputs = ','.join('%d' % x for x in rng.randint(0, 2, len_output))
+            steps.append(inputs + '|' + outputs if len_output else inputs)
+        lines.append(';'.join(steps))
+    return lines
+
+
+@pytest.mark.parametrize('len_output', [0, 2])
+@pytest.mark.parametrize('binarize', [False, True])
+def test_timeseries_construct_array_parity(len_output, binarize):
+    samples = ts.strip_split_samples(random_lines(len_output=len_output))
+    len_input, len_output, splitter = ts.get_timestep_split(samples[0][0])
+    data = ts.construct_array(samples, len_output, len_input, binarize)
+    expected = reference_construct_array(samples, len_output, len_input,
+                                         splitter, binarize)
+    assert data.shape == expected.shape
+    assert np.array_equal(np.isnan(data), np.isnan(expected))
+    assert np.all(data[~np.isnan(data)] == expected[~np.isnan(expected)])
+
+
+def test_timeseries_construct_array_inconsistent():
+    samples = ts.strip_split_samples(['1,2|0;1,2,3|0', '1,2|0,1'])
+    for sample in samples:
+        with pytest.raises(ts.DataFileError):
+            ts.construct_array([sample], 1, 2, False)
+
+
+def test_timeseries_binarize_parity():
+    samples = ts.strip_split_samples(random_lines())
+    data, len_output, _ = ts.load_timeseries(samples, 2, 3, binarize=True)
+    quantiles = ts.calculate_quantiles(data, len_output)
+    assert np.allclose(quantiles,
+                       reference_calculate_quantiles(data, len_output))
+    expected = reference_convert_to_2bit_binary(data.copy(), len_output,
+                                                quantiles)
+    data = ts.convert_to_2bit_binary(data, len_output, quantiles)
+    assert np.array_equal(np.isnan(data), np.isnan(expected))
+    assert np.all(data[~np.isnan(data)] == expected[~np.isnan(expected)])
+
+
+def test_timeseries_load_from_lines_quantiles():
+    quantiles = [(1.0, 2.0, 2.0), (1.0, 2.0, 2.0), (1.0, 2.0, 2.0)]
+    timeseries = ts.Timeseries()
+    timeseries.load_from_lines(io('1,1,1;2,2,2\n3,3,3'), quantiles)
+    data = timeseries.get_training_data()[0]
+    assert data.shape == (2, 2, 6)
+    assert np.all(data[0, 0] == [0, 0, 0, 0, 0, 0])
+    assert np.all(data[0, 1] == [1, 1, 1, 1, 1, 1])
+    assert np.all(data[1, 0] == [0, 1, 0, 1, 0, 1])
+    assert np.all(np.isnan(data[1, 1]))
+
+
+def padded(lengths, features=3, seed=0):
+    rng = np.random.RandomState(seed)
+    data = rng.rand(len(lengths), max(lengths), features).astype(np.float32)
+    for i, length in enumerate(lengths):
+        data[i, length:] = np.nan
+    return data
+
+
+def assert_same(a, b):
+    assert a.shape == b.shape
+    assert np.array_equal(np.isnan(a), np.isnan(b))
+    assert np.all(a[~np.isnan(a)] == b[~np.isnan(b)])
+
+
+def test_ragged_from_padded():
+    data = padded([3, 1, 4, 2])
+    ragged = RaggedSequences.from_padded(data)
+    assert ragged.shape == (4, 4, 3)
+    assert list(ragged.lengths) == [3, 1, 4, 2]
+    assert ragged.values.shape == (10, 3)
+    assert np.all(ragged[2] == data[2])
+    assert_same(ragged.to_padded(), data)
+
+
+def test_ragged_slice_take():
+    data = padded([3, 1, 4, 2, 5])
+    ragged = RaggedSequences.from_padded(data)
+    part = ragged[1:3]
+    assert list(part.lengths) == [1, 4]
+    assert_same(part.to_padded(), data[1:3, :4])
+    order = ragged.length_order()
+    assert list(order) == [4, 2, 0, 3, 1]
+    assert_same(ragged.take(order).to_padded(), data[order])
+    assert_same(ragged[::2].to_padded(), data[::2])
+
+
+def test_ragged_timesteps():
+    data = padded([5, 4, 4, 2, 1])
+    ragged = RaggedSequences.from_padded(data)
+    steps = list(ragged.timesteps())
+    assert [len(x) for x in steps] == [5, 4, 3, 3, 1]
+    for t, step in enumerate(steps):
+        assert np.all(step == data[:len(step), t])
+
+
+@pytest.mark.parametrize('binarize', [False, True])
+def test_ragged_construct_parity(binarize):
+    samples = ts.strip_split_samples(random_lines())
+    len_input, len_output, _ = ts.get_timestep_split(samples[0][0])
+    dense = ts.construct_array(samples, len_output, len_input, binarize)
+    ragged = ts.construct_ragged(samples, len_output, len_input, binarize)
+    assert_same(ragged.to_padded(), dense)
+
+
+def test_ragged_timeseries_parity():
+    samples = ts.strip_split_samples(random_lines())
+    dense, len_output, _ = ts.load_timeseries(samples, 2, 3, binarize=True)
+    ragged, _, _ = ts.load_timeseries(samples, 2, 3, binarize=True,
+                                      ragged=True)
+    dense, quantiles = ts.binarize(dense, len_output)
+    ragged, ragged_quantiles = ts.binarize(ragged, len_output)
+    assert np.allclose(quantiles, ragged_quantiles)
+    assert_same(ragged.to_padded(), dense)
+    timeseries = ts.Timeseries(ragged=True)
+    timeseries.load_from_lines(io(LINES), quantiles=None)
+    dense = ts.Timeseries(ragged=False)
+    dense.load_from_lines(io(LINES), quantiles=None)
+    assert_same(timeseries.get_predict_data()[0],
+                dense.get_predict_data()[0])
+
+
+def test_ragged_timeseries_save_load():
+    timeseries = ts.Timeseries(ragged=True)
+    timeseries.load_from_lines(io(LINES), quantiles=None)
+    try:
+        timeseries.save(HDF5_FILENAME)
+        loaded = ts.Timeseries()
+        loaded.load(HDF5_FILENAME)
+    finally:
+        os.remove(HDF5_FILENAME)
+    assert isinstance(loaded.data, RaggedSequences)
+    assert np.all(loaded.data.offsets == timeseries.data.offsets)
+    assert_same(loaded.data.to_padded(), timeseries.data.to_padded())
+
+
+def batches(data, batch_size=2, num_timesteps=3):
+    provider = DP({})
+    provider.binary_train_data = provider.binary_test_data = data
+    dp_data = provider.create_view()
+    for mode in ('train', 'test'):
+        num_samples = dp_data[mode]['shape'][1]
+        dp_data[mode]['batch_size'] = batch_size
+        dp_data[mode]['num_batches'] = -(-num_samples // batch_size)
+    T, _, vo = dp_data['train']['shape']
+    generator = Generic3dData(T, vo - 2, 2, batch_size, dp_data,
+                              out_nonlin=nonlin.Softmax,
+                              num_timesteps=num_timesteps)
+    ids = generator.train_batches + generator.test_batches
+    return [generator(x) for x in ids]
+
+
+def test_ragged_generic_3d_data_parity():
+    samples = ts.strip_split_samples(random_lines(samples=7))
+    len_input, len_output, _ = ts.get_timestep_split(samples[0][0])
+    ragged = ts.construct_ragged(samples, len_output, len_input, False)
+    ragged = ragged.take(ragged.length_order())
+    dense = ts.utils.to_mrnn_shape(ragged.to_padded())
+    for expected, batch in zip(batches(dense), batches(ragged)):
+        for exp_part, part in zip(expected, batch):
+            assert len(exp_part) == len(part)
+            for exp_step, step in zip(exp_part, part):
+                assert np.all(exp_step.as_numpy_array() ==
+                              step.as_numpy_array())
+
+
 def test_min_batch_size():
     min_batches = 3
     dataset_size = 5
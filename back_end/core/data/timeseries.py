@@ -1,8 +1,10 @@
 import numpy as np
 from . import utils
 from .base import BaseDataset
+from .ragged import RaggedSequences
 from .formats import open_datafile
 from ..aws import S3Key
+from ..conf import settings
 from ..exception import DataFileError, ApiParamsError
 
 
@@ -23,24 +25,28 @@ def extend_with_nans_new(batches):
     return np.vstack(batches)
 
 
-def load_timeseries_from_s3(s3_filename, binarize=False):
+def load_timeseries_from_s3(s3_filename, binarize=False, ragged=False):
     filename = get_data(s3_filename)
-    return load_timeseries_from_file(filename, binarize)
+    return load_timeseries_from_file(filename, binarize, ragged)
 
 
-def load_timeseries_from_file(filename, binarize=False):
+def load_timeseries_from_file(filename, binarize=False, ragged=False):
     data = open_datafile(filename)
-    return load_timeseries_from_lines(data, binarize)
+    return load_timeseries_from_lines(data, binarize, ragged)
 
 
-def load_timeseries_from_lines(data, binarize=False):
+def load_timeseries_from_lines(data, binarize=False, ragged=False):
     data = strip_split_samples(data)
-    len_input, len_output, splitter = get_timestep_split(data[0][0])
-    return load_timeseries(data, len_output, len_input, splitter, binarize)
+    len_input, len_output, _ = get_timestep_split(data[0][0])
+    return load_timeseries(data, len_output, len_input, binarize, ragged)
 
 
-def load_timeseries(data, len_output, len_input, splitter, binarize=False):
-    data = construct_array(data, len_output, len_input, splitter, binarize)
+def load_timeseries(data, len_output, len_input, binarize=False,
+                    ragged=False):
+    if ragged:
+        data = construct_ragged(data, len_output, len_input, binarize)
+    else:
+        data = construct_array(data, len_output, len_input, binarize)
     return data, len_output, np.arange(data.shape[0])
 
 
@@ -81,21 +87,67 @@ def sample_preprocess(sample, len_output, len_input, splitter, binarize):
     return rval
 
 
-def construct_array(data, len_output, len_input, splitter, binarize):
-    max_sample_size = max(len(x) for x in data)
+def parse_sample(sample, len_output, len_input):
+    """
+    Returns timesteps of sample as float32 array of shape
+    (len(sample), len_input + len_output).
+    """
+    for timestep in sample:
+        pipe = timestep.find('|')
+        if pipe < 0:
+            inputs, outputs = timestep.count(',') + 1, 0
+        else:
+            inputs = timestep.count(',', 0, pipe) + 1
+            outputs = timestep.count(',', pipe) + timestep.count('|')
+        if inputs != len_input:
+            raise DataFileError("Inconsistent number of inputs")
+        if outputs != len_output:
+            raise DataFileError("Inconsistent number of outputs")
+    values = ','.join(sample).replace('|', ',').split(',')
+    values = np.array(values, dtype=np.float32)
+    return values.reshape((len(sample), len_input + len_output))
+
+
+def fill_timesteps(out, sample, len_output, len_input, binarize):
+    """
+    Parses sample into out, which is (len(sample), timestep_size) array.
+    """
+    x = parse_sample(sample, len_output, len_input)
     if binarize:
-        timestep_size = 2 * len_input + len_output
+        out[:, 0:2 * len_input:2] = x[:, :len_input]
+        out[:, 1:2 * len_input:2] = 0
+        out[:, 2 * len_input:] = x[:, len_input:]
     else:
-        timestep_size = len_input + len_output
+        out[:] = x
+
+
+def get_timestep_size(len_output, len_input, binarize):
+    if binarize:
+        return 2 * len_input + len_output
+    return len_input + len_output
+
+
+def construct_array(data, len_output, len_input, binarize):
+    max_sample_size = max(len(x) for x in data)
+    timestep_size = get_timestep_size(len_output, len_input, binarize)
     rval = np.empty((len(data), max_sample_size, timestep_size), dtype=np.float32)
     for i, x in enumerate(data):
-        x = sample_preprocess(x, len_output, len_input, splitter, binarize)
-        x = np.array(x, dtype=np.float32)
-        shape = (max_sample_size - len(x), timestep_size)
-        if shape[0]:
-            nans = np.tile(np.nan, shape)
-            x = np.vstack((x, nans))
-        rval[i] = x
+        size = len(x)
+        fill_timesteps(rval[i, :size], x, len_output, len_input, binarize)
+        rval[i, size:] = np.nan
+    return rval
+
+
+def construct_ragged(data, len_output, len_input, binarize):
+    """
+    Same as construct_array, but returns RaggedSequences without padding.
+    """
+    lengths = np.array([len(x) for x in data], dtype=np.int64)
+    timestep_size = get_timestep_size(len_output, len_input, binarize)
+    values = np.empty((lengths.sum(), timestep_size), dtype=np.float32)
+    rval = RaggedSequences.from_lengths(values, lengths)
+    for i, x in enumerate(data):
+        fill_timesteps(rval[i], x, len_output, len_input, binarize)
     return rval
 
 
@@ -103,41 +155,37 @@ def calculate_quantiles(data, len_output):
     quantiles = []
     for column in range(0, data.shape[2] - len_output, 2):
         data_ = data[:, :, column]
-        quarter1 = np.percentile(data_[~np.isnan(data_)], 25)
-        quarter2 = np.percentile(data_[~np.isnan(data_)], 50)
-        quarter3 = np.percentile(data_[~np.isnan(data_)], 75)
-        quantiles.append((quarter1, quarter2, quarter3))
+        data_ = data_[~np.isnan(data_)]
+        quantiles.append(tuple(np.percentile(data_, [25, 50, 75])))
     return quantiles
 
 
 def convert_to_2bit_binary(data, len_output, quantiles):
-    iquantiles = iter(quantiles)
-    for column in range(0, data.shape[2] - len_output, 2):
-        try:
-            quarter1, quarter2, quarter3 = iquantiles.next()
-        except IndexError:
-            raise ApiParamsError('Quantiles and shapes doesn\'t match. '
-                                 'Try to restart this model.')
-        for i in xrange(data.shape[0]):
-            for j in xrange(data.shape[1]):
-                value = data[i][j][column]
-                if np.isnan(value):
-                    data[i][j][column:column + 2] = [np.NaN, np.NaN]
-                elif value <= quarter1:
-                    data[i][j][column:column + 2] = [0, 0]
-                elif value <= quarter2:
-                    data[i][j][column:column + 2] = [0, 1]
-                elif value <= quarter3:
-                    data[i][j][column:column + 2] = [1, 0]
-                else:
-                    data[i][j][column:column + 2] = [1, 1]
+    columns = range(0, data.shape[2] - len_output, 2)
+    quantiles = np.asarray(quantiles, dtype=np.float64)
+    if len(quantiles) < len(columns):
+        raise ApiParamsError('Quantiles and shapes doesn\'t match. '
+                             'Try to restart this model.')
+    for column, quarters in zip(columns, quantiles):
+        values = data[:, :, column]
+        nans = np.isnan(values)
+        # 0: value <= q1, 1: <= q2, 2: <= q3, 3: greater
+        level = np.searchsorted(quarters, values)
+        data[:, :, column] = level >> 1
+        data[:, :, column + 1] = level & 1
+        data[:, :, column:column + 2][nans] = np.nan
     return data
 
 
 def binarize(data, len_output, quantiles=None):
+    if isinstance(data, RaggedSequences):
+        # timesteps of all samples as one sample without padding
+        cube = data.values[np.newaxis]
+    else:
+        cube = data
     if quantiles is None:
-        quantiles = calculate_quantiles(data, len_output)
-    data = convert_to_2bit_binary(data, len_output, quantiles)
+        quantiles = calculate_quantiles(cube, len_output)
+    convert_to_2bit_binary(cube, len_output, quantiles)
     return data, np.array(quantiles)
 
 
@@ -159,11 +207,12 @@ def merge(data):
 
 
 class Timeseries(BaseDataset):
-    def __init__(self, **kwargs):
+    def __init__(self, ragged=None, **kwargs):
         self.quantiles = None
         self.original_order = None
         self.source_data_type = "TIMESERIES"
         self.in_mrnn_format = False
+        self.ragged = settings.TIMESERIES_RAGGED if ragged is None else ragged
         super(Timeseries, self).__init__()
 
     def load_from_source(self, source_file, filters=None, **kwargs):
@@ -177,14 +226,14 @@ class Timeseries(BaseDataset):
         else:
             binarize = False
         data, self.len_output, self.original_order = \
-            load_timeseries_from_file(source_file, binarize)
+            load_timeseries_from_file(source_file, binarize, self.ragged)
         return data
 
     def load_from_lines(self, lines, quantiles):
         self.quantiles = quantiles
         binarize = True if quantiles else False
         data, self.len_output, self.original_order = \
-                load_timeseries_from_lines(lines, binarize)
+                load_timeseries_from_lines(lines, binarize, self.ragged)
         if binarize:
             data = self._apply_filter(data, 'binarize', None)
         self.data = data
@@ -195,6 +244,8 @@ class Timeseries(BaseDataset):
         dset = dfile['data']
         self.len_output = dset.attrs['len_output']
         self.original_order = dfile['original_order'][...]
+        if 'offsets' in dfile:
+            self.data = RaggedSequences(self.data, dfile['offsets'][...])
         try:
             self.quantiles = dfile['quantiles'][...]
         except KeyError:
@@ -206,6 +257,9 @@ class Timeseries(BaseDataset):
         dset.attrs['len_output'] = self.len_output
         dfile.create_dataset('original_order', self.original_order.shape,
                              compression='gzip', data=self.original_order)
+        if isinstance(self.data, RaggedSequences):
+            dfile.create_dataset('offsets', self.data.offsets.shape,
+                                 compression='gzip', data=self.data.offsets)
         if self.quantiles is not None:
             dfile.create_dataset('quantiles', self.quantiles.shape,
                                  compression='gzip', data=self.quantiles)
@@ -219,11 +273,26 @@ class Timeseries(BaseDataset):
                                               params['start'], params['end'])
         return data
 
+    def _data_array(self):
+        if isinstance(self.data, RaggedSequences):
+            return self.data.values
+        return self.data
+
     def to_mrnn_format(self):
+        """
+        Sorts samples from longest to shortest, dense data is also
+        transposed to (T, N, F).
+        """
+        if not self.in_mrnn_format and isinstance(self.data, RaggedSequences):
+            new_order = self.data.length_order()
+            self.original_order = self.original_order[new_order]
+            self.data = self.data.take(new_order)
+            self.in_mrnn_format = True
         if not self.in_mrnn_format:
-            new_order = np.isnan(self.data).sum(axis=(1,2)).argsort()
+            data = np.asarray(self.data)
+            new_order = np.isnan(data).sum(axis=(1,2)).argsort()
             self.original_order = self.original_order[new_order]
-            self.data = self.data[new_order]
+            self.data = data[new_order]
             self.data = utils.to_mrnn_shape(self.data)
             self.in_mrnn_format = True
 
@@ -233,8 +302,25 @@ class Timeseries(BaseDataset):
 
     def get_predict_data(self):
         self.to_mrnn_format()
+        return self.get_padded_data(), self.len_output, self.original_order
+
+    def get_samples(self):
+        """
+        Returns data with samples in stored order, as (N, T, F) array
+        or RaggedSequences, with len_output and original_order.
+        """
+        assert not self.in_mrnn_format
         return self.data, self.len_output, self.original_order
 
+    def get_padded_data(self):
+        """
+        Returns data in padded (T, N, F) layout, also for ragged store.
+        """
+        self.to_mrnn_format()
+        if isinstance(self.data, RaggedSequences):
+            return utils.to_mrnn_shape(self.data.to_padded())
+        return self.data
+
     @property
     def extra_params(self):
         return {'quantiles': self.quantiles}
@@ -1,16 +1,36 @@
+import os
 import time
+import signal
 import json
-from multiprocessing import Process
+from inspect import getargspec
+from collections import deque
+from functools import partial
+from multiprocessing import Process, cpu_count
 import pika
 from pika.exceptions import AMQPConnectionError, AMQPChannelError, ConnectionClosed
 from . import get_logger
 from .conf import settings
+from .exception import ProgramSetupError
+from .mrnn.util import grab_gpu_boards
 
 
 log = get_logger('ersatz.listener')
 
+BlockingConnection = pika.BlockingConnection
+
 
 class Consumer(object):
+    """
+    Takes messages from rabbitmq queues.
+
+    get_message_wait() polls one queue with basic_get. consume() subscribes
+    to several queues on the same channel, broker pushes up to prefetch
+    unacknowledged messages per queue and next_message() returns them as
+    soon as they come. Lost connection is restored with exponential backoff
+    and subscriptions are renewed, messages not acknowledged on the old
+    channel are redelivered by broker.
+    """
+
     def __init__(self, default_queue=None):
         self.queue = default_queue
         self.credentials = pika.PlainCredentials(settings.BROKER_USER,
@@ -18,32 +38,53 @@ class Consumer(object):
         self.parameters = pika.ConnectionParameters(settings.BROKER_HOST,
                 settings.BROKER_PORT, settings.BROKER_VHOST, self.credentials)
         self.connection = None
+        self.channel = None
+        # queue -> consumer tag, None for paused queue
+        self.consumers = {}
+        self.prefetch = 0
+        self.deliveries = deque()
         self._create_connection()
         self._create_channel()
         log.info('Consumer for queue %s created.' % default_queue)
 
     def _create_connection(self):
         print 'PIKA: creating connection to a rabbitmq server'
+        delay = settings.BROKER_RECONNECT_DELAY
         while True:
             try:
-                self.connection = pika.BlockingConnection(self.parameters)
+                self.connection = BlockingConnection(self.parameters)
                 print 'PIKA: Connected to the queue server'
                 return self.connection
             except AMQPConnectionError:
-                print "PIKA: Cant't connect to the queue server"
-                time.sleep(5)
+                print ("PIKA: Cant't connect to the queue server, "
+                       "retry in %s sec" % delay)
+                time.sleep(delay)
+                delay = min(delay * 2, settings.BROKER_RECONNECT_MAX_DELAY)
 
     def _create_channel(self):
         #print 'PIKA: creating channel to a rabbitmq server'
         while True:
             try:
                 self.channel = self.connection.channel()
+                # delivery tags of the old channel are not valid anymore
+                self.deliveries.clear()
+                if self.prefetch:
+                    self.channel.basic_qos(prefetch_count=self.prefetch)
+                for queue, consumer_tag in self.consumers.items():
+                    if consumer_tag is not None:
+                        self._subscribe(queue)
                 return
             except Exception as e:
                 print ("PIKA: cant't create channel: %s" % e)
                 self.close()
                 self._create_connection()
 
+    def _reconnect(self):
+        print "PIKA: disconnected"
+        self.close()
+        self._create_connection()
+        self._create_channel()
+
     def _check_up_state(self):
         while self.channel.is_closed or self.channel.is_closing:
             self._create_channel()
@@ -52,7 +93,12 @@ class Consumer(object):
         _, _, body = self.get_message_wait(queue, seconds_wait)
         return body == 'STOP'
 
-    def get_message_wait(self, queue=None, seconds_wait=None):
+    def get_message_wait(self, queue=None, seconds_wait=None, no_ack=True):
+        """
+        Returns message from queue, waits up to seconds_wait seconds.
+
+        Message taken with no_ack=False must be acknowledged with ack().
+        """
         timer = 0
         queue = queue or self.queue
         if not queue:
@@ -62,13 +108,11 @@ class Consumer(object):
             self._check_up_state()
             try:
                 method_frame, header_frame, body = self.channel.basic_get(
-                        queue, no_ack=True)
+                        queue, no_ack=no_ack)
+            except ConnectionClosed:
+                self._reconnect()
             except (AMQPConnectionError, AMQPChannelError):
                 pass
-            except ConnectionClosed:
-                print "PIKA: disconnected"
-                self._create_connection()
-                self._create_channel()
 
             if method_frame:
                 return method_frame, header_frame, json.loads(body)
@@ -77,6 +121,116 @@ class Consumer(object):
             time.sleep(1)
             timer += 1
 
+    def consume(self, queues, prefetch=1):
+        """
+        Subscribes to queues, pushed messages are returned by next_message().
+        """
+        self.prefetch = prefetch
+        self._check_up_state()
+        self.channel.basic_qos(prefetch_count=prefetch)
+        for queue in queues:
+            self._subscribe(queue)
+
+    def _subscribe(self, queue):
+        self.consumers[queue] = self.channel.basic_consume(
+                partial(self._on_message, queue), queue=queue, no_ack=False)
+
+    def _on_message(self, queue, channel, method_frame, header_frame, body):
+        if channel is not self.channel or self.consumers.get(queue) is None:
+            # delivered before cancel of paused queue was processed
+            channel.basic_reject(delivery_tag=method_frame.delivery_tag,
+                                 requeue=True)
+            return
+        self.deliveries.append((queue, method_frame, body))
+
+    def pause(self, queue):
+        """
+        Stops deliveries from queue, returns its undelivered messages
+        to broker so other workers can take them.
+        """
+        consumer_tag = self.consumers.get(queue)
+        if consumer_tag is None:
+            return
+        self.consumers[queue] = None
+        try:
+            self.channel.basic_cancel(consumer_tag)
+            # rejected last is the first in queue
+            for delivery in [d for d in reversed(self.deliveries)
+                             if d[0] == queue]:
+                self.deliveries.remove(delivery)
+                self.reject(delivery[1].delivery_tag)
+        except AMQPConnectionError:
+            self._reconnect()
+
+    def resume(self, queue):
+        if queue not in self.consumers or self.consumers[queue] is not None:
+            return
+        try:
+            self._check_up_state()
+            self._subscribe(queue)
+        except AMQPConnectionError:
+            self._reconnect()
+            self._subscribe(queue)
+
+    def next_message(self, timeout=None):
+        """
+        Returns (queue, method_frame, body) of pushed message,
+        None if nothing came in timeout seconds.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.deliveries:
+            time_limit = 1
+            if deadline is not None:
+                time_limit = min(time_limit, deadline - time.time())
+                if time_limit <= 0:
+                    return None
+            try:
+                self._check_up_state()
+                self._process_events(time_limit)
+            except ConnectionClosed:
+                self._reconnect()
+            except AMQPChannelError:
+                # channel is recreated by _check_up_state
+                pass
+            except AMQPConnectionError:
+                self._reconnect()
+        queue, method_frame, body = self.deliveries.popleft()
+        return queue, method_frame, json.loads(body)
+
+    def _process_events(self, time_limit):
+        if 'time_limit' in getargspec(
+                self.connection.process_data_events).args:
+            self.connection.process_data_events(time_limit=time_limit)
+        else:
+            # pika 0.9 waits for data up to its socket timeout
+            self.connection.process_data_events()
+
+    def ack(self, delivery_tag, channel=None):
+        """
+        Acknowledges message, channel is the one message came from.
+        """
+        if channel is not None and channel is not self.channel:
+            # channel was recreated, broker will redeliver the message
+            log.warning('Message %s came from closed channel.' % delivery_tag)
+            return
+        try:
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+        except Exception as e:
+            log.warning('Failed to acknowledge message %s: %s'
+                        % (delivery_tag, e))
+
+    def reject(self, delivery_tag, channel=None):
+        """
+        Returns message to its queue.
+        """
+        if channel is not None and channel is not self.channel:
+            return
+        try:
+            self.channel.basic_reject(delivery_tag=delivery_tag, requeue=True)
+        except Exception as e:
+            log.warning('Failed to reject message %s: %s'
+                        % (delivery_tag, e))
+
     def close(self):
         log.info('Consumer exiting...')
         try:
@@ -85,30 +239,209 @@ class Consumer(object):
             pass
 
 
+class Resources(object):
+    """
+    Free slots of a worker box: cpu cores, gpu ids and memory in MB.
+
+    Job requirements are dicts like {'cpu': 1, 'gpu': 1, 'memory': 2048},
+    missing items mean 1 cpu, no gpu and no memory.
+    """
+
+    def __init__(self, cpus, gpus, memory=None):
+        self.cpus = cpus
+        self.gpus = list(gpus)
+        self.memory = memory
+        self.total = {'cpu': cpus, 'gpu': len(self.gpus), 'memory': memory}
+
+    @classmethod
+    def from_settings(cls):
+        return cls(settings.LISTENER_CPUS or cpu_count(), grab_gpu_boards(),
+                   settings.LISTENER_MEMORY)
+
+    @staticmethod
+    def _need(need):
+        return need.get('cpu', 1), need.get('gpu', 0), need.get('memory', 0)
+
+    def check(self, need):
+        """
+        Raises ProgramSetupError if job can't fit even into idle box.
+        """
+        cpu, gpu, memory = self._need(need)
+        if (cpu > self.total['cpu'] or gpu > self.total['gpu'] or
+                (self.memory is not None and memory > self.total['memory'])):
+            raise ProgramSetupError('Job needs %s, worker has %s'
+                                    % (need, self.total))
+
+    def fits(self, need):
+        cpu, gpu, memory = self._need(need)
+        return (cpu <= self.cpus and gpu <= len(self.gpus) and
+                (self.memory is None or memory <= self.memory))
+
+    def acquire(self, need):
+        """
+        Takes slots for job, returns them or None if box is full.
+        """
+        if not self.fits(need):
+            return None
+        cpu, gpu, memory = self._need(need)
+        gpus, self.gpus = self.gpus[:gpu], self.gpus[gpu:]
+        self.cpus -= cpu
+        if self.memory is not None:
+            self.memory -= memory
+        return {'cpu': cpu, 'gpus': gpus, 'memory': memory}
+
+    def release(self, slot):
+        self.cpus += slot['cpu']
+        self.gpus = sorted(self.gpus + slot['gpus'])
+        if self.memory is not None:
+            self.memory += slot['memory']
+
+
+def run_job(runner, body, gpus):
+    """
+    Entry point of job subprocess, job sees only gpus given to it.
+    """
+    # forked job inherits SIGTERM handler stopping the listener
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if gpus:
+        os.environ['ERSATZ_MRNN_GPUS'] = ','.join(str(gpu) for gpu in gpus)
+    runner(body)
+
+
+class JobPool(object):
+    """
+    Runs up to max_jobs jobs in subprocesses while resources allow.
+
+    on_done(exitcode) callback of a job is called from poll() in
+    the thread which started it.
+    """
+
+    def __init__(self, resources, max_jobs=1):
+        self.resources = resources
+        self.max_jobs = max_jobs
+        self.jobs = []
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def can_start(self, need):
+        return len(self.jobs) < self.max_jobs and self.resources.fits(need)
+
+    def start(self, runner, body, need, on_done):
+        if not self.can_start(need):
+            raise ProgramSetupError('No free slots for job')
+        slot = self.resources.acquire(need)
+        p = Process(target=run_job, args=(runner, body, slot['gpus']))
+        p.start()
+        self.jobs.append((p, slot, on_done))
+        log.info('Started job %s, %d running.' % (p.pid, len(self.jobs)))
+        return p
+
+    def poll(self):
+        """
+        Releases slots of finished jobs, returns number of them.
+        """
+        finished = [job for job in self.jobs if not job[0].is_alive()]
+        for job in finished:
+            p, slot, on_done = job
+            p.join()
+            self.jobs.remove(job)
+            self.resources.release(slot)
+            log.info('Job %s finished with code %s.' % (p.pid, p.exitcode))
+            on_done(p.exitcode)
+        return len(finished)
+
+    def drain(self, interval=1):
+        """
+        Waits until all running jobs finish.
+        """
+        if self.jobs:
+            log.info('Waiting for %d running jobs.' % len(self.jobs))
+        while self.jobs:
+            if not self.poll():
+                time.sleep(interval)
+
+
 class ApiListener(object):
+    """
+    Takes messages from queues of runners and runs them as jobs.
+
+    Messages are pushed by broker. With RUN_IN_SUBPROCESS jobs run
+    concurrently in JobPool, queue is consumed only while the box has
+    free slots for LISTENER_RESOURCES of the queue. Message is
+    acknowledged when the job finishes, so jobs of a killed worker
+    go back to the queue.
+    """
+
     def __init__(self, runners, queue='train'):
         self.runners = runners
         self.consumer = Consumer(default_queue=queue)
+        self.pool = JobPool(Resources.from_settings(),
+                            settings.LISTENER_MAX_JOBS)
+        self.stopping = False
+        for _, queue in runners:
+            self.pool.resources.check(self.get_need(queue))
+
+    def get_need(self, queue):
+        return settings.LISTENER_RESOURCES.get(queue, {})
 
     def loop(self):
         log.info('Listening for new api messages.')
         run_in_subprocess = settings.RUN_IN_SUBPROCESS
-        while True:
-            for runner, queue in self.runners:
-                method_frame, _, body = self.consumer.get_message_wait(
-                        queue=queue, seconds_wait=1)
-                if method_frame:
-                    # TODO replace it with pool which can run several
-                    # job at once
-                    if run_in_subprocess:
-                        p = Process(target=runner, args=(body,))
-                        p.start()
-                        while p.is_alive():
-                            time.sleep(1)
-                        p.join()
+        runners = dict((queue, runner) for runner, queue in self.runners)
+        prefetch = self.pool.max_jobs if run_in_subprocess else 1
+        self.consumer.consume(runners, prefetch=prefetch)
+        while not self.stopping:
+            self.pool.poll()
+            if self.stopping:
+                break
+            if run_in_subprocess:
+                for queue in runners:
+                    if self.pool.can_start(self.get_need(queue)):
+                        self.consumer.resume(queue)
                     else:
-                        runner(body)
-                    log.info('Listening for new api messages.')
+                        self.consumer.pause(queue)
+            # finished jobs are checked while waiting for messages
+            message = self.consumer.next_message(
+                    timeout=.1 if self.pool else 1)
+            if message is None:
+                continue
+            queue, method_frame, body = message
+            channel = self.consumer.channel
+            ack = partial(self.consumer.ack, method_frame.delivery_tag,
+                          channel)
+            need = self.get_need(queue)
+            if not run_in_subprocess:
+                # other queues must not hold messages while job runs
+                for other in runners:
+                    self.consumer.pause(other)
+                try:
+                    runners[queue](body)
+                finally:
+                    ack()
+                for other in runners:
+                    self.consumer.resume(other)
+                log.info('Listening for new api messages.')
+            elif self.pool.can_start(need):
+                self.pool.start(runners[queue], body, need,
+                                lambda exitcode, ack=ack: ack())
+            else:
+                # came with job of other queue which took the slots
+                self.consumer.reject(method_frame.delivery_tag, channel)
+        self.drain()
+
+    def stop(self):
+        """
+        Makes loop() stop taking messages and return after running jobs.
+        """
+        self.stopping = True
+
+    def drain(self):
+        self.stopping = True
+        for _, queue in self.runners:
+            self.consumer.pause(queue)
+        self.pool.drain()
 
     def close(self):
+        self.drain()
         self.consumer.close()
@@ -93,7 +93,10 @@ def set_gpu_from_args():
         else:
             mcpus = ','.join(str(x) for x in range(args.mcpus))
         os.environ['GNUMPY_USE_GPU'] = 'no'
+        os.environ['GNUMPY_CPU_PRECISION'] = str(args.cpu_precision)
         os.environ['ERSATZ_MRNN_GPUS'] = mcpus
+        if args.blas_threads is not None:
+            os.environ['ERSATZ_BLAS_THREADS'] = str(args.blas_threads)
         os.environ['THEANO_FLAGS'] = 'mode=FAST_RUN,device=cpu,floatX=float32'
 
     parser = argparse.ArgumentParser()
@@ -103,6 +106,12 @@ def set_gpu_from_args():
     group.add_argument('--mcpus', type=int, default=1,
                         help=("numer of cpu to use for mrnn. CPU mode only "
                               "(default: 1)"))
+    group.add_argument('--cpu-precision', type=int, choices=(32, 64),
+                        default=64,
+                        help="float bits of mrnn on CPU (default: 64)")
+    group.add_argument('--blas-threads', type=int,
+                        help=("BLAS threads of every mrnn process on CPU "
+                              "(default: cores divided between processes)"))
     group = parser.add_argument_group('gpu', 'options to run on gpu')
     group.add_argument('--gpu', type=int, default=0,
                         help="which GPU to use for running jobs (default: 0)")
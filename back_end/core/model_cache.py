@@ -0,0 +1,119 @@
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from . import get_logger
+from .conf import settings
+
+
+log = get_logger('ersatz.model_cache')
+
+
+def estimate_size(model):
+    """
+    Returns number of bytes held by parameters of the model.
+    """
+    if isinstance(model, np.ndarray):
+        return model.nbytes
+    if hasattr(model, 'get_params'):
+        # pylearn model, parameters are theano shared variables
+        return sum(p.get_value(borrow=True).nbytes for p in model.get_params())
+    if isinstance(model, dict):
+        return sum(estimate_size(value) for value in model.values())
+    size = 0
+    for value in getattr(model, '__dict__', {}).values():
+        if isinstance(value, np.ndarray):
+            size += value.nbytes
+        elif hasattr(value, 'as_numpy_array'):
+            # gnumpy garray, float32
+            size += value.size * 4
+        elif isinstance(value, dict) or hasattr(value, 'get_params'):
+            size += estimate_size(value)
+    return size
+
+
+class ModelCache(object):
+    """
+    LRU cache of deserialized models, keyed by s3_data.
+
+    Models are evicted when total estimated size exceeds max_size.
+    Lives as long as the process, so it helps only when jobs run in
+    the listener process (RUN_IN_SUBPROCESS off) or in a persistent
+    worker.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.cold_time = 0.
+        self.warm_time = 0.
+
+    def get(self, key, load, size=estimate_size):
+        """
+        Returns cached value for key, calls load() on miss.
+        """
+        start_time = time.time()
+        with self.lock:
+            if key in self.entries:
+                value, value_size = self.entries.pop(key)
+                self.entries[key] = (value, value_size)
+                self.hits += 1
+                self.warm_time += time.time() - start_time
+                return value
+        value = load()
+        value_size = size(value)
+        with self.lock:
+            self.misses += 1
+            self.cold_time += time.time() - start_time
+            if (self.max_size and key not in self.entries and
+                    value_size <= self.max_size):
+                self.entries[key] = (value, value_size)
+                self.size += value_size
+                self._evict()
+        return value
+
+    def _evict(self):
+        while self.size > self.max_size:
+            key, (_, value_size) = self.entries.popitem(last=False)
+            self.size -= value_size
+            self.evicted += 1
+            log.debug('Evicted model %s from cache.' % (key, ))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Returns hit rate and average cold (miss) and warm (hit) latency.
+        """
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evicted': self.evicted,
+                'size': self.size,
+                'models': len(self.entries),
+                'hit_rate': self.hits / float(requests) if requests else 0.,
+                'cold_latency': self.cold_time / self.misses if self.misses else 0.,
+                'warm_latency': self.warm_time / self.hits if self.hits else 0.,
+            }
+
+
+_cache = {}
+
+
+def get_model_cache():
+    """
+    Returns ModelCache of this process.
+    """
+    if 'cache' not in _cache:
+        _cache['cache'] = ModelCache(settings.PREDICT_MODEL_CACHE_SIZE)
+    return _cache['cache']
@@ -8,6 +8,7 @@
 ##############################################################
 from multiprocessing import Array
 from ..data import dataset
+from ..data.ragged import RaggedSequences
 from .. import get_logger
 from .util import shmem_as_ndarray2
 
@@ -29,21 +30,29 @@ class DP(object): # Data Provider Factory, not Double Penetration Factory...
         self.binary_valid_data = None if valid is None else valid[0]
 
     def create_view(self):
-        shmem_train_data = Array('f', self.binary_train_data.size)
-        self._train_data = shmem_as_ndarray2(shmem_train_data,
-                                             shape=self.binary_train_data.shape)
-        self._train_data[:] = self.binary_train_data
-        shmem_test_data = Array('f', self.binary_test_data.size)
-        self._test_data = shmem_as_ndarray2(shmem_test_data,
-                                       shape=self.binary_test_data.shape)
-        self._test_data[:] = self.binary_test_data
         return {
-            'train': {
-                'shmem': shmem_train_data,
-                'shape': self.binary_train_data.shape,
-            },
-            'test': {
-                'shmem': shmem_test_data,
-                'shape': self.binary_test_data.shape,
-            }
+            'train': self._share(self.binary_train_data),
+            'test': self._share(self.binary_test_data),
+        }
+
+    def _share(self, data):
+        """
+        Copies data into shared memory. Ragged data shares concatenated
+        timesteps and offsets, its shape is the padded (T, N, F) one.
+        """
+        ragged = isinstance(data, RaggedSequences)
+        values = data.values if ragged else data
+        shmem = Array('f', values.size)
+        shmem_as_ndarray2(shmem, shape=values.shape)[:] = values
+        if not ragged:
+            return {'shmem': shmem, 'shape': values.shape}
+        shmem_offsets = Array('i', data.offsets.size)
+        shmem_as_ndarray2(shmem_offsets, shape=data.offsets.shape)[:] = \
+            data.offsets
+        num_samples, max_len, num_features = data.shape
+        return {
+            'shmem': shmem,
+            'shape': (max_len, num_samples, num_features),
+            'offsets': shmem_offsets,
+            'values_shape': values.shape,
         }
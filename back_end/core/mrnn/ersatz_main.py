@@ -44,9 +44,6 @@ def get_network(settings, train_pipe_param):
        cg_precond_expr='1',
 
 
-       test_freq = 1,
-       test_otherwise_on_num = 24,
-
        save_freq = settings.save_freq,
 
        maxnum_iter=settings.maxnum_iter,
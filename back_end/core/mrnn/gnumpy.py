@@ -54,9 +54,9 @@ if _useGpu == 'yes':
  import cudamat as _cudamat
 elif _useGpu == 'no':
  import npmat as _cudamat
- _precision = _os.environ.get('GNUMPY_CPU_PRECISION', '32')
+ _precision = _os.environ.get('GNUMPY_CPU_PRECISION', '64')
  assert _precision in ('32', '64', '128'), 'environment variable GNUMPY_CPU_PRECISION, if present, should have value 32, 64, or 128.'
- _cudamat.__DTYPE__ = eval('numpy.float'+_precision)
+ _cudamat.set_dtype(eval('numpy.float'+_precision)) # __DTYPE__ of the package would not reach npmat.npmat
 
 _cmType = _cudamat.CUDAMatrix
 _isTijmen = False
@@ -88,6 +88,11 @@ def _init_gpu():
 def usingGpu():
  assert _useGpu in ('yes', 'no'), 'first initialize gnumpy'
  return _useGpu=='yes'
+
+def itemsize():
+ """ Bytes of one number of a garray, float32 on the gpu. """
+ if usingGpu(): return 4
+ return int(_precision) // 8
  
 expensive_check_probability = 1 
 acceptable_number_types = 'anything goes' # alternatives: 'no nans'; 'no nans or infs'; or a number indicating the max allowed abs
@@ -393,6 +398,21 @@ def dot(a1, a2):
   return dot(a12, a22).reshape(retShape)
  raise NotImplementedError('dot with arguments of shapes %s and %s' % (a1.shape, a2.shape))
 
+def dot_to(out, a1, a2):
+ """ writes dot(a1, a2) of 2d garrays into the existing garray <out>, which must not overlap a1 or a2. Returns out. """
+ if a1.ndim!=2 or a2.ndim!=2 or a1.shape[1]!=a2.shape[0] or out.shape!=(a1.shape[0], a2.shape[1]): raise ValueError('dot_to with arrays of shapes %s and %s into %s' % (a1.shape, a2.shape, out.shape))
+ if out.size==0: return out
+ if a1.shape[1]==0: out[_t0] = 0; return out # cudamat bug workaround
+ _cudamat.dot(a2._base_as_2d(), a1._base_as_2d(), out._base_as_2d())
+ return out
+
+def add_dot(out, a1, a2):
+ """ out += dot(a1, a2) for 2d garrays, without temporary arrays. Returns out. """
+ if a1.ndim!=2 or a2.ndim!=2 or a1.shape[1]!=a2.shape[0] or out.shape!=(a1.shape[0], a2.shape[1]): raise ValueError('add_dot with arrays of shapes %s and %s into %s' % (a1.shape, a2.shape, out.shape))
+ if out.size==0 or a1.shape[1]==0: return out
+ out._base_as_2d().add_dot(a2._base_as_2d(), a1._base_as_2d())
+ return out
+
 def outer(vec1, vec2): return dot(vec1.ravel()[:, newaxis], vec2.ravel()[newaxis, :])
 
 def concatenate(arrays, axis=0):
@@ -2,10 +2,19 @@
 
 import os, pdb, time, warnings
 import numpy as np
+from scipy.linalg.blas import get_blas_funcs
 
 __DTYPE__ = np.float64
 
 
+def set_dtype(dtype):
+    """
+    Selects float type of matrices created from now on.
+    """
+    global __DTYPE__
+    __DTYPE__ = np.dtype(dtype).type
+
+
 def dummy():
     return CUDAMatrix(np.zeros((1, 1)))
 
@@ -76,7 +85,8 @@ class CUDAMatrix(object):
 
     def reshape(self, shape):
         assert shape[0]*shape[1] == self.shape[0]*self.shape[1]
-        self.numpy_array.resize(*shape)
+        # column major as cudamat, resize() fails on views
+        self.numpy_array = self.numpy_array.reshape(shape, order='F')
         return self
 
     def copy(self):
@@ -791,33 +801,18 @@ class CUDAMatrix(object):
         """
         Add the dot product of m1 and m2 to the matrix.
         """
-
-
-        m3 = dot(m1, m2)
-
-        if m3.shape != self.shape:
+        if (m1.shape[0], m2.shape[1]) != self.shape:
             raise IncompatibleDimensionsException
-
-        self.numpy_array += m3.numpy_array
-
-
+        gemm(1., m1.numpy_array, m2.numpy_array, 1., self.numpy_array)
         return self
 
     def subtract_dot(self, m1, m2):
         """
         Subtract the dot product of m1 and m2 from the matrix.
         """
-
-
-
-        m3 = dot(m1, m2)
-
-        if m3.shape != self.shape:
+        if (m1.shape[0], m2.shape[1]) != self.shape:
             raise IncompatibleDimensionsException
-
-        self.numpy_array -= m3.numpy_array
-
-
+        gemm(-1., m1.numpy_array, m2.numpy_array, 1., self.numpy_array)
         return self
 
 
@@ -1034,7 +1029,7 @@ def empty(shape=None):
     if shape is None:
         shape = (1, 1)
 
-    return CUDAMatrix(np.empty(shape))
+    return CUDAMatrix(np.empty(shape, dtype=__DTYPE__, order='F'), ref=False)
 
 
 def zeros(shape):
@@ -1069,13 +1064,41 @@ def dot(m1, m2, target = None):
 
     target.resize(target_shape)
 
-    try:
-        target.numpy_array[:] = np.dot(m1.numpy_array, m2.numpy_array)
-    except ValueError:
+    if m1.shape[1] != m2.shape[0]:
         raise IncompatibleDimensionsException
+    gemm(1., m1.numpy_array, m2.numpy_array, 0., target.numpy_array)
 
     return target
 
+
+def gemm(alpha, a, b, beta, c):
+    """
+    Computes c = alpha * a.b + beta * c in c, without temporary
+    arrays when c is Fortran ordered and types of a, b and c match.
+    """
+    if (c.dtype.char not in 'fd' or a.dtype != c.dtype or
+            b.dtype != c.dtype or not c.flags.f_contiguous or
+            not a.size or not b.size):
+        if beta:
+            c *= beta
+            c += alpha * np.dot(a, b)
+        else:
+            c[:] = alpha * np.dot(a, b)
+        return c
+    # row major operands are passed transposed, not copied
+    trans_a = not a.flags.f_contiguous
+    trans_b = not b.flags.f_contiguous
+    if trans_a:
+        a = a.T
+    if trans_b:
+        b = b.T
+    func = get_blas_funcs('gemm', (c,))
+    ans = func(alpha, a, b, beta, c, trans_a=trans_a, trans_b=trans_b,
+               overwrite_c=True)
+    if ans is not c:
+        c[:] = ans
+    return c
+
 def vdot(m1, m2):
     assert m1.shape == m2.shape
     return (m1.asarray() * m2.asarray()).sum()
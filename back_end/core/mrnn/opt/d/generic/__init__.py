@@ -5,6 +5,7 @@ import random
 from ersatz.mrnn.opt.utils import nonlin
 from ersatz.mrnn import gnumpy as g
 from ersatz.mrnn.util import shmem_as_ndarray2
+from ersatz.data.ragged import RaggedSequences
 from ersatz import get_logger
 
 log = get_logger('generic 3d data')
@@ -87,16 +88,14 @@ class Generic3dData(object):
         Split data array into test/train subarrays
         """
         log.debug('loading train data...')
-        self.train_data = shmem_as_ndarray2(self.dp_data['train']['shmem'],
-                                            shape=self.dp_data['train']['shape'])
+        self.train_data = self.shared_data(self.dp_data['train'])
         self.train_batches = range(self.dp_data['train']['num_batches'])
         for b in self.train_batches:
             self.batches_info[b] = {'sig': None, 'T': None}
         log.debug('done')
         if self.test_data is None:
             log.debug('loading test data...')
-            self.test_data = shmem_as_ndarray2(self.dp_data['test']['shmem'],
-                                                shape=self.dp_data['test']['shape'])
+            self.test_data = self.shared_data(self.dp_data['test'])
             self.test_batches = [-x-1 for x in range(self.dp_data['test']['num_batches'])]
             for b in self.test_batches:
                 self.batches_info[b] = {'sig': None, 'T': None}
@@ -107,6 +106,17 @@ class Generic3dData(object):
             #self.valid_batches = range(len(self.validation_data))
             log.debug('done')
 
+    def shared_data(self, data):
+        """
+        Returns (T, N, F) array or RaggedSequences over shared memory.
+        """
+        if 'offsets' not in data:
+            return shmem_as_ndarray2(data['shmem'], shape=data['shape'])
+        values = shmem_as_ndarray2(data['shmem'], shape=data['values_shape'])
+        offsets = shmem_as_ndarray2(data['offsets'],
+                                    shape=(data['shape'][1] + 1,))
+        return RaggedSequences(values, offsets)
+
     def __call__(self, x):
         """
         Return batch number x
@@ -124,13 +134,19 @@ class Generic3dData(object):
 
         batch = self.create_batch(mode, batch_id)
 
-        T = batch.shape[0]
+        if isinstance(batch, RaggedSequences):
+            # samples are sorted by length and have no padding,
+            # so every timestep holds only samples which are still going
+            T = self.dp_data[mode]['shape'][0]
+            timesteps = batch.timesteps()
+        else:
+            T = batch.shape[0]
+            timesteps = (step[~np.isnan(step)].reshape((-1, step.shape[1]))
+                         for step in batch)
         Vs = []
         Os = []
         Ms = []
-        for t, timestep in enumerate(batch):
-            num_features = timestep.shape[1]
-            timestep = timestep[~np.isnan(timestep)].reshape((-1, num_features))
+        for t, timestep in enumerate(timesteps):
             if timestep.size == 0:
                 # if timestep contains only nans, then we at the end of
                 # samples and in this batch no one sample has this
@@ -156,4 +172,6 @@ class Generic3dData(object):
             batch_size = self.dp_data['test']['batch_size']
             data = self.test_data
             batch_id = -batch_id - 1
+        if isinstance(data, RaggedSequences):
+            return data[batch_size*batch_id:batch_size*(batch_id+1)]
         return data[:, batch_size*batch_id:batch_size*(batch_id+1), :]
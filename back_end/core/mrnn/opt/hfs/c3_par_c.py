@@ -1,5 +1,6 @@
 import os
 import sys
+import time
 import traceback
 import numpy as np
 from collections import Counter, defaultdict
@@ -10,6 +11,7 @@ from ersatz.listener import Consumer
 from ersatz.exception import ApiParamsError
 from ersatz import conf
 from ersatz.mrnn.util import (shmem_as_ndarray, partition_batches,
+                              batch_costs, BatchQueue,
                               cpu, grab_gpu_boards,
                               to_masked_array_of_different_len as to_masked)
 from  ersatz.mrnn.opt.hfs.c3c import (std_backtrack_arithmetic_factory,
@@ -20,6 +22,7 @@ from ersatz.exception import MRNNWorkerException, UnstableModelException
 from ersatz import get_logger
 from ersatz.misc import Tee
 from ersatz.reporter import build_train_pipe
+from ersatz.profiler import get_profiler
 
 log = get_logger('c3_par_c')
 
@@ -57,8 +60,6 @@ class HF(c3c.HF):
 
                  progress_heuristic=progress_heuristic,
                  damping_heuristic=damping_heuristic,
-                 test_freq=1,
-                 test_otherwise_on_num=None,
 
                  save_freq=None,
                  settings={},
@@ -132,10 +133,7 @@ class HF(c3c.HF):
         self._total_batch = 0
 
         self.iter = 1
-        self.test_freq = test_freq
-        self.test_otherwise_on_num = test_otherwise_on_num
         self.test_losses = -1
-        self.cheap_test_losses = -1
 
 
 
@@ -197,9 +195,9 @@ class HF(c3c.HF):
 
 
         # now we're gonna make the "shared" variables where we write
-        # the answers back form the GN process guys. I don't bother with the
-        # gradients cause they take so much time that sending stuff through a pipe
-        # is good enough.
+        # the answers back form the GN process guys. Gradients come
+        # back the same way, pickling them through a pipe is slow
+        # for large X.
 
 
         init_X_np = init_X_np.astype(np.float32)
@@ -216,6 +214,14 @@ class HF(c3c.HF):
         for i in range(len(self.gpu_boards)):
             GN_shared[i] = multiprocessing.Array('f', init_X_np * 0)
 
+        # grad is written to GN_shared, grad2 here.
+        G2_shared = [multiprocessing.Array('f', init_X_np.size)
+                     for i in range(len(self.gpu_boards))]
+
+        # generation of the parameters in X_shared, bumped by
+        # share_X; workers copy X to the gpu only when it changes.
+        X_generation = multiprocessing.RawValue('l', 0)
+
         # Unfortunately, shmem_as_ndarray is stupid, returning
         # too large arrays; so we trim by len(init_X_np).
         # That seems to do the trick.
@@ -231,6 +237,12 @@ class HF(c3c.HF):
         # write their gauss-newton answers to.
         self.GN_shared_list = [shmem_as_ndarray(x)[:len(init_X_np)]
                                for x in GN_shared]
+        self.G2_shared_list = [shmem_as_ndarray(x)[:len(init_X_np)]
+                               for x in G2_shared]
+        self.sh_X_generation = X_generation
+        self._sh_X_key = None
+        # answers of workers are summed here before going to the gpu
+        self._reduce_buffer = np.empty_like(init_X_np)
 
 
         # create the processes.
@@ -277,6 +289,17 @@ class HF(c3c.HF):
         total_batches = multiprocessing.Value('l', 0)
         total_batches_lock = multiprocessing.Lock()
 
+        # batches of grad, losses, accuracy and gauss_newton are
+        # balanced by their length, workers steal from each other
+        dp_data = settings.worker_params['dp_data']
+        self.train_costs, self.test_costs = [
+            batch_costs(dp_data[mode], dp_data[mode]['batch_size'],
+                        dp_data[mode]['num_batches'])
+            for mode in ('train', 'test')]
+        self.batch_queue = BatchQueue(
+            len(self.gpu_boards),
+            max(len(self.train_costs), len(self.test_costs)))
+
         self.error_queue = SimpleQueue()
         for i in range(len(self.gpu_boards)):
             self.workers[i] = multiprocessing.Process(
@@ -292,6 +315,9 @@ class HF(c3c.HF):
                       X_shared,
                       R_shared,
                       GN_shared,
+                      G2_shared,
+                      X_generation,
+                      self.batch_queue,
                       total_batches,
                       total_batches_lock))
 
@@ -377,6 +403,80 @@ class HF(c3c.HF):
             if self.ans_pipe[worker_id][0].poll(0.001):
                 return self.ans_pipe[worker_id][0].recv()
 
+    @property
+    def X(self):
+        return self._X
+
+    @X.setter
+    def X(self, X):
+        # also called by self.X += ..., parameters changed in place
+        # otherwise need self.X = self.X to reach workers
+        self._X = X
+        self._X_generation = getattr(self, '_X_generation', 0) + 1
+
+    def share_X(self, X):
+        """
+        Writes parameters to shared memory, unless workers have
+        them already.
+        """
+        key = self._X_generation if X is self._X else None
+        if key is None or key != self._sh_X_key:
+            self.sh_X[:] = X.asarray()
+            self.sh_X_generation.value += 1
+        self._sh_X_key = key
+
+    def X_version(self, X):
+        """
+        Returns version of shared parameters X, the same as long as
+        self.X doesn't change, even when temporary parameters like
+        self.X + x were shared in between.
+        """
+        if X is self._X:
+            return self._X_generation
+        # temporary parameters, valid while they stay shared
+        return ('shared', self.sh_X_generation.value)
+
+    def reduce_shared(self, slots):
+        """
+        Sums answers of workers in place, returns the sum on the gpu.
+        """
+        from ersatz.mrnn import gnumpy as g
+        out = self._reduce_buffer
+        out[:] = slots[0]
+        for slot in slots[1:]:
+            out += slot
+        return g.garray(out)
+
+    def load(self, *args, **kwargs):
+        super(HF, self).load(*args, **kwargs)
+        # load changes X in place
+        self.X = self.X
+
+    def batch_cost(self, bid):
+        if bid < 0:
+            return self.test_costs[-bid - 1]
+        return self.train_costs[self.batch_map[bid]]
+
+    def assign_batches(self, batches):
+        """
+        Shares batches of the next command between workers, they
+        take them from self.batch_queue.
+        """
+        self.batch_queue.assign(batches, map(self.batch_cost, batches))
+
+    def pop_profile(self):
+        stats = super(HF, self).pop_profile()
+        profiler = get_profiler()
+        for i in range(len(self.gpu_boards)):
+            self.command_pipe[i][0].send(('profile', None, None, None))
+        stats['profile_workers'] = []
+        for i in range(len(self.gpu_boards)):
+            msg, totals, events = self.get_ans(i)
+            assert msg == 'profile'
+            stats['profile_workers'].append(totals)
+            profiler.add_events(events)
+        return stats
+
     def refresh_mask(self):
         from ersatz.mrnn import gnumpy as g
         self.mask = (g.rand((1, self.h))>.5)
@@ -409,37 +509,33 @@ class HF(c3c.HF):
 
         #batches = range(min(len(batches), len(self.batch_map)))
 
-        from ersatz.mrnn import gnumpy as g
-
         # communicate the current setting of the parameters:
-        self.sh_X[:] = X.asarray()
+        self.share_X(X)
 
         print "GPU BOARDS", self.gpu_boards
+        self.assign_batches(batches)
         for i in range(len(self.gpu_boards)):
-            batches_i = partition_batches(batches, i, len(self.gpu_boards))
-
-            # send the requests
+            # send the requests, batches are in the batch queue
             if any(x<0 for x in batches):
                 self.command_pipe[i][0].send(
-                    ('grad', batches_i, self.batch_map_test, self.mask))
+                    ('grad', None, self.batch_map_test, self.mask))
             else:
                 self.command_pipe[i][0].send(
-                    ('grad', batches_i, self.batch_map, self.mask))
+                    ('grad', None, self.batch_map, self.mask))
 
 
-        tot_grad, tot_losses, tot_grad2, tot = 0, 0, 0, 0
+        tot_losses, tot = 0, 0
         for i in range(len(self.gpu_boards)):
-            # grad sends the answer through a pipe
-            cmd_name, (tot_grad_i,
-                       tot_grad2_i,
-                       tot_losses_i,
+            # grad sends the losses through a pipe, grad and grad2
+            # are in the shared memory
+            cmd_name, (tot_losses_i,
                        tot_i) = self.get_ans(i)
 
             assert cmd_name == 'grad'
-            tot_grad += g.garray(tot_grad_i)
-            tot_grad2 += g.garray(tot_grad2_i)
             tot_losses += tot_losses_i
             tot += tot_i
+        tot_grad = self.reduce_shared(self.GN_shared_list)
+        tot_grad2 = self.reduce_shared(self.G2_shared_list)
 
         end_grad = time.time()
         self.printf('HF: time per grad minibatch = %12.6f\n' % ((end_grad - start_grad) / float(len(batches))))
@@ -451,28 +547,33 @@ class HF(c3c.HF):
 
     def get_accuracy(self, batches, X):
 
-        self.sh_X[:] = X.asarray()
+        self.share_X(X)
 
+        self.assign_batches(batches)
         for i in range(len(self.gpu_boards)):
-            batches_i = partition_batches(batches, i, len(self.gpu_boards))
-
             self.command_pipe[i][0].send(
-                ('accuracy', batches_i, self.batch_map, self.mask))
+                ('accuracy', None, self.batch_map, self.mask))
+
+        answers = []
+        for i in range(len(self.gpu_boards)):
+            cmd_name, accuracy = self.get_ans(i)
+            assert cmd_name == 'accuracy'
+            answers.append(accuracy)
+        return self.merge_accuracy(answers)
 
+    def merge_accuracy(self, answers):
         accuracy_for_each_ts = []
-        accuracy_total = []
-        accuracy_for_last_10_steps = []
         weights = []
         confusion = defaultdict(Counter)
-        for i in range(len(self.gpu_boards)):
-            cmd_name, (acc_for_each_ts, cm, w) = self.get_ans(i)
+        for acc_for_each_ts, cm, w in answers:
+            if acc_for_each_ts is None:
+                # all batches were taken by other workers
+                continue
             accuracy_for_each_ts.append(acc_for_each_ts)
             weights.append(w)
             for k, v in cm.iteritems():
                 confusion[k].update(v)
 
-        assert cmd_name == 'accuracy'
-
         accuracy_for_each_ts = to_masked(accuracy_for_each_ts)
         weights = to_masked(weights)
         accuracy_for_each_ts = np.array(np.ma.average(accuracy_for_each_ts,
@@ -485,19 +586,57 @@ class HF(c3c.HF):
                 accuracy_for_last_10_steps.tolist(), confusion)
 
 
+    def evaluate(self, batches, X, compute_grad=False):
+        """
+        grad, grad2, losses and accuracy as get_accuracy of batches
+        with one forward pass of each batch. grad and grad2 are None
+        without compute_grad.
+        """
+        self._total_batch += 1
+        start = time.time()
+
+        self.share_X(X)
+
+        self.assign_batches(batches)
+        batch_map = self.batch_map
+        if any(x<0 for x in batches):
+            batch_map = self.batch_map_test
+        for i in range(len(self.gpu_boards)):
+            self.command_pipe[i][0].send(
+                ('evaluate', None, batch_map, self.mask, compute_grad))
+
+        tot_losses, tot = 0, 0
+        answers = []
+        for i in range(len(self.gpu_boards)):
+            # grad and grad2 are in the shared memory
+            cmd_name, (tot_losses_i, tot_i, accuracy) = self.get_ans(i)
+            assert cmd_name == 'evaluate'
+            tot_losses += tot_losses_i
+            tot += tot_i
+            answers.append(accuracy)
+
+        grad = grad2 = None
+        if compute_grad:
+            grad = self.reduce_shared(self.GN_shared_list) / tot
+            grad2 = self.reduce_shared(self.G2_shared_list) / tot
+            self.printf('HF: time per grad minibatch = %12.6f\n' % (
+                (time.time() - start) / float(len(batches))))
+
+        self.tot_batch_size = tot
+        return grad, grad2, tot_losses / tot, self.merge_accuracy(answers)
+
     def losses(self, batches, X):
         self._total_batch += 1
         #batches = self._dynamic_blowup(batches)
 
 
         # communicate the current parameters:
-        self.sh_X[:] = X.asarray()
+        self.share_X(X)
 
+        self.assign_batches(batches)
         for i in range(len(self.gpu_boards)):
-            batches_i = partition_batches(batches, i, len(self.gpu_boards))
-
             self.command_pipe[i][0].send(
-                ('losses', batches_i, self.batch_map, self.mask))
+                ('losses', None, self.batch_map, self.mask))
 
         # then collect the answers:
         tot_losses, tot = 0, 0
@@ -517,23 +656,24 @@ class HF(c3c.HF):
         self._total_batch += 1
         #batches = self._dynamic_blowup(batches)
 
-        from ersatz.mrnn import gnumpy as g
-
-        # just copy the damn parameters. Make it faster later if I really want to.
-        self.sh_X[:] = X.asarray()
+        # copy the parameters, unless they didn't change since the
+        # previous call (they don't during CG).
+        self.share_X(X)
 
         # also copy R.
         self.sh_R[:] = R.asarray()
+        self.assign_batches(batches)
+        # workers keep forward states of batches for this version
+        version = self.X_version(X)
         for i in range(len(self.gpu_boards)):
-            batches_i = partition_batches(batches, i, len(self.gpu_boards))
-
             self.command_pipe[i][0].send(
-                ('gauss_newton', batches_i, None, self.damping, self.mask))
+                ('gauss_newton', None, None, self.damping, self.mask,
+                 version))
 
 
 
         # now get the answer back. Of course.
-        tot_gn, tot = 0, 0
+        tot = 0
         for i in range(len(self.gpu_boards)):
             cmd_name, tot_i = self.get_ans(i)
             if cmd_name == 'quit_now':
@@ -543,9 +683,9 @@ class HF(c3c.HF):
             assert cmd_name == 'gauss_newton'
 
             tot += tot_i
-            # get the result of the gauss newton thing
-            # from the shared memory:
-            tot_gn += g.garray(self.GN_shared_list[i])
+        # get the result of the gauss newton thing
+        # from the shared memory:
+        tot_gn = self.reduce_shared(self.GN_shared_list)
 
         self.tot_batch_size = tot
         return (tot_gn / tot)
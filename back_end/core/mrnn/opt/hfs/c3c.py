@@ -20,6 +20,9 @@ from termcolor import colored
 from ersatz import conf, api, aws
 from ersatz.exception import UnstableModelException, ApiStoppedTraining
 from ersatz.misc import NPArrayEncoder
+from ersatz.profiler import get_profiler
+from ersatz.checkpoint import CheckpointUploader, dumps_modeldata, \
+        load_modeldata, MODELDATA_SUFFIX
 
 
 # utility functions:
@@ -200,8 +203,6 @@ class HF(object):
 
                  progress_heuristic=progress_heuristic,
                  damping_heuristic=damping_heuristic,
-                 test_freq=1,
-                 test_otherwise_on_num=None,
                  save_freq=None,
 
                  grab_gpus=True,
@@ -214,6 +215,7 @@ class HF(object):
 
         self.number_of_timesteps_to_use = number_of_timesteps_to_use
         self.is_model_resumed = False
+        self.checkpoints = None
         self.save_freq = save_freq
         self.cg_min_cg = cg_min_cg
         assert num_gpus == 1
@@ -303,10 +305,7 @@ class HF(object):
         self._total_num_cg = 0
         self._total_batch = 0
         self.iter = 1
-        self.test_freq = test_freq
-        self.test_otherwise_on_num = test_otherwise_on_num
         self.test_losses = -1
-        self.cheap_test_losses = -1
 
 
 
@@ -383,6 +382,16 @@ class HF(object):
 
         return ans
 
+    # loss, accuracy and, with compute_grad, grad and grad2 of batches.
+    # overloaded in c3_par_c.py, where they come from one forward pass.
+    def evaluate(self, batches, X, compute_grad=False):
+        grad = grad2 = None
+        if compute_grad:
+            grad, grad2, losses = self.grad(batches, X)
+        else:
+            losses = self.losses(batches, X)
+        return grad, grad2, losses, self.get_accuracy(batches, X)
+
     # R is the vector we multiply by
     def gauss_newton(self, batches, X, R):
         if 'order' not in self.__dict__:
@@ -448,7 +457,8 @@ class HF(object):
 
         def A(x, batches=None):
             if batches is None: batches=self.GN_batches
-            return self.gauss_newton(batches, self.X, x) + x*self.damper
+            with get_profiler().span('gauss_newton'):
+                return self.gauss_newton(batches, self.X, x) + x*self.damper
 
         def M_inv(x):
             return x/self.precond
@@ -704,6 +714,7 @@ class HF(object):
             self.high_score = 0.
             self.lower_loss = None
         time_of_iteration_start = time.time()
+        profiler = get_profiler()
         try:
             for self.iter in xrange(self.iter, self.maxnum_iter+1):
 
@@ -757,25 +768,26 @@ class HF(object):
                     self.refresh_mask() # for dropout
 
                 self.printf('\n\n\nHF: iter = %s\n' % self.iter)
-                grad, grad2, train_losses = self.grad(self.grad_batches, self.X)
-
-                if self.iter % self.test_freq == 0:
-                    self.test_losses = \
-                        self.losses(self.test_batches, self.X)
-                else:
-                    from ersatz.mrnn.opt.utils.extra import random_subset_2
-                    cheap_test_batches = random_subset_2(self.test_batches, self.test_otherwise_on_num)
-                    self.cheap_test_losses = self.losses(cheap_test_batches, self.X)
-
-                accuracy_for_each_timestep_test, \
-                total_accuracy_test, \
-                accuracy_for_last_10_steps_test, \
-                confusion_test = self.get_accuracy(self.test_batches, self.X)
-
-                accuracy_for_each_timestep_train, \
-                total_accuracy_train, \
-                accuracy_for_last_10_steps_train, \
-                confusion_train = self.get_accuracy(self._train_batches, self.X)
+                # grad_batches are the train batches of the iteration,
+                # their losses and accuracy come with the grad
+                with profiler.span('grad'):
+                    grad, grad2, train_losses, (
+                        accuracy_for_each_timestep_train,
+                        total_accuracy_train,
+                        accuracy_for_last_10_steps_train,
+                        confusion_train) = self.evaluate(
+                            self.grad_batches, self.X, compute_grad=True)
+
+                # accuracy needs all test batches, so they are
+                # evaluated every iteration
+                with profiler.span('test'):
+                    test_losses, (
+                        accuracy_for_each_timestep_test,
+                        total_accuracy_test,
+                        accuracy_for_last_10_steps_test,
+                        confusion_test) = self.evaluate(
+                            self.test_batches, self.X)[2:]
+                    self.test_losses = test_losses
 
                 # should probably add validation batches here too...
 
@@ -789,9 +801,11 @@ class HF(object):
                     print colored('new score reached','green')
                     self.high_score = copy.copy(total_accuracy_test)
                     self.lower_loss = self.test_losses.mean()
-                    self.save('best')
+                    with profiler.span('save'):
+                        self.save('best')
 
-                model_data = self.save('latest')
+                with profiler.span('save'):
+                    model_data = self.save('latest')
 
                 accuracy_for_each_timestep_train = [[x for x in accuracy_for_each_timestep_train]]
                 accuracy_for_each_timestep_test = [[x for x in accuracy_for_each_timestep_test]]
@@ -825,17 +839,17 @@ class HF(object):
                         'v_h_norm': norm(nm.W_vh), 'v_f_norm': norm(nm.W_vf),
                         'h_o_norm': norm(nm.W_ho)
                         })
+                if profiler.enabled:
+                    # phases since the previous report: cg and line
+                    # search of the previous iteration, then grad and
+                    # test evaluation of this one
+                    iteration_stats.update(self.pop_profile())
 
                 if self.is_model_resumed:
                     self.is_model_resumed = False
                 else:
-                    api_response = self.report_stat(iteration_stats,
-                                                    model_data,
-                                                    stats_reporter)
-
-                    #if response False, it's api error or job canceled, stop optimizing
-                    if not api_response:
-                        raise Exception('Api respond with not 200 status, stop optimizing')
+                    self.report_stat(iteration_stats, model_data,
+                                     stats_reporter)
 
 
                 self.printf('HF: |grad|  =%8.5f\n' % norm(grad))
@@ -849,7 +863,6 @@ class HF(object):
                 self.printf('HF: test_t_acc = %s%%\n'   % total_accuracy_test)
                 self.printf('HF: test_l10_acc  = %s%%\n'   % accuracy_for_last_10_steps_test)
                 self.printf('HF: test_step_acc =  \n%s\n'   % accuracy_for_each_timestep_test)
-                self.printf('HF: cheaptest= %s\n'   % self.cheap_test_losses)
                 self.printf('HF: overfit  = %s\n'   % (self.test_losses - train_losses))
                 self.printf('HF: damping =  %s\n' % self.damping)
 
@@ -861,7 +874,8 @@ class HF(object):
                 print "1111111111111111"
 
                 time_of_iteration_start = time.time()
-                new_direction = self.get_new_direction(grad, grad2)
+                with profiler.span('cg'):
+                    new_direction = self.get_new_direction(grad, grad2)
 
                 print "2222222222222222"
 
@@ -869,7 +883,8 @@ class HF(object):
                     self.damping, self.rho, self.max_damping,
                     self.behavior_at_max_damping)
 
-                self.line_search(new_direction)
+                with profiler.span('line_search'):
+                    self.line_search(new_direction)
 
                 self.CG_x *= self.cg_shrink_factor
 
@@ -910,6 +925,15 @@ class HF(object):
             raise e
         finally:
             self.shutdown_workers()
+            if self.checkpoints is not None:
+                self.checkpoints.flush(check=False)
+            if profiler.trace:
+                profiler.write_trace(os.path.join(
+                    conf.settings.PROFILE_TRACE_DIR,
+                    '%s.trace.json' % self.model_id))
+
+        if self.checkpoints is not None:
+            self.checkpoints.check()
 
 
         if self.high_score > 0.:
@@ -989,20 +1013,48 @@ class HF(object):
         self.printf('done saving.\n')
         return data
 
-    def report_stat(self, stats, model_data, stats_reporter):
-        modeldata_key = aws.save_modeldata(self.model_id, stats['iteration'], model_data)
-        payload = {
-            'model': self.model_id,
-            'data': stats,
-            's3_data': modeldata_key,
-            'queue_key': self.queue_key
-        }
+    def pop_profile(self):
+        """
+        Returns time spent in phases since the last call,
+        overridden in c3_par_c.py to add timings of workers.
+        """
+        return {'profile': get_profiler().pop()}
 
-        # publish stats
-        if stats_reporter:
-            stats_reporter(json.dumps(payload, cls=NPArrayEncoder))
-
-        return api.post('/api/stats/', payload)
+    def report_stat(self, stats, model_data, stats_reporter):
+        """
+        Queues model data upload and stats report, they are sent by
+        background thread, optimize() waits for them at the end.
+        """
+        if self.checkpoints is None:
+            self.checkpoints = CheckpointUploader()
+        stats['report_time_saved'] = self.checkpoints.time_saved
+        iteration = stats['iteration']
+
+        def upload():
+            with get_profiler().span('upload'):
+                return aws.save_modeldata(self.model_id, iteration,
+                                          dumps_modeldata(model_data),
+                                          suffix=MODELDATA_SUFFIX)
+
+        def report(modeldata_key):
+            payload = {
+                'model': self.model_id,
+                'data': stats,
+                's3_data': modeldata_key,
+                'queue_key': self.queue_key
+            }
+
+            # publish stats
+            if stats_reporter:
+                stats_reporter(json.dumps(payload, cls=NPArrayEncoder))
+
+            #if response False, it's api error or job canceled, stop optimizing
+            with get_profiler().span('api'):
+                response = api.post('/api/stats/', payload)
+            if not response:
+                raise Exception('Api respond with not 200 status, stop optimizing')
+
+        self.checkpoints.submit(report, upload)
 
 
     def load(self, path=None, s3_data=None, high_score=None, lower_loss=None):
@@ -1024,7 +1076,7 @@ class HF(object):
         # path = prefix + str(biggest_int)
 
         if s3_data:
-            data = json.loads(aws.get_data(s3_data))
+            data = load_modeldata(s3_data)
         else:
             if path is None:
                 path = self.path + '.X'
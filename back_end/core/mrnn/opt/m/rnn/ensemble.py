@@ -0,0 +1,113 @@
+import numpy as np
+from ersatz.mrnn import gnumpy as g
+from ersatz.mrnn.opt.m.rnn.mrnn import project_inputs
+
+
+def compatible_key(W):
+    """
+    MRNNs with the same key can run in one MRNNEnsemble.
+    """
+    return (W.v, W.o, W.hid_nonlin, W.out_nonlin)
+
+
+def block_diagonal(arrays):
+    rows = sum(a.shape[0] for a in arrays)
+    columns = sum(a.shape[1] for a in arrays)
+    ans = np.zeros((rows, columns), dtype=arrays[0].dtype)
+    row = column = 0
+    for a in arrays:
+        ans[row:row + a.shape[0], column:column + a.shape[1]] = a
+        row += a.shape[0]
+        column += a.shape[1]
+    return ans
+
+
+class MRNNEnsemble(object):
+    """
+    Forward pass of several MRNNs over the same inputs, one pass over
+    stacked weights per timestep.
+
+    Input projections are single dots over weights of all models and
+    inputs of all timesteps, the output layer is a dot per timestep,
+    nonlinearities run on the stacked state.
+    Only the recurrent dots are done per model, block-diagonal
+    W_hf/W_fh would multiply their flops by the number of models.
+    """
+
+    def __init__(self, models):
+        assert len(set(map(compatible_key, models))) == 1
+        W = models[0]
+        self.models = models
+        self.v, self.o = W.v, W.o
+        self.hid_nonlin = W.hid_nonlin
+        self.out_nonlin = W.out_nonlin
+
+        # columns of each model in stacked hidden and factor units
+        self.h_slices, self.f_slices = [], []
+        h = f = 0
+        for W in models:
+            self.h_slices.append(slice(h, h + W.h))
+            self.f_slices.append(slice(f, f + W.f))
+            h += W.h
+            f += W.f
+        self.h, self.f = h, f
+
+        def stack(name):
+            return g.concatenate([getattr(W, name) for W in models], axis=1)
+
+        self.h_init = stack('h_init')
+        self.W_vf = stack('W_vf')
+        self.W_vh = stack('W_vh')
+        self.f_bias = stack('f_bias')
+        self.W_hf = [W.W_hf for W in models]
+        self.W_fh = [W.W_fh for W in models]
+        # output units of model k are columns k*o:(k+1)*o
+        self.W_ho = g.garray(block_diagonal(
+                [W.W_ho.as_numpy_array() for W in models]))
+
+    def forward_pass(self, V):
+        """
+        Returns stacked hidden states and outputs of models after
+        out_nonlin for every timestep of V, like MRNN.forward_pass
+        without the initial state. Timesteps may get shorter, as
+        samples sorted by length end.
+        """
+        batch_size = V[0].shape[0]
+        H_prev = g.tile(self.h_init, (batch_size, 1))
+        H, Y = [], []
+        for V_t, VF_t, C in zip(V, project_inputs(V, self.W_vf),
+                                project_inputs(V, self.W_vh)):
+            batch_size = V_t.shape[0]
+            H_prev = H_prev[:batch_size]
+            B = VF_t.tanh()
+            A = g.concatenate([g.dot(H_prev[:, hs], W_hf) for hs, W_hf in
+                               zip(self.h_slices, self.W_hf)], axis=1)
+            AB = A * (B + self.f_bias)
+            HX = g.concatenate([g.dot(AB[:, fs], W_fh) for fs, W_fh in
+                                zip(self.f_slices, self.W_fh)], axis=1)
+            H_prev = self.hid_nonlin(HX + C)
+            OX = g.dot(H_prev, self.W_ho)
+            # out_nonlin works on rows, one row per sample and model
+            Y_t = self.out_nonlin(OX.reshape((-1, self.o)))
+            H.append(H_prev)
+            Y.append(Y_t.reshape(OX.shape))
+        return H, Y
+
+    def hidden(self, H, k):
+        """
+        Returns hidden states of k-th model from stacked ones.
+        """
+        return [H_t[:, self.h_slices[k]] for H_t in H]
+
+    def outputs(self, Y):
+        """
+        Returns outputs as (models, T, N, o) array, NaN where samples
+        have ended.
+        """
+        # float64 as extend_with_nans made them before
+        ans = np.empty((len(self.models), len(Y), Y[0].shape[0], self.o))
+        ans.fill(np.nan)
+        for t, Y_t in enumerate(Y):
+            Y_t = Y_t.as_numpy_array().reshape((-1, len(self.models), self.o))
+            ans[:, t, :Y_t.shape[0]] = Y_t.transpose(1, 0, 2)
+        return ans
@@ -1,11 +1,109 @@
+import os
 import re
-from collections import Counter
+from collections import Counter, OrderedDict
 import numpy as np
+from ersatz.conf import settings
 from ersatz.mrnn import gnumpy as g
 from ersatz.mrnn.util import to_masked_array_of_different_len as to_masked
 from ersatz.mrnn.opt.utils import nonlin
 from ersatz.mrnn.opt.utils.extra import unpack, sparsify_strict
 
+def project_inputs(V, W):
+    """
+    Returns [V[t].W for every timestep] computed as one dot of inputs
+    of all timesteps stacked, timesteps are views of its rows and get
+    shorter as samples end.
+    """
+    P = g.dot(g.concatenate(V, axis=0), W)
+    ans = []
+    row = 0
+    for V_t in V:
+        ans.append(P[row:row + V_t.shape[0]])
+        row += V_t.shape[0]
+    return ans
+
+
+def add_input_grad(out, V, D):
+    """
+    Adds sum of V[t].T.D[t] over timesteps to out as one dot.
+    """
+    g.add_dot(out, g.concatenate(V, axis=0).T, g.concatenate(D, axis=0))
+
+
+def dot_into(out, a, b):
+    """
+    Returns a.b written into out, new array if out is None.
+    """
+    if out is None:
+        return g.dot(a, b)
+    return g.dot_to(out, a, b)
+
+
+class Workspace(object):
+    """
+    Buffers of passes of MRNNs of one shape over batches of at most n
+    samples, reused between calls: outputs of dots of every timestep,
+    scratch arrays of a timestep and gradient accumulators. Buffers
+    are made on first use, timesteps are added as longer batches come,
+    passes use views on their first rows.
+    Arrays of a state or result computed in a workspace are valid
+    until its next pass of the same kind: a forward pass, grad or
+    gauss_newton.
+    """
+
+    def __init__(self, W, n):
+        self.n = n
+        self.num_params = W.num_params()
+        self.buffers = {}
+
+    def rows(self, name, n, columns, t=0):
+        """
+        Returns first n rows of buffer name of timestep t, t is 0 for
+        scratch arrays.
+        """
+        key = (name, t)
+        if key not in self.buffers:
+            self.buffers[key] = g.empty((self.n, columns))
+        return self.buffers[key][:n]
+
+    def zeros(self, name):
+        """
+        Returns zeroed vector of the size of parameters.
+        """
+        if name not in self.buffers:
+            self.buffers[name] = g.empty(self.num_params)
+        X = self.buffers[name]
+        X[:] = 0
+        return X
+
+
+# workspaces of the latest batch sizes, per process
+_workspaces = {}
+
+
+def get_workspace(W, V):
+    """
+    Returns Workspace for passes of W over inputs V, the least recently
+    used one is dropped when there are more than
+    settings.MRNN_WORKSPACE_CACHE_SIZE.
+    """
+    pid = os.getpid()
+    if _workspaces.get('pid') != pid:
+        _workspaces['cache'] = OrderedDict()
+        _workspaces['pid'] = pid
+    cache = _workspaces['cache']
+    # samples are sorted by length, the first timestep is the largest
+    n = max(V_t.shape[0] for V_t in V if V_t is not None)
+    key = (n, W.v, W.h, W.f, W.o)
+    workspace = cache.pop(key, None)
+    if workspace is None:
+        workspace = Workspace(W, n)
+    cache[key] = workspace
+    while len(cache) > settings.MRNN_WORKSPACE_CACHE_SIZE:
+        cache.popitem(last=False)
+    return workspace
+
+
 # MRNN. The MRNN is cool. We define it here.
 class MRNN(object):
     def __init__(self,
@@ -18,7 +116,8 @@ class MRNN(object):
 
                  struct_damp_nonlin=nonlin.Tanh, # the structural damping nonlinearity
 
-                 init=True, number_of_timesteps_to_use=99999999):
+                 init=True, number_of_timesteps_to_use=99999999,
+                 hoist_inputs=True, use_workspace=True):
         """
         v int number of features
         h int number of hidden units
@@ -28,11 +127,17 @@ class MRNN(object):
         out_nonlin function output nonlinearity function
         struct_damp_nonlin function
         init bool whether to initialize arrays to random data
+        hoist_inputs bool whether products with inputs of all timesteps
+            are one dot, not a dot per timestep
+        use_workspace bool whether loss, grad and gauss_newton write
+            into buffers of a Workspace reused between calls
         """
         self.v = v
         self.h = h
         self.f = f
         self.o = o
+        self.hoist_inputs = hoist_inputs
+        self.use_workspace = use_workspace
 
         self.hid_nonlin = hid_nonlin
         self.out_nonlin = out_nonlin
@@ -87,10 +192,16 @@ class MRNN(object):
                               self.W_vf.ravel(),
                               self.W_ho.ravel()])
 
+    def num_params(self):
+        v, h, f, o = self.v, self.h, self.f, self.o
+        return h + h*f + f*h + f + v*h + v*f + h*o
+
     def unpack(self, X):
         ans = MRNN(self.v, self.h, self.f, self.o,
                    self.hid_nonlin, self.out_nonlin,
-                   number_of_timesteps_to_use=self.number_of_timesteps_to_use)
+                   number_of_timesteps_to_use=self.number_of_timesteps_to_use,
+                   hoist_inputs=self.hoist_inputs,
+                   use_workspace=self.use_workspace)
 
         (ans.h_init,
          ans.W_hf,
@@ -110,7 +221,24 @@ class MRNN(object):
                             X)
         return ans
 
-    def forward_pass(self, batch, O=None, mask=None):
+    def project_inputs(self, V, W):
+        if not self.hoist_inputs:
+            return [g.dot(V_t, W) for V_t in V]
+        return project_inputs(V, W)
+
+    def add_input_grad(self, out, V, D):
+        if not self.hoist_inputs:
+            for V_t, D_t in zip(V, D):
+                g.add_dot(out, V_t.T, D_t)
+        else:
+            add_input_grad(out, V, D)
+
+    def workspace(self, V):
+        if self.use_workspace:
+            return get_workspace(self, V)
+        return None
+
+    def forward_pass(self, batch, O=None, mask=None, workspace=None):
         # the forward pass: compute the state. it's the most important
         # function and everything else is defined in terms of it.
 
@@ -130,17 +258,24 @@ class MRNN(object):
         batch_size = V[1].shape[0]
 
         A, B, H, OX = [[None]*(T+1) for _ in range(4)]
+        ws = workspace
+
+        # only products with H[t-1] are left in the loop
+        VF = [None] + self.project_inputs(V[1:], self.W_vf)
+        C = [None] + self.project_inputs(V[1:], self.W_vh)
 
         H[0] = g.tile(self.h_init, (batch_size, 1))
         for t in range(1, T+1):
             batch_size = V[t].shape[0]
-            B[t] = g.dot(V[t],   self.W_vf).tanh()
-            A[t] = g.dot(H[t-1], self.W_hf)[:batch_size, :]
-            C_t = g.dot(V[t], self.W_vh) # + hh stuff
+            B[t] = VF[t].tanh()
+            A[t] = dot_into(ws and ws.rows('A', batch_size, self.f, t),
+                            H[t-1][:batch_size], self.W_hf)
+            C_t = C[t] # + hh stuff
 
             AB = A[t]*(B[t] + self.f_bias)
 
-            HX_t = g.dot(AB, self.W_fh) + C_t
+            HX_t = dot_into(ws and ws.rows('HX', batch_size, self.h),
+                            AB, self.W_fh) + C_t
             H[t] = self.hid_nonlin(HX_t)
 
             #next line implements dropout
@@ -156,11 +291,24 @@ class MRNN(object):
             else:
                 new_w_ho = self.W_ho
 
-            OX[t] = g.dot(H[t], new_w_ho)
+            OX[t] = dot_into(ws and ws.rows('OX', batch_size, self.o, t),
+                             H[t], new_w_ho)
 
         return (V[1:], A, B, H, OX[1:])
 
-    def R_forward_pass(self, state, R):
+    def nonlin_derivs(self, state):
+        """
+        Returns derivatives of nonlinearities of the state, which are
+        used by every gauss_newton at it: of hidden units and factor
+        inputs for timesteps 1..T, and outputs after out_nonlin.
+        """
+        V, A, B, H, OX = state
+        HD = [None] + [self.hid_nonlin.grad_y(H_t) for H_t in H[1:]]
+        BD = [None] + [1-B_t*B_t for B_t in B[1:]]
+        P = [self.out_nonlin(OX_t) for OX_t in OX]
+        return HD, BD, P
+
+    def R_forward_pass(self, state, R, workspace=None, derivs=None):
         # differentiate the forward pass using the R-op.
         # R is the direciton of our direcitonal derivative.
         # Really simple stuff.
@@ -183,28 +331,43 @@ class MRNN(object):
         T = len(V)-1
         batch_size = V[1].shape[0]
         R_OX, R_HX = [None]*(T+1), [None]*(T+1)
+        ws = workspace
+        if derivs is None:
+            derivs = self.nonlin_derivs(state)
+        HD, BD = derivs[:2]
+
+        R_VF = [None] + self.project_inputs(V[1:], R.W_vf)
+        R_C = [None] + self.project_inputs(V[1:], R.W_vh)
 
         R_H_t = g.tile(R.h_init, (batch_size, 1))
         for t in range(1, T+1):
             batch_size = V[t].shape[0]
             R_H_1t = R_H_t
 
-            R_B_t = g.dot(V[t], R.W_vf) * (1-B[t]*B[t])
-            R_A_t = g.dot(R_H_1t, self.W_hf) + g.dot(H[t-1], R.W_hf)
-            R_C_t = g.dot(V[t], R.W_vh) # + hh stuff
+            R_B_t = R_VF[t] * BD[t]
+            R_A_t = dot_into(ws and ws.rows('R_A', batch_size, self.f),
+                             R_H_1t[:batch_size], self.W_hf)
+            g.add_dot(R_A_t, H[t-1][:batch_size], R.W_hf)
+            R_C_t = R_C[t] # + hh stuff
 
             B_t_f = B[t] + self.f_bias
             AB = A[t]*B_t_f
-            R_AB = R_A_t[:batch_size,:]*B_t_f + A[t]*(R_B_t + R.f_bias)
+            R_AB = R_A_t*B_t_f + A[t]*(R_B_t + R.f_bias)
 
-            R_HX[t] = g.dot(R_AB, self.W_fh) + g.dot(AB, R.W_fh) + R_C_t
-            R_H_t = self.hid_nonlin.grad_y(H[t]) * R_HX[t]
+            R_HX[t] = dot_into(ws and ws.rows('R_HX', batch_size, self.h, t),
+                               R_AB, self.W_fh)
+            g.add_dot(R_HX[t], AB, R.W_fh)
+            R_HX[t] += R_C_t
+            R_H_t = HD[t] * R_HX[t]
 
-            R_OX[t] = g.dot(H[t], R.W_ho) + g.dot(R_H_t, self.W_ho)
+            R_OX[t] = dot_into(ws and ws.rows('R_OX', batch_size, self.o, t),
+                               H[t], R.W_ho)
+            g.add_dot(R_OX[t], R_H_t, self.W_ho)
 
         return (R_HX, R_OX[1:])
 
-    def backward_pass(self, state, dOX, R_state=None, mu=0., compute_grad2=False):
+    def backward_pass(self, state, dOX, R_state=None, mu=0., compute_grad2=False,
+                      workspace=None, derivs=None):
         # backprop.
 
         if R_state is None:
@@ -229,27 +392,43 @@ class MRNN(object):
 
         T = len(V)-1
 
-        grad = self.unpack(self.pack() * 0)
-        if compute_grad2:
-            grad2 = self.unpack(self.pack() * 0)
+        ws = workspace
+        if ws is None:
+            grad = self.unpack(g.zeros(self.num_params()))
         else:
+            # results of grad and of gauss_newton are kept apart
+            grad = self.unpack(ws.zeros('grad' if R_state is None else 'gn'))
+        if not compute_grad2:
             grad2 = None
+        elif ws is None:
+            grad2 = self.unpack(g.zeros(self.num_params()))
+        else:
+            grad2 = self.unpack(ws.zeros('grad2'))
+        W_ho_T, W_fh_T, W_hf_T = self.W_ho.T, self.W_fh.T, self.W_hf.T
 
 
+        # gradients wrt inputs of the hidden and factor units, their
+        # products with V are summed after the loop
+        dHX, dBB = [None]*(T+1), [None]*(T+1)
+
         dH_1t = g.zeros(H[T].shape)
         prev_batch_size = H[T].shape[0]
         for t in reversed(range(1, T+1)):
 
-            dH_t = g.dot(dOX[t], self.W_ho.T)
+            batch_size = dOX[t].shape[0]
+            dH_t = dot_into(ws and ws.rows('dH', batch_size, self.h), dOX[t], W_ho_T)
             dH_t[:prev_batch_size, :] += dH_1t
 
-            grad.W_ho += g.dot(H[t].T, dOX[t])
+            g.add_dot(grad.W_ho, H[t].T, dOX[t])
             if compute_grad2:
-                grad2.W_ho += g.dot((H[t]*H[t]).T, dOX[t]*dOX[t])
+                g.add_dot(grad2.W_ho, (H[t]*H[t]).T, dOX[t]*dOX[t])
 
             ## backpropagate the nonlinearity: at this point, dHX_t, the gradinet
             ## wrt the total inputs to H_t, is correct.
-            dHX_t = dH_t * self.hid_nonlin.grad_y(H[t])
+            if derivs is None:
+                dHX_t = dH_t * self.hid_nonlin.grad_y(H[t])
+            else:
+                dHX_t = dH_t * derivs[0][t]
 
             ## Add the structured reg at this point: That's good.
             if R_HX is not None:
@@ -261,47 +440,53 @@ class MRNN(object):
             B_t_f = (B[t] + self.f_bias)
             AB = A[t]*B_t_f
 
-            grad.W_fh += g.dot(AB.T, dHX_t)
-            grad.W_vh += g.dot(V[t].T, dHX_t)
+            g.add_dot(grad.W_fh, AB.T, dHX_t)
+            dHX[t] = dHX_t
             if compute_grad2:
                 _dHX2 = dHX_t*dHX_t
-                grad2.W_fh += g.dot((AB*AB).T, _dHX2)
-                grad2.W_vh += g.dot((V[t]*V[t]).T, _dHX2)
+                g.add_dot(grad2.W_fh, (AB*AB).T, _dHX2)
 
 
             ## do the intermediate backprop:
-            dAB = g.dot(dHX_t, self.W_fh.T)
+            dAB = dot_into(ws and ws.rows('dAB', batch_size, self.f), dHX_t, W_fh_T)
 
 
             dB = dAB*A[t]
 
             grad.f_bias += dB.sum(0)
-            dBB = dB * (1-B[t]*B[t])
-            grad.W_vf += g.dot(V[t].T, dBB)
+            if derivs is None:
+                dBB[t] = dB * (1-B[t]*B[t])
+            else:
+                dBB[t] = dB * derivs[1][t]
 
             dA = dAB * B_t_f
             Ht_minus_one = H[t-1][:dA.shape[0], :]
-            grad.W_hf += g.dot(Ht_minus_one.T, dA)
+            g.add_dot(grad.W_hf, Ht_minus_one.T, dA)
 
             if compute_grad2:
                 grad2.f_bias += (dB*dB).sum(0)
-                grad2.W_vf += g.dot((V[t]*V[t]).T, dBB*dBB)
-                grad2.W_hf += g.dot((Ht_minus_one*Ht_minus_one).T, dA*dA)
+                g.add_dot(grad2.W_hf, (Ht_minus_one*Ht_minus_one).T, dA*dA)
 
-            dH_1t = g.dot(dA, self.W_hf.T)
+            dH_1t = dot_into(ws and ws.rows('dH_1', batch_size, self.h), dA, W_hf_T)
             prev_batch_size = V[t].shape[0]
 
 
         grad.h_init += dH_1t.sum(0)
+        self.add_input_grad(grad.W_vh, V[1:], dHX[1:])
+        self.add_input_grad(grad.W_vf, V[1:], dBB[1:])
         if compute_grad2:
             grad2.h_init += (dH_1t*dH_1t).sum(0)
+            V2 = [V_t*V_t for V_t in V[1:]]
+            self.add_input_grad(grad2.W_vh, V2, [x*x for x in dHX[1:]])
+            self.add_input_grad(grad2.W_vf, V2, [x*x for x in dBB[1:]])
 
         return grad, grad2
 
     def loss(self, (V, O, M), mask=None):
         assert len(V) == len(O) == len(M)
 
-        (V, A, B, H, OX) = self.cur_state_from_loss = self.forward_pass(V, mask=mask)
+        (V, A, B, H, OX) = self.cur_state_from_loss = self.forward_pass(
+                V, mask=mask, workspace=self.workspace(V))
 
         loss = 0.
         for t in range(len(O)):
@@ -321,7 +506,8 @@ class MRNN(object):
 
     def grad(self, (V, O, M), loss=False, compute_grad2=False, mask=None):
 
-        state = self.forward_pass(V, mask=mask)
+        workspace = self.workspace(V)
+        state = self.forward_pass(V, mask=mask, workspace=workspace)
 
         OX = state[-1]
 
@@ -337,14 +523,42 @@ class MRNN(object):
             loss += self.out_nonlin.loss(OX[t], O[t], M[t])
 
 
-        grad, grad2 = self.backward_pass(state, dOX, compute_grad2 = compute_grad2)
+        grad, grad2 = self.backward_pass(state, dOX, compute_grad2 = compute_grad2,
+                                         workspace=workspace)
 
         return grad, grad2, loss
 
-    def get_accuracy(self, (V, O, M)):
-        state = self.forward_pass(V)
+    def evaluate(self, (V, O, M), compute_grad=False, compute_grad2=False,
+                 mask=None):
+        """
+        Returns loss, accuracy as get_accuracy, grad and grad2 of the
+        batch from one forward pass. grad and grad2 are None unless
+        asked for, the backward pass runs only then.
+        """
+        workspace = self.workspace(V)
+        state = self.forward_pass(V, mask=mask, workspace=workspace)
         OX = state[-1]
 
+        dOX = [None] * len(OX)
+        loss = 0.
+        for t in range(len(O)):
+            if compute_grad:
+                dOX[t] = self.out_nonlin.grad(OX[t], O[t], M[t])
+            loss += self.out_nonlin.loss(OX[t], O[t], M[t])
+        accuracy = self.accuracy(O, OX)
+
+        grad = grad2 = None
+        if compute_grad:
+            grad, grad2 = self.backward_pass(state, dOX,
+                                             compute_grad2=compute_grad2,
+                                             workspace=workspace)
+        return loss, accuracy, grad, grad2
+
+    def get_accuracy(self, (V, O, M)):
+        state = self.forward_pass(V, workspace=self.workspace(V))
+        return self.accuracy(O, state[-1])
+
+    def accuracy(self, O, OX):
         accuracy = []
         confusion = {}
         weights = []
@@ -367,21 +581,29 @@ class MRNN(object):
 
         return accuracy_for_each_ts, confusion, weights
 
-    def gauss_newton(self, data, R, state=None, mu=0., mask=None):
+    def gauss_newton(self, data, R, state=None, mu=0., mask=None,
+                     derivs=None):
+        # state and derivs (nonlin_derivs of state) may be kept by the
+        # caller for products with many R at the same parameters
         (V, O, M) = data
 
+        workspace = self.workspace(V)
         if state is None:
-            state = self.forward_pass(V, mask=mask)
+            state = self.forward_pass(V, mask=mask, workspace=workspace)
         (V, A, B, H, OX) = state
+        if derivs is None:
+            derivs = self.nonlin_derivs(state)
+        P = derivs[2]
 
-        (R_HX, R_OX) = R_state = self.R_forward_pass(state, R)
+        (R_HX, R_OX) = R_state = self.R_forward_pass(state, R, workspace,
+                                                     derivs)
 
         LJ = [None] * len(R_OX)
         for t in range(len(OX)):
-            P_t = self.out_nonlin(OX[t])
-            LJ[t] = self.out_nonlin.H_prod(R_OX[t], P_t, M[t])
+            LJ[t] = self.out_nonlin.H_prod(R_OX[t], P[t], M[t])
 
-        ans, ans2 = self.backward_pass(state, LJ, R_state, mu=mu)
+        ans, ans2 = self.backward_pass(state, LJ, R_state, mu=mu,
+                                       workspace=workspace, derivs=derivs)
         return ans
 
     def __repr__(self):
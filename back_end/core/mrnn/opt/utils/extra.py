@@ -1,27 +1,4 @@
 
-def random_subset_2(list, num):
-    if num>=len(list):
-        return list
-    else:
-        return random_subset(list, num)
-
-def random_subset(list, num):
-    from pylab import randint
-
-    assert num <= len(list)
-
-    remaining_inds = range(len(list))
-    inds = []
-    for n in range(num):
-        i = randint(len(remaining_inds))
-        actual_ind = remaining_inds[i]
-        del remaining_inds[i]
-
-        inds.append(actual_ind)
-
-    return [list[i] for i in inds]
-
-
 def random_pick(lst):
     import numpy as np
     return lst[np.random.randint(len(lst))]
@@ -1,5 +1,6 @@
 import os
 import ctypes
+import multiprocessing
 import numpy as np
 from numpy import random
 from math import ceil, floor
@@ -95,16 +96,103 @@ def to_gpu(x):
 
 
 def partition_batches(L, i, tot):
-    if len(L) == 1:
-        assert i == 0 and tot == 1
-        return L
+    """
+    Returns i-th of tot contiguous parts of L, sizes differ by one
+    at most.
+    """
+    assert 0 <= i < tot
+    size, extra = divmod(len(L), tot)
+    start = i * size + min(i, extra)
+    return L[start:start + size + (i < extra)]
+
+
+def batch_costs(data, batch_size, num_batches):
+    """
+    Returns estimated cost of batches of shared data of Generic3dData
+    (see ersatz_dp.DP._share), the number of their non-NaN timesteps.
+    """
+    if 'offsets' in data:
+        offsets = shmem_as_ndarray2(data['offsets'],
+                                    shape=(data['shape'][1] + 1, ))
+        lengths = np.diff(offsets)
+    else:
+        values = shmem_as_ndarray2(data['shmem'], shape=data['shape'])
+        lengths = (~np.isnan(values[:, :, 0])).sum(axis=0)
+    lengths = lengths.astype(np.float64)
+    return [lengths[b * batch_size:(b + 1) * batch_size].sum()
+            for b in range(num_batches)]
 
-    print "i=%d\ttot=%d\tlen(L)=%d" % (i, tot, len(L))
-    assert 0 <= i < tot and len(L) >= tot;
 
-    l = len(L) - 1
-    part_size = int(np.ceil(float(l)/float(tot)))
-    return L[i * part_size:(i + 1) * part_size + (i + 1 == tot) * part_size]
+class BatchQueue(object):
+    """
+    Batches of one command of HF manager, shared by its workers.
+
+    assign() hands batches out longest first, each to the worker with
+    the least work so far. Workers take their own batches with pop()
+    and then steal from the worker with most work left, so a worker
+    with underestimated batches doesn't stall the others. Lives in
+    shared memory, create it before forking workers.
+    """
+
+    def __init__(self, num_workers, size):
+        self.num_workers = num_workers
+        self.size = size
+        self.lock = multiprocessing.Lock()
+        self.batches = multiprocessing.RawArray('l', size)
+        self.costs = multiprocessing.RawArray('d', size)
+        # [start, stop) in batches of each worker
+        self.bounds = multiprocessing.RawArray('l', 2 * num_workers)
+
+    def assign(self, batches, costs):
+        """
+        Called by manager while workers are idle, returns batches
+        of each worker.
+        """
+        assert len(batches) <= self.size
+        loads = [0.] * self.num_workers
+        parts = [[] for i in range(self.num_workers)]
+        for index in sorted(range(len(batches)), key=lambda i: -costs[i]):
+            worker = loads.index(min(loads))
+            parts[worker].append(index)
+            loads[worker] += costs[index]
+        pos = 0
+        for worker, part in enumerate(parts):
+            self.bounds[2 * worker] = pos
+            for index in part:
+                self.batches[pos] = batches[index]
+                self.costs[pos] = costs[index]
+                pos += 1
+            self.bounds[2 * worker + 1] = pos
+        return [[batches[index] for index in part] for part in parts]
+
+    def _left(self, worker):
+        start, stop = self.bounds[2 * worker], self.bounds[2 * worker + 1]
+        return sum(self.costs[start:stop]), stop - start
+
+    def pop(self, worker, reverse=False):
+        """
+        Returns next batch of worker, None when all are taken. Own
+        batches are taken from the front (back with reverse), stolen
+        ones from the other end.
+        """
+        with self.lock:
+            if self.bounds[2 * worker] == self.bounds[2 * worker + 1]:
+                victim = max(range(self.num_workers), key=self._left)
+                if self.bounds[2 * victim] == self.bounds[2 * victim + 1]:
+                    return None
+                worker, reverse = victim, not reverse
+            if reverse:
+                self.bounds[2 * worker + 1] -= 1
+                return self.batches[self.bounds[2 * worker + 1]]
+            self.bounds[2 * worker] += 1
+            return self.batches[self.bounds[2 * worker] - 1]
+
+    def iterate(self, worker, reverse=False):
+        while True:
+            batch = self.pop(worker, reverse)
+            if batch is None:
+                return
+            yield batch
 
 
 def grab_gpu_boards():
@@ -112,6 +200,58 @@ def grab_gpu_boards():
     return [int(x) for x in boards.split(',')]
 
 
+# thread count setters of BLAS libraries by part of library file name
+_BLAS_THREAD_SETTERS = (
+    ('openblas', 'openblas_set_num_threads'),
+    ('mkl_rt', 'MKL_Set_Num_Threads'),
+)
+
+
+def loaded_blas_libraries():
+    """
+    Returns paths of BLAS libraries mapped into the process, numpy
+    and scipy may bring their own copies.
+    """
+    try:
+        with open('/proc/self/maps') as f:
+            paths = set(line.split()[-1] for line in f if '/' in line)
+    except IOError:
+        return []
+    return sorted(path for path in paths
+                  if any(name in os.path.basename(path)
+                         for name, _ in _BLAS_THREAD_SETTERS))
+
+
+def set_blas_threads(num_threads):
+    """
+    Sets number of threads of every loaded BLAS library, returns
+    number of libraries which were set.
+    """
+    done = 0
+    for path in loaded_blas_libraries():
+        lib = ctypes.CDLL(path)
+        for name, setter in _BLAS_THREAD_SETTERS:
+            if name in os.path.basename(path) and hasattr(lib, setter):
+                getattr(lib, setter)(ctypes.c_int(num_threads))
+                done += 1
+                break
+    return done
+
+
+def init_blas_threads(num_processes):
+    """
+    Splits cores between BLAS threads of num_processes processes
+    running on CPU, unless ERSATZ_BLAS_THREADS sets threads per process.
+    """
+    threads = os.environ.get('ERSATZ_BLAS_THREADS')
+    if threads:
+        threads = int(threads)
+    else:
+        threads = max(1, multiprocessing.cpu_count() // num_processes)
+    set_blas_threads(threads)
+    return threads
+
+
 def calculate_batch_size(dataset_size, max_batch_size, min_batches):
     """
     we need to select maximum possible batch size
@@ -3,16 +3,31 @@ from collections import defaultdict, Counter
 import numpy as np
 from . import gnumpy as g
 from .. import get_logger
+from ..conf import settings as global_settings
+from ..model_cache import ModelCache
+from ..profiler import get_profiler
 from .opt.utils import nonlin
 from .opt.d.generic import Generic3dData
 from .opt.m.rnn.mrnn import MRNN
-from .util import (shmem_as_ndarray, to_gpu, mcpu,
+from .util import (shmem_as_ndarray, to_gpu, cpu, mcpu, grab_gpu_boards,
+                   init_blas_threads,
                    to_masked_array_of_different_len as to_masked)
 
 
 log = get_logger('WORKER')
 
 
+def state_size(value):
+    """
+    Returns number of bytes held by garrays of nested lists and tuples.
+    """
+    if isinstance(value, (list, tuple)):
+        return sum(state_size(x) for x in value)
+    if isinstance(value, g.garray):
+        return value.size * g.itemsize()
+    return 0
+
+
 class BaseWorker(object):
 
     def __init__(self, worker_id, gpu_id, settings):
@@ -58,8 +73,11 @@ class BaseWorker(object):
         X = self.W.pack()
         print 'X size = ', X.size
 
-        self.gauss_newton_state = None
-        self.gauss_newton_old_bid = None
+        # forward states and nonlin_derivs of batches of the current
+        # parameters, kept during CG, keyed by (version, bid)
+        self.gauss_newton_cache = ModelCache(
+                global_settings.GAUSS_NEWTON_CACHE_SIZE)
+        self.gauss_newton_version = None
 
         self.init_damping = settings.init_damping
 
@@ -76,6 +94,10 @@ class BaseWorker(object):
         g._init_gpu()
         g.max_memory_usage = self.settings.worker_params['dp_data']['memory']
         log.info("Gnumpy max_memory_usage=%s" % (g.max_memory_usage,))
+        if g._useGpu == 'no':
+            # workers share cores of the node
+            threads = init_blas_threads(len(grab_gpu_boards()))
+            log.info('BLAS threads: %s' % threads)
         print 'worker %s, gpu_id %s: successfully imported gnumpy.' % (self.worker_id,
                                                                        self.gpu_id)
 
@@ -130,32 +152,96 @@ class BaseWorker(object):
         losses = np.array([full_loss, loss, bpc])
         return (grad, grad2, losses)
 
-    def gauss_newton(self, bid, batch=None, X=None, R=None,
-                     damping_factor=None, mask=None):
+    def evaluate(self, batch, X, mask, compute_grad):
+        """
+        Returns grad, grad2, losses and accuracy of the batch as
+        grad_grad2_losses, losses and get_accuracy from one forward
+        pass. grad and grad2 are None without compute_grad.
+        """
+        W_X = self.W.unpack(X)
+        loss, accuracy, grad, grad2 = W_X.evaluate(
+                batch, compute_grad=compute_grad, compute_grad2=compute_grad,
+                mask=mask)
+
+        full_loss = loss + self.L2_loss(X, batch)
+        if compute_grad:
+            grad2 = grad2.pack() + self.L2_curvature(X, batch)
+            grad = grad.pack() + self.L2_grad(X, batch)
+            bpc = full_loss/np.log(2)/self.dp.true_T
+        else:
+            bpc = loss/np.log(2)/self.dp.true_T
 
+        return grad, grad2, np.array([full_loss, loss, bpc]), accuracy
+
+    def gauss_newton(self, bid, batch=None, X=None, R=None,
+                     damping_factor=None, mask=None, version=None):
+        """
+        version identifies the parameters X, states of batches are
+        reused until it changes or until 'forget'.
+        """
         if bid == 'forget':
-            self.gauss_newton_state = None
+            self.gauss_newton_cache.clear()
             return
 
         W_X = self.W.unpack(X)
         W_R = self.W.unpack(R)
 
         # state caching:
-        if (bid != self.gauss_newton_old_bid) or (self.gauss_newton_state is None):
+        if version != self.gauss_newton_version:
+            self.gauss_newton_cache.clear()
+            self.gauss_newton_version = version
+        key = (version, bid)
+
+        def load():
+            # without a workspace, the state must outlive other passes
             I = batch[0]
             O = batch[1]
-            self.gauss_newton_state = W_X.forward_pass((I,O),mask=mask)
-            self.gauss_newton_old_bid = bid
+            state = W_X.forward_pass((I,O),mask=mask)
+            return state, W_X.nonlin_derivs(state)
+        state, derivs = self.gauss_newton_cache.get(key, load, state_size)
 
         mu = float(damping_factor[1])
-        ans = W_X.gauss_newton(batch, W_R, state=self.gauss_newton_state, mu=mu).pack()
+        ans = W_X.gauss_newton(batch, W_R, state=state, mu=mu,
+                               derivs=derivs).pack()
 
         return ans + self.L2_R(X,R, batch)
 
 
+def merge_accuracy(accuracies):
+    """
+    Merges (accuracy_for_each_ts, confusion, weights) of batches,
+    returns Nones when there are none.
+    """
+    if not accuracies:
+        # other workers took all batches
+        return None, None, None
+    if len(accuracies) == 1:
+        return accuracies[0]
+    tot_accuracy_for_each_ts, cms, tot_weights = zip(*accuracies)
+    tot_weights = to_masked(tot_weights)
+    tot_accuracy_for_each_ts = np.ma.average(to_masked(tot_accuracy_for_each_ts), axis=0, weights=tot_weights)
+    tot_accuracy_for_each_ts = np.array(tot_accuracy_for_each_ts)
+    tot_weights = np.array(tot_weights.sum(axis=0))
+    confusion = defaultdict(Counter)
+    for cm in cms:
+        for k, v in cm.iteritems():
+            confusion[k].update(v)
+    return tot_accuracy_for_each_ts, confusion, tot_weights
+
+
+def copy_to_shared(out, x):
+    # x is garray, or 0 when the worker got no batches
+    out[:] = x.asarray() if hasattr(x, 'asarray') else x
+
+
 class Worker(BaseWorker):
+    # commands which use the parameters
+    X_COMMANDS = ('grad', 'accuracy', 'losses', 'evaluate', 'cross_validate',
+                  'gauss_newton')
+
     def __init__(self, worker_id, gpu_id, settings, command_pipe, ans_pipe,
-                 X_size, X_shared, R_shared, GN_shared, total_batches,
+                 X_size, X_shared, R_shared, GN_shared, G2_shared,
+                 X_generation, batch_queue, total_batches,
                  total_batches_lock):
         # most essentially, the first time gnumpy is imported must be here,
         # on the new process.
@@ -168,9 +254,16 @@ class Worker(BaseWorker):
         self.total_batches = total_batches
         self.total_batches_lock = total_batches_lock
         # convert the shared mem vars into usable numpy arrays
-        self.np_X, self.np_R, self.np_MY_ANS = \
+        self.np_X, self.np_R, self.np_MY_ANS, self.np_MY_GRAD2 = \
                 [shmem_as_ndarray(x)[:X_size]
-                 for x in (X_shared, R_shared, GN_shared[worker_id])]
+                 for x in (X_shared, R_shared, GN_shared[worker_id],
+                           G2_shared[worker_id])]
+        # parameters on the gpu and their generation
+        self.X_generation = X_generation
+        self.X = None
+        self.X_cached_generation = None
+        # batches of commands sent without them
+        self.batch_queue = batch_queue
 
         # this little variable is used to speedup gauss_newton --- see below.
         self.gauss_newton_order = True
@@ -178,118 +271,181 @@ class Worker(BaseWorker):
         print 'worker %s: successfully accessed shared vars and is can now function.' % gpu_id
 
     def run(self):
+        # idle - waiting for commands of manager, ipc - moving
+        # parameters and answers between processes, compute - the rest
+        profiler = get_profiler()
         while True:
             # receive the command
-            cmd = self.command_pipe.recv()
+            with profiler.span('idle'):
+                cmd = self.command_pipe.recv()
             print "WORKER " + str(self.gpu_id) + " GOT CMD:", cmd[:1]
             if cmd[0] == 'gauss_newton':
                 message, batches, new_batch_map, damping, mask = cmd[:5]
             else:
                 message, batches, new_batch_map, mask = cmd[:4]
 
-            # we always receive a new batch map, unless its a gauss-newton request.
-            if message == 'grad' or message == 'losses':
-                assert new_batch_map is not None
-
-            if new_batch_map is not None:
-                self.batch_map = new_batch_map
-
-            # invariant: np_X always has the current value of the parameters.
-            # becasue np_X is shared memory. That np_X is up-to-date must be enforced
-            # by the manager.
-            X = to_gpu(self.np_X)
-
             if message == 'quit':
                 print 'WORKER ' + str(self.gpu_id) + ' QUIT'
                 self.ans_pipe.send(('quit', ))
                 break
 
-            if message == 'cycle_data':
-                self.dp.cycle_data()
-                self.ans_pipe.send(('cycle_data', ))
-
-            elif message == 'forget':
-                self.dp.forget()
-                super(Worker, self).gauss_newton('forget')
-                self.ans_pipe.send(('forget', ))
+            if message == 'profile':
+                self.ans_pipe.send(('profile', profiler.pop(),
+                                    profiler.take_events()))
+                continue
 
-            elif message == 'grad':
-                if mask:
-                    new_X = (X * g.tile(mask, (X.shape[0]/mask.shape[1],))).ravel()
-                else:
-                    new_X = X.ravel()
-                g_ans = mcpu(self.grad(batches, new_X, mask=mask))
-                self.ans_pipe.send(('grad', g_ans))
-
-            elif message == 'accuracy':
-                if mask:
-                    raise Exception('Dropout not implemented for accuracy calculations yet')
-                a_ans = mcpu(self.get_accuracy(batches, X))
-                self.ans_pipe.send(('accuracy', a_ans))
-
-            elif message == 'losses':
-                if mask:
-                    new_X = (X * g.tile(mask, (X.shape[0]/mask.shape[1],))).ravel()
-                else:
-                    new_X = X.ravel()
-                l_ans = mcpu(self.losses(batches, new_X, mask=mask))
-                self.ans_pipe.send(('losses', l_ans))
-
-            elif message == 'get_validation_data':
-                data = self.dp.validation_data
-                self.ans_pipe.send(('get_validation_data', data))
-
-            elif message == 'cross_validate':
-                # a note on l_ans here...
-                # it ends up being a list of tuples
-                # each tuple has: Hidden activations, Pre-softmax output
-
-                # new_X = (X * g.tile(mask, (X.shape[0]/mask.shape[1],))).ravel()
-                l_ans = mcpu(self.forward_pass(batches, X, validate=True, mask=mask))
-                self.ans_pipe.send(('cross_validate', l_ans))
-
-            elif message == 'gauss_newton':
-                self.gauss_newton_order = not self.gauss_newton_order
-                if self.gauss_newton_order:
-                    batches = batches[::-1]
-                # why do we have the order variable?
-                # It is sensible when len(batches) is small,
-                # say 2 or 3 (but is pointless when larger).
-                # If len(batches)==3, we'll get the batches
-                # in the order 1,2,3,3,2,1,1,2,3,3,2,1,
-                # and won't need to recompute the state
-                # at the 2nd occurrance of 3, and the second occurance of 1.
-                # If the state recomputation takes half
-                # of the gauss-newton function, then we're talking about
-                # 1/3 of the batches * 1/2 of the time = about 10% speedup.
-                # If we use 2 minibatches for the curvature,
-                # we'll be in 1,2,2,1,1,2,2,1, we'll be
-                # saving the computation in 1/2 of the batches,
-                # thus obtaining a 25% speedup. Which is decent.
-
-                R = to_gpu(self.np_R)
-                # we get the argument, R, through the shared variable.
-
-                # the damping is given in the third command
-                damping = cmd[3]
-
-                if mask:
-                    new_X = (X * g.tile(mask, (X.shape[0]/mask.shape[1],))).ravel()
-                else:
-                    new_X = X.ravel()
-                #try:
-                gn_ans, gn_tot = self.gauss_newton(batches, new_X, R, damping, mask)
-                #except:
-                #    ans_pipe.send(('quit_now', 'numerically_unstable'))
-
-                # copy the answer to the shared memory
-                self.np_MY_ANS[:] = gn_ans.asarray()
+            # we always receive a new batch map, unless its a gauss-newton request.
+            if message in ('grad', 'losses', 'evaluate'):
+                assert new_batch_map is not None
 
-                # and tell the manager that we are done, reporting the minibatch size.
-                self.ans_pipe.send(('gauss_newton', gn_tot))
+            if new_batch_map is not None:
+                self.batch_map = new_batch_map
 
+            with profiler.span('ipc'):
+                X = self.get_X() if message in self.X_COMMANDS else None
+
+            with profiler.span('compute'):
+                ans = self.execute(message, batches, X, mask, cmd)
+
+            with profiler.span('ipc'):
+                if message == 'gauss_newton':
+                    gn_ans, gn_tot = ans
+                    # copy the answer to the shared memory
+                    copy_to_shared(self.np_MY_ANS, gn_ans)
+                    # and tell the manager that we are done, reporting the minibatch size.
+                    self.ans_pipe.send(('gauss_newton', gn_tot))
+                elif message == 'grad':
+                    tot_grad, tot_grad2, tot_losses, tot = ans
+                    copy_to_shared(self.np_MY_ANS, tot_grad)
+                    copy_to_shared(self.np_MY_GRAD2, tot_grad2)
+                    self.ans_pipe.send(('grad', (cpu(tot_losses), tot)))
+                elif message == 'evaluate':
+                    tot_grad, tot_grad2, tot_losses, tot, accuracy = ans
+                    if tot_grad is not None:
+                        copy_to_shared(self.np_MY_ANS, tot_grad)
+                        copy_to_shared(self.np_MY_GRAD2, tot_grad2)
+                    self.ans_pipe.send(('evaluate',
+                                        (cpu(tot_losses), tot, accuracy)))
+                else:
+                    self.ans_pipe.send(ans)
+
+    def get_X(self):
+        """
+        Returns parameters on the gpu, copies them from the shared
+        memory only when the manager has written new ones.
+        """
+        # invariant: np_X always has the current value of the parameters.
+        # becasue np_X is shared memory. That np_X is up-to-date must be enforced
+        # by the manager, which bumps X_generation.
+        generation = self.X_generation.value
+        if generation != self.X_cached_generation:
+            self.X = to_gpu(self.np_X)
+            self.X_cached_generation = generation
+        return self.X
+
+    def execute(self, message, batches, X, mask, cmd):
+        """
+        Runs command of manager, returns the answer.
+        """
+        if batches is None and message in ('grad', 'accuracy', 'losses',
+                                           'evaluate'):
+            batches = self.batch_queue.iterate(self.worker_id)
+
+        if message == 'cycle_data':
+            self.dp.cycle_data()
+            return ('cycle_data', )
+
+        elif message == 'forget':
+            self.dp.forget()
+            super(Worker, self).gauss_newton('forget')
+            return ('forget', )
+
+        elif message == 'grad':
+            if mask:
+                new_X = (X * g.tile(mask, (X.shape[0]/mask.shape[1],))).ravel()
+            else:
+                new_X = X.ravel()
+            # sent by run() through the shared memory
+            return self.grad(batches, new_X, mask=mask)
+
+        elif message == 'accuracy':
+            if mask:
+                raise Exception('Dropout not implemented for accuracy calculations yet')
+            a_ans = mcpu(self.get_accuracy(batches, X))
+            return ('accuracy', a_ans)
+
+        elif message == 'losses':
+            if mask:
+                new_X = (X * g.tile(mask, (X.shape[0]/mask.shape[1],))).ravel()
             else:
-                raise TypeError('message (%s) is of an unrecognized kind.' % message)
+                new_X = X.ravel()
+            l_ans = mcpu(self.losses(batches, new_X, mask=mask))
+            return ('losses', l_ans)
+
+        elif message == 'evaluate':
+            # grad is sent by run() through the shared memory
+            compute_grad = cmd[4]
+            if mask:
+                raise Exception('Dropout not implemented for accuracy calculations yet')
+            return self.evaluate(batches, X.ravel(), compute_grad)
+
+        elif message == 'get_validation_data':
+            data = self.dp.validation_data
+            return ('get_validation_data', data)
+
+        elif message == 'cross_validate':
+            # a note on l_ans here...
+            # it ends up being a list of tuples
+            # each tuple has: Hidden activations, Pre-softmax output
+
+            # new_X = (X * g.tile(mask, (X.shape[0]/mask.shape[1],))).ravel()
+            l_ans = mcpu(self.forward_pass(batches, X, validate=True, mask=mask))
+            return ('cross_validate', l_ans)
+
+        elif message == 'gauss_newton':
+            self.gauss_newton_order = not self.gauss_newton_order
+            if batches is None:
+                # own batches of the batch queue, stolen ones come
+                # from the other end
+                batches = self.batch_queue.iterate(
+                        self.worker_id, reverse=self.gauss_newton_order)
+            elif self.gauss_newton_order:
+                batches = batches[::-1]
+            # why do we have the order variable?
+            # It is sensible when len(batches) is small,
+            # say 2 or 3 (but is pointless when larger).
+            # If len(batches)==3, we'll get the batches
+            # in the order 1,2,3,3,2,1,1,2,3,3,2,1,
+            # and won't need to recompute the state
+            # at the 2nd occurrance of 3, and the second occurance of 1.
+            # If the state recomputation takes half
+            # of the gauss-newton function, then we're talking about
+            # 1/3 of the batches * 1/2 of the time = about 10% speedup.
+            # If we use 2 minibatches for the curvature,
+            # we'll be in 1,2,2,1,1,2,2,1, we'll be
+            # saving the computation in 1/2 of the batches,
+            # thus obtaining a 25% speedup. Which is decent.
+
+            R = to_gpu(self.np_R)
+            # we get the argument, R, through the shared variable.
+
+            # the damping is given in the third command
+            damping = cmd[3]
+            # version of X, from the manager
+            version = cmd[5]
+
+            if mask:
+                new_X = (X * g.tile(mask, (X.shape[0]/mask.shape[1],))).ravel()
+            else:
+                new_X = X.ravel()
+            #try:
+            return self.gauss_newton(batches, new_X, R, damping, mask,
+                                     version)
+            #except:
+            #    ans_pipe.send(('quit_now', 'numerically_unstable'))
+
+        else:
+            raise TypeError('message (%s) is of an unrecognized kind.' % message)
 
     def inc_total_batches(self):
         with self.total_batches_lock:
@@ -319,32 +475,13 @@ class Worker(BaseWorker):
         return ans
 
     def get_accuracy(self, batches, X):
-        tot_accuracy_for_each_ts = []
-        cms = []
-        tot_weights = []
+        accuracies = []
         for bid in batches:
             batch = self.get_batch(bid)
-            accuracy_for_each_ts, confusion, weights = super(Worker, self).get_accuracy(batch, X)
-            cms.append(confusion)
-            tot_accuracy_for_each_ts.append(accuracy_for_each_ts)
-            tot_weights.append(weights)
+            accuracies.append(super(Worker, self).get_accuracy(batch, X))
 
         # below merges results for each batch before sending back to c3_par_c
-        if len(tot_accuracy_for_each_ts) > 1:
-            tot_weights = to_masked(tot_weights)
-            tot_accuracy_for_each_ts = np.ma.average(to_masked(tot_accuracy_for_each_ts), axis=0, weights=tot_weights)
-            #tot_accuracy_for_each_ts = to_masked(tot_accuracy_for_each_ts).mean(axis=0)
-            tot_accuracy_for_each_ts = np.array(tot_accuracy_for_each_ts)
-            tot_weights = np.array(tot_weights.sum(axis=0))
-            confusion = defaultdict(Counter)
-            for cm in cms:
-                for k, v in cm.iteritems():
-                    confusion[k].update(v)
-        else:
-            tot_accuracy_for_each_ts = tot_accuracy_for_each_ts[0]
-            tot_weights = tot_weights[0]
-
-        return tot_accuracy_for_each_ts, confusion, tot_weights
+        return merge_accuracy(accuracies)
 
     def grad(self, batches, X, mask):
         tot_grad, tot_losses, tot_grad2, tot = 0,0,0,0
@@ -359,6 +496,24 @@ class Worker(BaseWorker):
             tot_losses += losses
         return tot_grad, tot_grad2, tot_losses, tot
 
+    def evaluate(self, batches, X, compute_grad):
+        tot_grad, tot_grad2, tot_losses, tot = 0, 0, 0, 0
+        accuracies = []
+        for bid in batches:
+            batch = self.get_batch(bid)
+            grad, grad2, losses, accuracy = super(Worker, self).evaluate(
+                    batch, X, None, compute_grad)
+            tot += self.dp.size(batch)
+            if compute_grad:
+                tot_grad += grad
+                tot_grad2 += grad2
+            tot_losses += losses
+            accuracies.append(accuracy)
+        if not compute_grad:
+            tot_grad = tot_grad2 = None
+        accuracy = mcpu(merge_accuracy(accuracies))
+        return tot_grad, tot_grad2, tot_losses, tot, accuracy
+
     def losses(self, batches, X, mask):
         tot_losses, tot = 0., 0
         for bid in batches:
@@ -377,13 +532,14 @@ class Worker(BaseWorker):
             activations.append([[x.asarray() for x in H[:3]], (bid, [x.asarray() for x in OX])])
         return activations
 
-    def gauss_newton(self, batches, X, R, damping, mask):
+    def gauss_newton(self, batches, X, R, damping, mask, version):
         tot_gn, tot = 0, 0
         for bid in batches:
             batch = self.get_batch(bid)
             batch_size = self.dp.size(batch)
-            gn = super(Worker, self).gauss_newton(bid, batch, X, R,
-                                                  damping, mask=mask)
+            gn = super(Worker, self).gauss_newton(
+                    bid, batch, X, R, damping, mask=mask,
+                    version=version)
             tot_gn += gn
             tot += batch_size
         return tot_gn, tot
@@ -1,7 +1,6 @@
 #!/usr/bin/python
 import gc
 import os
-import json
 import math
 import uuid
 import subprocess
@@ -9,15 +8,19 @@ from collections import Counter
 import numpy as np
 from termcolor import colored
 from . import aws, get_logger, api
+from .checkpoint import load_modeldata
+from .model_cache import get_model_cache
 from .conf import settings
 from .mrnn import gnumpy as g
 from .mrnn.opt.utils import nonlin
 from .mrnn.opt.m.rnn.mrnn import MRNN
+from .mrnn.opt.m.rnn.ensemble import MRNNEnsemble, compatible_key
 from .mrnn.memory import get_max_gnumpy_memory
 from .data.dataset import get_dataset
 from .data.timeseries import Timeseries
 from .data import utils as data_utils
-from .mrnn.util import grab_gpu_boards
+from .data.ragged import RaggedSequences
+from .mrnn.util import grab_gpu_boards, init_blas_threads
 from .data import dataset as dataset_module
 from .shared.cifar import BatchWriter
 
@@ -29,19 +32,34 @@ class LoadModelException(Exception):
     pass
 
 
-def extend_with_nans(batches, shape_0=None):
-    size = shape_0 if shape_0 is not None else batches[0].shape[0]
-    for i in range(1, len(batches)):
-        delta = np.tile(np.nan, (size - batches[i].shape[0], batches[i].shape[1]))
-        batches[i] = np.vstack((batches[i], delta))
-    return np.array(batches)
-
-
 def remove_nans(data, is_argmax=True):
-    temp = []
-    for sample in data:
-        temp.append([t for t in sample if not np.isnan(t).all()])
-    return temp
+    """
+    Returns samples of (N, T, o) array without their NaN timesteps.
+    """
+    data = np.asarray(data)
+    mask = ~np.isnan(data).all(axis=2)
+    return np.split(data[mask], np.cumsum(mask.sum(axis=1))[:-1])
+
+
+def iterate_chunks(data, original_order, num_inputs, chunk_size):
+    """
+    Yields samples of (N, T, F) array or RaggedSequences in
+    original order, chunk_size samples at once, as (timesteps, order).
+    Timesteps are input rows of samples sorted from longest to
+    shortest, order puts results of the chunk to original order.
+    """
+    positions = np.argsort(original_order, kind='mergesort')
+    for start in xrange(0, len(positions), chunk_size):
+        # lazy datasets read increasing indexes
+        index = np.sort(positions[start:start + chunk_size])
+        if isinstance(data, RaggedSequences):
+            chunk = data.take(index)
+        else:
+            chunk = RaggedSequences.from_padded(np.asarray(data[index]))
+        by_length = chunk.length_order()
+        chunk = chunk.take(by_length)
+        order = np.argsort(original_order[index][by_length], kind='mergesort')
+        yield [x[:, :num_inputs] for x in chunk.timesteps()], order
 
 
 class Predictor(object):
@@ -53,7 +71,7 @@ class Predictor(object):
         self.quantiles = quantiles
         self.dataset = dataset
         self.input_data = []
-        self.models = [(m['iteration_id'], m['model_id'], self.load_model(**m))
+        self.models = [(m['iteration_id'], m['model_id'], self.get_model(m))
                 for m in predicts]
         self.init_gpu()
         gc.collect()
@@ -63,33 +81,61 @@ class Predictor(object):
         g.board_id_to_use = gpu_id
         g._init_gpu()
         g.max_memory_usage = get_max_gnumpy_memory()
+        if g._useGpu == 'no':
+            init_blas_threads(1)
 
     def sort_as_original(self, data):
-        return [x for (_, x) in sorted(zip(self.original_order, data))]
+        order = np.argsort(self.original_order[:len(data)], kind='mergesort')
+        if isinstance(data, np.ndarray):
+            return data[order]
+        return [data[i] for i in order]
+
+    def run_models(self, V=None):
+        """
+        Yields index in self.models, (T, N, o) outputs padded with NaN
+        and hidden states for every model, over V or self.input_data.
+        Models with the same inputs, outputs and nonlinearities run
+        together in one MRNNEnsemble.
+        """
+        if V is None:
+            V = self.input_data
+        groups = {}
+        for index, (_, _, W) in enumerate(self.models):
+            groups.setdefault(compatible_key(W), []).append(index)
+        for indexes in sorted(groups.values()):
+            ensemble = MRNNEnsemble([self.models[i][2] for i in indexes])
+            print '==========', ', '.join(self.models[i][2].model_name
+                                          for i in indexes), '=========='
+            H, Y = ensemble.forward_pass(V)
+            outputs = ensemble.outputs(Y)
+            for k, index in enumerate(indexes):
+                yield index, outputs[k], ensemble.hidden(H, k)
 
     def predict(self, input_data):
-        pre_list = []
-        predicts_results = []
+        predicts_results = [None] * len(self.models)
         self._load_data(input_data)
 
-        for (iteration_id, model_id, W) in self.models:
-            print '==========', W.model_name, '=========='
-
-            sig = W.out_nonlin
-            H, results = W.forward_pass(self.input_data)[-2:]
-            results = extend_with_nans([sig(x).as_numpy_array() for x in results])
+        # running sum of outputs
+        total = None
+        for index, results, H in self.run_models():
+            iteration_id = self.models[index][0]
+            if total is None:
+                total = results.copy()
+            else:
+                total += results
             results = data_utils.to_normal_shape(results)
             results = self.sort_as_original(results)
-            H = self.sort_as_original(H[1:])
-            pre_list.append(results)
+            H = self.sort_as_original(H)
             results = remove_nans(results)
-            predicts_results.append({
+            predicts_results[index] = {
                 'iteration': iteration_id,
                 'output': results,
                 'hidden_activations': H
-            })
+            }
 
-        avg_pre = np.array(pre_list).mean(axis=0)
+        avg_pre = total / len(self.models)
+        avg_pre = data_utils.to_normal_shape(avg_pre)
+        avg_pre = self.sort_as_original(avg_pre)
         avg_pre = remove_nans(avg_pre)
         print 'Pre Activation Avg. Result: ', avg_pre
         print 'Results', predicts_results
@@ -98,9 +144,8 @@ class Predictor(object):
                 'predictions': predicts_results,
                }
 
-    def load_mrnn(self, model_id, data, out_nonlin):
-        NN_np1 = json.loads(data)
-        X_np1 = np.array(NN_np1['X'])
+    def load_mrnn(self, model_id, NN_np1, out_nonlin):
+        X_np1 = np.asarray(NN_np1['X'])
         h1 = NN_np1['h']
         f1 = NN_np1['f']
         v1 = NN_np1['v']
@@ -113,9 +158,15 @@ class Predictor(object):
         W.model_name = 'MODEL %s' % model_id
         return W
 
+    def get_model(self, predict):
+        key = (predict['model_name'], predict['s3_data'],
+               predict['out_nonlin'])
+        return get_model_cache().get(key, lambda: self.load_model(**predict))
+
     def load_model(self, model_id, model_name, s3_data, out_nonlin, **kwargs):
-        data = aws.get_data(s3_data)
         if model_name == 'MRNN':
+            # binary weights are memory-mapped from s3 cache
+            data = load_modeldata(s3_data)
             return self.load_mrnn(model_id, data, out_nonlin)
         raise LoadModelException("Unavailable model name %s for model id %s" %
                 (model_name, model_id))
@@ -141,18 +192,13 @@ class RunEnsemblePredictor(Predictor):
                  dataset, options, data_split=None, **kwargs):
         self.ensemble = ensemble
         self.queue_key = queue_key
-        self.input_data = []
         self.input_only = kwargs.get('INPUT_ONLY', False)
         dataset = get_dataset(dataset)
-        data, len_output, self.original_order = dataset.get_predict_data()
-        if len_output:
-            data, self.output_data = data[:,:,:-len_output], data[:,:,-len_output:]
-        else:
-            self.output_data = None
-        self.to_gnumpy(data)
-        self.models = [(m['iteration_id'], m['model_id'], self.load_model(**m))
+        # samples are read by chunks in run_ensemble
+        self.data, len_output, self.original_order = dataset.get_samples()
+        self.num_inputs = self.data.shape[2] - len_output
+        self.models = [(m['iteration_id'], m['model_id'], self.get_model(m))
                 for m in predicts]
-        del data
         self.init_gpu()
         gc.collect()
 
@@ -177,46 +223,57 @@ class RunEnsemblePredictor(Predictor):
         return '\n'.join(';'.join(','.join(str(x) for x in timestep)
                                   for timestep in sample) for sample in data)
 
-    def run_ensemble(self):
-        pre_list = []
-        iteration_ids = []
-        models_ids = []
-        for (iteration_id, model_id, W) in self.models:
-            print '==========', W.model_name, '=========='
-
-            sig = W.out_nonlin
-            results = W.forward_pass(self.input_data)[4]
-
-            pre_activation_results = extend_with_nans([sig(x).as_numpy_array()
-                                                       for x in results])
-            pre_list.append(pre_activation_results)
-            iteration_ids.append(iteration_id)
-            models_ids.append(model_id)
+    def write_results(self, f, results, order, first):
+        """
+        Writes (T, N, o) results of a chunk to f in original order.
+        """
+        results = data_utils.to_normal_shape(results)[order]
+        if not first:
+            f.write('\n')
+        f.write(self.to_str(remove_nans(results)))
 
-        avg_pre = np.array(pre_list).mean(axis=0)
-        #if self.input_only:
-        predicted_results = []
-        for iteration_id, model_id, results in zip(iteration_ids, models_ids, pre_list):
-            results = data_utils.to_normal_shape(results)
-            results = self.sort_as_original(results)
-            results = remove_nans(results)
-            results = self.to_str(results)
-            s3_key = '/download/predict/result/%s/ensemble-%s-iteration-%s.ts.gz'
-            s3_key = s3_key % (uuid.uuid4(), self.ensemble, iteration_id)
-            results = aws.save_as_s3_file(results, s3_key)
-            predicted_results.append({
-                'iteration': iteration_id,
-                'output': results
-            })
-        avg = data_utils.to_normal_shape(avg_pre)
-        avg = self.sort_as_original(avg)
-        avg = remove_nans(avg)
+    def run_ensemble(self):
+        """
+        Runs models over the dataset by chunks of PREDICT_CHUNK_SIZE
+        samples, outputs of every model and their average are written
+        to gzip files as they are computed and uploaded at the end.
+        """
+        iteration_ids = [iteration_id for iteration_id, _, _ in self.models]
+        s3_key = '/download/predict/result/%s/ensemble-%s-iteration-%s.ts.gz'
+        outputs = [aws.GzipUpload(s3_key % (uuid.uuid4(), self.ensemble,
+                                            iteration_id))
+                   for iteration_id in iteration_ids]
         s3_key = '/download/predict/result/%s/avg-ensemble-%s-iterations-%s.ts.gz'
         s3_key = s3_key % (uuid.uuid4(), self.ensemble,
                            '-'.join(str(x) for x in iteration_ids))
-        avg = self.to_str(avg)
-        avg = aws.save_as_s3_file(avg, s3_key)
-        return {'predictions': predicted_results, 'ensemble_prediction': avg}
+        avg = aws.GzipUpload(s3_key)
+        chunks = iterate_chunks(self.data, self.original_order,
+                                self.num_inputs, settings.PREDICT_CHUNK_SIZE)
+        try:
+            for i, (timesteps, order) in enumerate(chunks):
+                V = [g.garray(x) for x in timesteps]
+                # running sum of outputs
+                total = None
+                for index, results, _ in self.run_models(V):
+                    if total is None:
+                        total = results.copy()
+                    else:
+                        total += results
+                    self.write_results(outputs[index], results, order, i == 0)
+                total /= len(self.models)
+                self.write_results(avg, total, order, i == 0)
+                del V
+                g.free_reuse_cache()
+            keys = [f.close() for f in outputs + [avg]]
+        finally:
+            # local files of failed prediction
+            for f in outputs + [avg]:
+                f.abort()
+        predicted_results = [{'iteration': iteration_id, 'output': key}
+                             for iteration_id, key in zip(iteration_ids, keys)]
+        #if self.input_only:
+        return {'predictions': predicted_results,
+                'ensemble_prediction': keys[-1]}
         #else:
             ## for mask we selecting mean for reducing dim like argmax reduce
             ## but with mean we don't loose nan
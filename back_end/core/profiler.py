@@ -0,0 +1,156 @@
+"""
+Timing spans for hot paths of training.
+
+    with get_profiler().span('grad'):
+        ...
+
+Spans are summed by name until pop(), nested spans are counted in
+both names. With trace on, every span is kept as chrome trace event,
+see write_trace(). Disabled profiler hands out one shared no-op span.
+"""
+import os
+import json
+import time
+import ctypes
+import ctypes.util
+import threading
+from .conf import settings
+
+
+def _get_clock():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    for name in ('c', 'rt'):
+        path = ctypes.util.find_library(name)
+        try:
+            clock_gettime = ctypes.CDLL(path).clock_gettime
+            break
+        except (OSError, AttributeError):
+            continue
+    else:
+        return time.time
+    CLOCK_MONOTONIC = 1
+    byref = ctypes.byref
+
+    def monotonic():
+        ts = timespec()
+        clock_gettime(CLOCK_MONOTONIC, byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+
+# seconds, system wide, so spans of worker processes line up
+monotonic = _get_clock()
+
+
+class Span(object):
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, self.start, monotonic())
+
+
+class NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Profiler(object):
+
+    def __init__(self, enabled=True, trace=False):
+        self.enabled = enabled
+        self.trace = trace
+        self.lock = threading.Lock()
+        # name -> [seconds, count]
+        self.totals = {}
+        # (name, start, end, pid, tid)
+        self.events = []
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def add(self, name, start, end):
+        with self.lock:
+            total = self.totals.get(name)
+            if total is None:
+                self.totals[name] = [end - start, 1]
+            else:
+                total[0] += end - start
+                total[1] += 1
+            if self.trace:
+                self.events.append((name, start, end, os.getpid(),
+                                    threading.current_thread().ident))
+
+    def pop(self):
+        """
+        Returns {name: {'time': seconds, 'count': spans}} recorded
+        since the last call.
+        """
+        with self.lock:
+            totals, self.totals = self.totals, {}
+        return dict((name, {'time': seconds, 'count': count})
+                    for name, (seconds, count) in totals.iteritems())
+
+    def take_events(self):
+        with self.lock:
+            events, self.events = self.events, []
+        return events
+
+    def add_events(self, events):
+        """
+        Adds trace events of other process.
+        """
+        if self.trace:
+            with self.lock:
+                self.events.extend(events)
+
+    def write_trace(self, filename):
+        """
+        Writes recorded events as chrome trace event json, open it in
+        chrome://tracing.
+        """
+        events = [{'name': name, 'ph': 'X', 'ts': start * 1e6,
+                   'dur': (end - start) * 1e6, 'pid': pid, 'tid': tid}
+                  for name, start, end, pid, tid in self.take_events()]
+        if not os.path.isdir(os.path.dirname(filename) or '.'):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+_profiler = {}
+
+
+def get_profiler():
+    """
+    Returns Profiler of this process.
+    """
+    pid = os.getpid()
+    if _profiler.get('pid') != pid:
+        _profiler['profiler'] = Profiler(
+                settings.PROFILE_TRAINING,
+                trace=bool(settings.PROFILE_TRACE_DIR))
+        _profiler['pid'] = pid
+    return _profiler['profiler']
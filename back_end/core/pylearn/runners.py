@@ -1,8 +1,6 @@
 import os
 import re
-import StringIO
 import uuid
-import gzip
 import json
 import cPickle
 import traceback
@@ -19,6 +17,7 @@ from .trainers import (MaxOutTrainer, AutoEncoderTrainer, SigmoidTrainer,
 from ..runners import BaseTrainRunner, BasePredictRunner
 from .. import aws
 from ..aws import S3Key
+from ..model_cache import get_model_cache
 from ..exception import DataFileError
 from ..conf import settings
 from .. import spearmint_wrapper as swrap
@@ -27,6 +26,10 @@ from .. import hyperparams as hp
 from theano import function
 
 
+# rows of predictions formatted at once by _save_as_s3_file
+SAVE_ROWS = 4096
+
+
 # TODO: fix pylearn2 crash with unicode params
 def u_to_str(value):
     if isinstance(value, unicode):
@@ -267,10 +270,27 @@ class PylearnBasePredictRunner(BasePredictRunner):
     def _save_as_s3_file(self, rval, s3_key):
         raise NotImplementedError()
 
-    def _fetch_model(self, predict):
+    def _load_model(self, predict):
         with S3Key(predict['s3_data']).get_file() as data:
             model = cPickle.load(data)['model']
-        return model
+        return {'model': model, 'functions': {}}
+
+    def _cached_model(self, predict):
+        return get_model_cache().get(('pylearn', predict['s3_data']),
+                                     lambda: self._load_model(predict))
+
+    def _fetch_model(self, predict):
+        return self._cached_model(predict)['model']
+
+    def _get_function(self, predict, name, build):
+        """
+        Returns compiled theano function of the model, build(model)
+        is called only once per cached model.
+        """
+        entry = self._cached_model(predict)
+        if name not in entry['functions']:
+            entry['functions'][name] = build(entry['model'])
+        return entry['functions'][name]
 
 class PylearnMLPPredictRunner(PylearnBasePredictRunner):
     def get_output_len(self, dataset_params):
@@ -284,7 +304,8 @@ class PylearnMLPPredictRunner(PylearnBasePredictRunner):
         output_len = self.get_output_len(self.api_message['dataset'])
         predicted_results = []
 
-        average = []
+        # running sum of probabilities of models
+        average = None
         for predict in self._predicts:
             model = self._fetch_model(predict)
             model.set_batch_size(128)
@@ -305,36 +326,33 @@ class PylearnMLPPredictRunner(PylearnBasePredictRunner):
             batches = dataset.iterator(mode='sequential',
                                        batch_size=128,
                                        data_specs=data_specs)
-            Xb = model.get_input_space().make_batch_theano()
-            Xb.name = 'Xb'
-            ymf = model.fprop(Xb)
-            ymf.name = 'ymf'
-            f1 = function([Xb], [ymf])                
+            f1 = self._get_function(predict, 'fprop', self._build_fprop)
 
-            rval = rval_avg = None
+            rval, rval_avg = [], []
             for batch in batches:
                 probs = self._run_function(f1, batch)[0]
                 if predict['out_nonlin'] == 'LINEARGAUSSIAN':
                     result = np.around(probs.astype(np.double), 5)
                 else:
                     result = probs.argmax(axis=1)
+                rval.append(result)
+                rval_avg.append(probs)
 
-                if rval is None:
-                    rval = result
-                    rval_avg = probs
-                else:
-                    rval = np.hstack((rval, result))
-                    rval_avg = np.vstack((rval_avg, probs))
-
-            average.append(rval_avg)
-            rval = self._translate_predictions(rval, error_lines=error_lines)
+            # rows of all batches, concatenated once
+            rval_avg = np.concatenate(rval_avg)
+            if average is None:
+                average = rval_avg.astype(np.double)
+            else:
+                average += rval_avg
+            rval = self._translate_predictions(np.concatenate(rval),
+                                               error_lines=error_lines)
 
             predicted_results.append({
                 'iteration': predict['iteration_id'],
                 'output': rval,
                 'probs': np.around(probs.astype(np.double), 3)
             })
-        average = np.array(average).mean(axis=0)
+        average /= len(self._predicts)
         if self.api_message['predicts'][0]['out_nonlin'] == 'LINEARGAUSSIAN':
             average = np.around(average.astype(np.double), 5)
         else:
@@ -344,13 +362,20 @@ class PylearnMLPPredictRunner(PylearnBasePredictRunner):
 
         return predicted_results, average
 
+    def _build_fprop(self, model):
+        Xb = model.get_input_space().make_batch_theano()
+        Xb.name = 'Xb'
+        ymf = model.fprop(Xb)
+        ymf.name = 'ymf'
+        return function([Xb], [ymf])
+
     def _save_as_s3_file(self, rval, s3_key):
-        rval = '\n'.join((str(x) for x in rval))
-        gz = StringIO.StringIO()
-        f = gzip.GzipFile(fileobj=gz, mode='w')
-        f.write(rval)
-        f.close()
-        aws.save_modeldata_to_filename(s3_key, gz.getvalue())
+        with aws.GzipUpload(s3_key) as f:
+            for start in xrange(0, len(rval), SAVE_ROWS):
+                if start:
+                    f.write('\n')
+                f.write('\n'.join(str(x) for x in
+                                  rval[start:start + SAVE_ROWS]))
         return s3_key
 
     def get_output_len(self, dataset_params):
@@ -390,19 +415,10 @@ class PylearnAutoencoderPredictRunner(PylearnBasePredictRunner):
                                        batch_size=128,
                                        data_specs=data_specs)
 
-            X = model.get_input_space().make_batch_theano()
-            X.name = 'X'
-            y = model.encode(X)
-            y.name = 'y'
-            f1 = function([X], [y])
+            f1 = self._get_function(predict, 'encode', self._build_encode)
 
-            val = None
-            for batch in batches:
-                results = self._run_function(f1, batch)[0]
-                if val is None:
-                    val = results
-                else:
-                    val = np.vstack((val, results))
+            val = np.concatenate([self._run_function(f1, batch)[0]
+                                  for batch in batches])
 
             predicted_results.append({
                 'iteration': predict['iteration_id'],
@@ -411,11 +427,15 @@ class PylearnAutoencoderPredictRunner(PylearnBasePredictRunner):
 
         return predicted_results, None
 
+    def _build_encode(self, model):
+        X = model.get_input_space().make_batch_theano()
+        X.name = 'X'
+        y = model.encode(X)
+        y.name = 'y'
+        return function([X], [y])
+
     def _save_as_s3_file(self, rval, s3_key):
-        gz = StringIO.StringIO()
-        f = gzip.GzipFile(fileobj=gz, mode='w')
-        np.savetxt(f, rval, delimiter=",", fmt="%.5f")
-        f.close()
-        aws.save_modeldata_to_filename(s3_key, gz.getvalue())
+        with aws.GzipUpload(s3_key) as f:
+            np.savetxt(f, rval, delimiter=",", fmt="%.5f")
         return s3_key
 
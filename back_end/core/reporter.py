@@ -1,50 +1,83 @@
 import json
 import threading
 import time
-import requests
+from collections import deque
 
+from . import api, get_logger
+from .conf import settings
 from .rabbit import get_connection
-from . conf import settings
-from . misc import NPArrayEncoder
 
 
-class LogsBufferWatcher(threading.Thread):
-    """ Watcher's passed pipe's buffer age and then flushes once it's mature. """
+log = get_logger('ersatz.reporter')
 
-    def __init__(self, logs_pipe, buffer_age):
-        super(LogsBufferWatcher, self).__init__()
-        self.logs_pipe = logs_pipe
-        self.buffer_age = buffer_age
-        self.is_stop = threading.Event()
-
-    def stop(self):
-        self.is_stop.set()
 
-    def stopped(self):
-        return self.is_stop.isSet()
+class RingBuffer(object):
+    """
+    Bounded buffer of written strings, keeps the newest max_size bytes.
+    Not thread safe, RabbitPipe guards it with its lock.
+    """
 
-    def run(self):
-        while not self.stopped():
-            self.logs_pipe.flush()
-            time.sleep(self.buffer_age)
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.chunks = deque()
+        self.size = 0
+        # bytes dropped from full buffer, bytes cut off too long writes
+        self.dropped = 0
+        self.truncated = 0
+
+    def __len__(self):
+        return self.size
+
+    def write(self, data):
+        if len(data) > self.max_size:
+            self.truncated += len(data) - self.max_size
+            data = data[len(data) - self.max_size:]
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size > self.max_size:
+            excess = self.size - self.max_size
+            first = self.chunks[0]
+            if len(first) <= excess:
+                self.chunks.popleft()
+                excess = len(first)
+            else:
+                self.chunks[0] = first[excess:]
+            self.size -= excess
+            self.dropped += excess
+
+    def take(self):
+        """
+        Returns written chunks and empties the buffer.
+        """
+        chunks, self.chunks = list(self.chunks), deque()
+        self.size = 0
+        return chunks
 
 
 class RabbitPipe(object):
     """
     Callable that broadcasts data to specified
     queue, exchange and channel number.
+
+    Written data is kept in RingBuffer and published by a thread which
+    owns the channel, pika channels are not thread safe. With buffer_age
+    > 0 data written for buffer_age seconds goes as one message, with 0
+    every write is a message, with -1 data is published by flush() only.
+    Every message is published once, if any of publish_conditions is
+    false for it, it's skipped. Bytes lost in the full buffer are counted
+    in metrics().
     """
 
     def __init__(self, rabbit_conn, exchange_name, queue_name=None,
         exchange_type='fanout', routing_key='', channel_number=None,
         buffer_age=0, pre_hooks=[], post_hooks=[], publish_conditions=[],
-        donotflush=False):
+        max_buffer=None):
 
-        self.buffer = []
+        self.buffer = RingBuffer(max_buffer or settings.LOGS_BUFFER_SIZE)
+        self.cond = threading.Condition()
         self.publish_conditions = publish_conditions
         self.pre_hooks = pre_hooks
         self.post_hooks = post_hooks
-        self.buffer_lock = threading.Lock()
         self.buffer_age = buffer_age
         self.queue_name = queue_name
         self.exchange_name = exchange_name
@@ -53,7 +86,6 @@ class RabbitPipe(object):
         self.channel = rabbit_conn.channel(channel_number=channel_number)
         self.channel.exchange_declare(exchange=self.exchange_name,
                                       exchange_type=self.exchange_type)
-        self.donotflush = donotflush
 
         # only create queue and bind to exchange if queue_name is present
         if self.queue_name:
@@ -62,66 +94,123 @@ class RabbitPipe(object):
                                     routing_key=self.routing_key,
                                     queue=self.queue_name)
 
-        # if buffered, create watcher
-        self.buffer_watcher = None
-        if self.buffer_age > 0:
-            self.buffer_watcher = LogsBufferWatcher(self, self.buffer_age)
-            self.buffer_watcher.start()
+        self.written = 0
+        self.published = 0
+        self.messages = 0
+        self.flush_requested = 0
+        self.flushed = 0
+        self.closed = False
+        # from now on the channel is used by publisher thread only
+        self.publisher = threading.Thread(target=self._run,
+                                          name='rabbit-pipe')
+        self.publisher.daemon = True
+        self.publisher.start()
+
+    @property
+    def buffer_age(self):
+        return self._buffer_age
+
+    @buffer_age.setter
+    def buffer_age(self, buffer_age):
+        # publisher may wait without timeout for the old buffer_age
+        with self.cond:
+            self._buffer_age = buffer_age
+            self.cond.notify_all()
 
     def __call__(self, data):
-        """ Whenever the instance is called, buffer or broadcast data. """
-
-        if not self._must_buffer() and self._can_publish():
-            self.flush(data)
-        else:
-            self.buffer_lock.acquire()
-            self.buffer.append(data)
-            self.buffer_lock.release()
-
-    def _must_buffer(self):
-        """Only buffer if there's indefinite buffer (-1) or aging buffer w/ a watcher
+        """ Whenever the instance is called, buffer data for publisher. """
+        with self.cond:
+            self.buffer.write(data)
+            self.written += len(data)
+            if self.buffer_age == 0:
+                self.cond.notify_all()
+
+    def _wait(self):
         """
-        return self.buffer_age == -1 or (self.buffer_watcher and self.buffer_age > 0)
-
-    def _can_publish(self):
-        """Check non-timing related conditions that must be true before the buffer
-        can be flushed and published.
+        Waits until buffered data must be published, returns it with
+        number of the last flush request it satisfies.
         """
-        if self.publish_conditions:
-            return all(cond(self.buffer) for cond in self.publish_conditions)
-        else:
-            return True
+        with self.cond:
+            start_time = time.time()
+            while not self.closed and self.flushed == self.flush_requested:
+                if self.buffer_age == 0:
+                    if len(self.buffer):
+                        break
+                    self.cond.wait()
+                elif self.buffer_age > 0:
+                    remaining = start_time + self.buffer_age - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                else:
+                    self.cond.wait()
+            return self.buffer.take(), self.flush_requested, self.closed
+
+    def _run(self):
+        while True:
+            chunks, flush_requested, closed = self._wait()
+            try:
+                if self.buffer_age == 0:
+                    for data in chunks:
+                        self._publish(data)
+                elif chunks:
+                    self._publish(''.join(chunks))
+            except Exception:
+                log.exception('Publishing to %s failed.' % self.exchange_name)
+            with self.cond:
+                self.flushed = flush_requested
+                self.cond.notify_all()
+            if closed:
+                return
+
+    def flush(self):
+        """ Publishes buffered data, returns when it's published. """
+        with self.cond:
+            if self.closed:
+                return
+            self.flush_requested += 1
+            flush_requested = self.flush_requested
+            self.cond.notify_all()
+            while (self.flushed < flush_requested and
+                   self.publisher.is_alive()):
+                self.cond.wait(1)
 
     def close(self):
-        if self.buffer_watcher:
-            self.buffer_watcher.stop()
-            self.buffer_watcher.join()
-
-    def flush(self, last_data=None):
-        if last_data:
-            self.buffer.append(last_data)
-        if not self.buffer:
-            return
-
-        size = len(self.buffer)
-        data = ''.join(self.buffer[0:size])
-        self._publish(data)
-
-        # then slice the published data
-        if not self.donotflush:
-            self.buffer_lock.acquire()
-            self.buffer = self.buffer[size:]
-            self.buffer_lock.release()
-
-        #TODO refactor this to prevent the unnecessary buffer slice for null
-        #     initial buffer ^^^
-        # BUT: the line `if not self.buffer:` will catch falsy buffer ^^^
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.publisher.join()
+        metrics = self.metrics()
+        if metrics['dropped'] or metrics['truncated']:
+            log.warning('%s: %d bytes dropped from full buffer, '
+                        '%d bytes truncated.' % (self.exchange_name,
+                                                 metrics['dropped'],
+                                                 metrics['truncated']))
+
+    def metrics(self):
+        """
+        Returns counters of written, published and lost bytes.
+        """
+        with self.cond:
+            return {'written': self.written,
+                    'published': self.published,
+                    'messages': self.messages,
+                    'buffered': len(self.buffer),
+                    'dropped': self.buffer.dropped,
+                    'truncated': self.buffer.truncated}
 
     def _publish(self, data):
+        if not all(cond(data) for cond in self.publish_conditions):
+            return
         pre_data = reduce(lambda a, func: func(a), self.pre_hooks, data)
         self.channel.basic_publish(exchange=self.exchange_name,
                                    routing_key=self.routing_key,
                                    body=pre_data)
+        with self.cond:
+            self.published += len(data)
+            self.messages += 1
         reduce(lambda a, func: func(a), self.post_hooks, data)
 
 
@@ -155,10 +244,8 @@ def logs_saver(model_id):
             'model': model_id,
             'data': data,
             'is_new': logs_saver.is_new,
-            'worker_key': settings.WORKER_KEY
         }
-        url = '%s/api/logs/' % settings.API_SERVER
-        requests.post(url, json.dumps(payload, cls=NPArrayEncoder))
+        api.post('/api/logs/', payload)
         logs_saver.is_new = False
     return _saver
 
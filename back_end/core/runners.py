@@ -13,9 +13,11 @@ from .exception import BaseErsatzError
 from .predictors import Predictor, RunEnsemblePredictor
 from . misc import NPArrayEncoder
 from .reporter import (RabbitReporterMixin, RabbitPipe, logs_transformer,
-                       logs_saver, build_train_pipe, LogsBufferWatcher)
+                       logs_saver, build_train_pipe)
 from .rabbit import get_connection
 from .misc import Tee
+from .checkpoint import CheckpointUploader
+from .model_cache import get_model_cache
 
 
 log = get_logger('ersatz.runner')
@@ -50,6 +52,7 @@ class BasePredictRunner(object):
             self.report_error()
         else:
             self.report_result(result)
+        log.info('Model cache: %s' % get_model_cache().stats())
 
     def _predict_models(self):
         raise NotImplementedError
@@ -105,6 +108,7 @@ class BaseTrainRunner(RabbitReporterMixin):
         self.initialize_train_pipe()
         self.initialize_stats_reporter()
         self.mount_pipes()
+        self.checkpoints = CheckpointUploader()
 
         try:
             self.ensemble = api_message['ensemble']
@@ -136,6 +140,7 @@ class BaseTrainRunner(RabbitReporterMixin):
             self.report_error()
 
         # cleanup
+        self.checkpoints.flush(check=False)
         sys.stdout.close()
         sys.stderr.close()
         self.train_pipe.close()  # close logs pipe
@@ -177,9 +182,12 @@ class BaseTrainRunner(RabbitReporterMixin):
         if not api.post('/api/train/status/', api_params):
             log.warn("Can't set model status to TRAIN (api response not 200)")
             raise ApiStoppedTraining
+        # reports of this model before its first upload have resume key
+        self.checkpoints.reset(self.model.get('resume_X'))
         self.training_start_time = time.time()
 
     def report_finish_training(self):
+        self.checkpoints.flush()
         api_params = {'model': self.model['id'], 'state': 'FINISHED',
                       'model_name': self.model['name'],
                       'queue_key': self.queue_key,
@@ -206,40 +214,49 @@ class BaseTrainRunner(RabbitReporterMixin):
         return
 
     def report_stats(self, modeldata, stats, upload_modeldata=True):
+        """
+        Queues model data upload and stats report, they are sent by
+        background thread, errors are raised by the next call.
+        """
         log.info('Reporting stats.')
-        if upload_modeldata:
+        model = self.model
+        stats['time'] = time.time() - self.training_start_time
+        stats['report_time_saved'] = self.checkpoints.time_saved
+
+        def upload():
             start_time = time.time()
-            s3_data = aws.upload_modeldata(modeldata,
-                                           self.model.get('resume_X'),
-                                           self.model['id'])
-            self.model['resume_X'] = s3_data
+            s3_data = aws.upload_modeldata(modeldata, model.get('resume_X'),
+                                           model['id'])
             log.debug('Model data uploading time: %s seconds' %
                       (time.time() - start_time))
             if s3_data is None:
-                print "s3_data is None", self.id
                 log.critical('Model data uploading returned None. Stop training.')
-                raise Exception
-        else:
-            s3_data = self.model.get('resume_X')
-        stats['time'] = time.time() - self.training_start_time
-        payload = {
-            'model': self.model['id'],
-            'model_name': self.model['name'],
-            's3_data': s3_data,
-            'queue_key': self.queue_key,
-            'data': stats
-        }
-        start_time = time.time()
+                raise Exception('Model data uploading returned None')
+            model['resume_X'] = s3_data
+            return s3_data
+
+        def report(s3_data):
+            payload = {
+                'model': model['id'],
+                'model_name': model['name'],
+                's3_data': s3_data,
+                'queue_key': self.queue_key,
+                'data': stats
+            }
+            start_time = time.time()
 
-        # publish stats first
-        self.stats_publish(json.dumps(payload, cls=NPArrayEncoder))
+            # publish stats first
+            self.stats_publish(json.dumps(payload, cls=NPArrayEncoder))
 
-        # then persist stats
-        if not api.post('/api/stats/', payload):
-            log.critical('Post stats to api failed. Stop training.')
-            raise ApiStoppedTraining
+            # then persist stats
+            if not api.post('/api/stats/', payload):
+                log.critical('Post stats to api failed. Stop training.')
+                raise ApiStoppedTraining
 
-        log.debug('Report stats time: %s seconds' % (time.time() - start_time))
+            log.debug('Report stats time: %s seconds' %
+                      (time.time() - start_time))
+
+        self.checkpoints.submit(report, upload if upload_modeldata else None)
         self.model['last_report_epoch'] = stats['iteration'] + 1
         self.training_start_time = time.time()
 
@@ -274,15 +291,13 @@ class TSNEEnsembleRunner(BaseTrainRunner):
 
         # pipe stdout to both train_pipe (for console output on ui)
         # and report_pipe (for live stats and d3 graph updates)
-        buffer_age = 2
-        self.report_pipe.buffer_age = buffer_age
-        self.report_pipe.donotflush = True
-        self.report_pipe.buffer_watcher = LogsBufferWatcher(self.report_pipe, buffer_age)
-        self.report_pipe.buffer_watcher.start()
-
-        #TODO de-duplicate call to _extract_stats:
+        # stats are extracted only from output written since the last
+        # publish, the report has all stats found so far
+        self._stats_list = []
+        self._partial_line = ''
         self.report_pipe.pre_hooks = [self._report_pipe_pre_hook]
-        self.report_pipe.publish_conditions = [lambda x: self._extract_stats(x)]
+        self.report_pipe.publish_conditions = [self._scan_stats]
+        self.report_pipe.buffer_age = 2
 
         # pattern for iteration line matching
         self.iteration_pattern = re.compile('\[t-SNE\] Iteration (\d+): error = (\d+.?\d*), gradient norm = (\d+.?\d*)')
@@ -306,18 +321,12 @@ class TSNEEnsembleRunner(BaseTrainRunner):
 
         # once training is done, flush logs and stats
         self.train_pipe.flush()
-        self.report_pipe.donotflush = False
+        # complete the last line
+        self.report_pipe('\n')
         self.report_pipe.flush()
 
     def _report_pipe_pre_hook(self, data):
-        stats_list = self._extract_stats(data)
-
-        # if we're unable to extract any stats,
-        # just return the data as it is
-        if not stats_list:
-            return data
-
-        payload = self._make_payload(self._models[0], stats_list)
+        payload = self._make_payload(self._models[0], list(self._stats_list))
 
         # persist stats
         if not api.post('/api/stats/', payload):
@@ -325,10 +334,17 @@ class TSNEEnsembleRunner(BaseTrainRunner):
 
         return json.dumps(payload, cls=NPArrayEncoder)
 
-    def _extract_stats(self, rawdata=None):
-        rawdata = rawdata if rawdata else self.report_pipe.buffer
-        output = ''.join(rawdata)
-        lines = output.strip().split('\n')
+    def _scan_stats(self, data):
+        """
+        Adds stats from new output, returns True if there are new ones.
+        """
+        lines = (self._partial_line + data).split('\n')
+        self._partial_line = lines.pop()
+        stats_list = self._extract_stats(lines)
+        self._stats_list.extend(stats_list)
+        return bool(stats_list)
+
+    def _extract_stats(self, lines):
         stats_list = []
         for line in lines:
             match = self.iteration_pattern.match(line)
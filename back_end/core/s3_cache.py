@@ -0,0 +1,209 @@
+import os
+import time
+import errno
+import sqlite3
+from contextlib import contextmanager
+from . import get_logger
+from .misc import fp_md5
+
+
+log = get_logger('ersatz.s3_cache')
+
+INDEX_FILENAME = 'index.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    etag TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pins (
+    key TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    PRIMARY KEY (key, pid)
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+COUNTERS = ('hits', 'misses', 'evicted_bytes', 'evicted_files')
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class S3Cache(object):
+    """
+    Local cache of S3 keys with sqlite index.
+
+    Index stores etag, size and mtime of every cached file, so freshness
+    is checked against etag of remote key (single HEAD request) without
+    reading the local file. Files are evicted in LRU order when total
+    size exceeds max_size, files pinned by running processes are kept.
+    Index is shared by all processes which use the same cachedir.
+    """
+
+    def __init__(self, cachedir, max_size=None):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        self.index_filename = os.path.join(cachedir, INDEX_FILENAME)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        """
+        Yields connection to index, commits or rolls back and closes it.
+        """
+        conn = sqlite3.connect(self.index_filename, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def local_filename(self, key):
+        return os.path.join(self.cachedir, key.strip('/'))
+
+    def get(self, remote, download, pin=False):
+        """
+        Returns local filename of remote key, downloads it with
+        download(remote, local_filename) if cached file is missing
+        or stale.
+        """
+        key = remote.key
+        etag = remote.etag.strip('"')
+        local = self.local_filename(key)
+        if self._is_fresh(key, etag, local):
+            log.debug('Using cached version of %s.' % key)
+            self._touch(key, 'hits')
+        else:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            download(remote, local)
+            self._add(key, etag, local)
+        if pin:
+            self.pin(key)
+        self.evict(keep=key)
+        return local
+
+    def _is_fresh(self, key, etag, local):
+        with self._connect() as conn:
+            row = conn.execute('SELECT etag, size, mtime FROM entries '
+                               'WHERE key = ?', (key,)).fetchone()
+        try:
+            stat = os.stat(local)
+        except OSError:
+            return False
+        if row is None:
+            # file cached before index existed, check it once
+            if fp_md5(local) != etag:
+                return False
+            self._add(key, etag, local, counter=None)
+            return True
+        return (row[0] == etag and row[1] == stat.st_size and
+                row[2] == stat.st_mtime)
+
+    def _add(self, key, etag, local, counter='misses'):
+        stat = os.stat(local)
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?)',
+                         (key, etag, stat.st_size, stat.st_mtime,
+                          time.time()))
+            if counter is not None:
+                self._incr(conn, counter, 1)
+
+    def _touch(self, key, counter):
+        with self._connect() as conn:
+            conn.execute('UPDATE entries SET last_access = ? WHERE key = ?',
+                         (time.time(), key))
+            self._incr(conn, counter, 1)
+
+    def _incr(self, conn, name, value):
+        conn.execute('INSERT OR IGNORE INTO counters VALUES (?, 0)', (name,))
+        conn.execute('UPDATE counters SET value = value + ? WHERE name = ?',
+                     (value, name))
+
+    def pin(self, key, pid=None):
+        """
+        Protects key from eviction while process pid is running.
+        """
+        pid = os.getpid() if pid is None else pid
+        with self._connect() as conn:
+            conn.execute('INSERT OR IGNORE INTO pins VALUES (?, ?)',
+                         (key, pid))
+
+    def unpin(self, key, pid=None):
+        pid = os.getpid() if pid is None else pid
+        with self._connect() as conn:
+            conn.execute('DELETE FROM pins WHERE key = ? AND pid = ?',
+                         (key, pid))
+
+    def _pinned(self, conn):
+        pinned = set()
+        for key, pid in conn.execute('SELECT key, pid FROM pins').fetchall():
+            if pid_alive(pid):
+                pinned.add(key)
+            else:
+                conn.execute('DELETE FROM pins WHERE key = ? AND pid = ?',
+                             (key, pid))
+        return pinned
+
+    def size(self):
+        with self._connect() as conn:
+            return conn.execute('SELECT COALESCE(SUM(size), 0) '
+                                'FROM entries').fetchone()[0]
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used files until cache fits max_size.
+        """
+        if self.max_size is None:
+            return 0
+        evicted = 0
+        with self._connect() as conn:
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) '
+                                 'FROM entries').fetchone()[0]
+            if total <= self.max_size:
+                return 0
+            pinned = self._pinned(conn)
+            pinned.add(keep)
+            rows = conn.execute('SELECT key, size FROM entries '
+                                'ORDER BY last_access').fetchall()
+            for key, size in rows:
+                if total <= self.max_size:
+                    break
+                if key in pinned:
+                    continue
+                try:
+                    os.remove(self.local_filename(key))
+                except OSError:
+                    pass
+                conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                log.debug('Evicted %s from cache.' % key)
+                total -= size
+                evicted += size
+                self._incr(conn, 'evicted_files', 1)
+            self._incr(conn, 'evicted_bytes', evicted)
+        return evicted
+
+    def stats(self):
+        """
+        Returns hits, misses and eviction counters.
+        """
+        with self._connect() as conn:
+            rows = dict(conn.execute('SELECT name, value FROM counters'))
+        rval = dict((name, rows.get(name, 0)) for name in COUNTERS)
+        rval['size'] = self.size()
+        return rval
@@ -1,3 +1,6 @@
+import re
+import time
+import uuid
 import hashlib
 from unipath import Path
 
@@ -14,6 +17,12 @@ class S3Bucket(object):
             return k
         return None
 
+    def initiate_multipart_upload(self, key_name):
+        mp = MultiPartUpload(self)
+        mp.key_name = key_name
+        mp.id = uuid.uuid4().hex
+        return mp
+
 
 class S3Connection(object):
     def __init__(self, access_key, secret_key):
@@ -38,6 +47,10 @@ class Key(object):
     def etag(self):
         return fp_md5(self.path)
 
+    @property
+    def size(self):
+        return self.path.size()
+
     def delete(self):
         self.path.remove()
 
@@ -45,29 +58,84 @@ class Key(object):
         self.path.parent.mkdir(parents=True)
 
     def get_contents_to_filename(self, local_file, *args, **kwargs):
+        throttle(self.size)
         self.path.copy(local_file)
 
+    def get_contents_to_file(self, fp, headers=None, *args, **kwargs):
+        start, length = 0, None
+        match = re.match(r'bytes=(\d+)-(\d+)', (headers or {}).get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            length = int(match.group(2)) - start + 1
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            data = f.read() if length is None else f.read(length)
+        throttle(len(data))
+        fp.write(data)
+
     def set_contents_from_filename(self, local_file, *args, **kwargs):
         self._mkdir()
+        throttle(Path(local_file).size())
         Path(local_file).copy(self.path)
 
     def set_contents_from_file(self, fp, *args, **kwargs):
         self._mkdir()
+        data = fp.read()
+        throttle(len(data))
         with open(self.path, 'wb') as f:
-            f.write(fp.read())
+            f.write(data)
+        return len(data)
 
     def get_contents_as_string(self):
         with open(self.path, 'r') as f:
             data = f.read()
+        throttle(len(data))
         return data
 
     def set_contents_from_string(self, data):
         self._mkdir()
+        throttle(len(data))
         with open(self.path, 'wb') as f:
             f.write(data)
         return len(data)
 
 
+class MultiPartUpload(object):
+    """
+    Parts are kept in S3_ROOT/.multipart/<id> until complete_upload.
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.key_name = None
+        self.id = None
+
+    @property
+    def path(self):
+        return settings.S3_ROOT.child('.multipart', self.id)
+
+    def upload_part_from_file(self, fp, part_num, size=None, *args, **kwargs):
+        self.path.mkdir(parents=True)
+        data = fp.read() if size is None else fp.read(size)
+        throttle(len(data))
+        with open(self.path.child('%05d' % part_num), 'wb') as f:
+            f.write(data)
+
+    def complete_upload(self):
+        k = Key(self.bucket, key=self.key_name)
+        k._mkdir()
+        with open(k.path, 'wb') as f:
+            for part in sorted(self.path.listdir()):
+                with open(part, 'rb') as p:
+                    f.write(p.read())
+        self.path.rmtree()
+        return k
+
+    def cancel_upload(self):
+        if self.path.exists():
+            self.path.rmtree()
+
+
 class S3DataError(Exception):
     pass
 
@@ -76,6 +144,17 @@ class S3ResponseError(Exception):
     pass
 
 
+def throttle(num_bytes):
+    """
+    Simulates latency and bandwidth of S3 request.
+    """
+    delay = settings.S3_LOCAL_LATENCY
+    if settings.S3_LOCAL_BANDWIDTH:
+        delay += num_bytes / float(settings.S3_LOCAL_BANDWIDTH)
+    if delay:
+        time.sleep(delay)
+
+
 def fp_md5(file_, blocksize=65536):
     with open(file_) as f:
         hasher = hashlib.md5()
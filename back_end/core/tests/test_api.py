@@ -0,0 +1,75 @@
+import json
+import requests
+from ersatz import api
+from ersatz.conf import settings
+
+
+class Response(object):
+    def __init__(self, status_code=200, data=None):
+        self.status_code = status_code
+        self.text = json.dumps(data or {'status': 'success'})
+
+
+class Session(object):
+    def __init__(self, failures=0, response=None):
+        self.failures = failures
+        self.response = response or Response()
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url, kwargs))
+        if self.failures:
+            self.failures -= 1
+            raise requests.ConnectionError('refused')
+        return self.response
+
+
+def test_backoff(monkeypatch):
+    monkeypatch.setattr(settings, 'API_RETRY_DELAY', 1)
+    monkeypatch.setattr(settings, 'API_RETRY_MAX_DELAY', 8)
+    for attempt, delay in ((0, 1), (2, 4), (10, 8)):
+        for i in range(10):
+            assert delay / 2. <= api.backoff(attempt) <= delay
+
+
+def test_request_retry(monkeypatch):
+    session = Session(failures=2)
+    sleeps = []
+    monkeypatch.setattr(api, 'get_session', lambda: session)
+    monkeypatch.setattr(api.time, 'sleep', sleeps.append)
+    monkeypatch.setattr(settings, 'API_BATCH', False)
+    assert api.post('/api/train/status/', {'model': 1})
+    assert len(session.calls) == 3 and len(sleeps) == 2
+    assert sleeps[0] < sleeps[1]
+    assert session.calls[-1][2]['timeout'] == settings.API_TIMEOUT
+
+
+def test_batch_coalesce(monkeypatch):
+    sent = []
+
+    def request(method, url, data):
+        sent.append((url, json.loads(data)))
+        return Response(data={'status': 'success',
+                              'models': {'1': 'success',
+                                         '2': 'User out of time'}})
+
+    monkeypatch.setattr(api, 'request', request)
+    batch = api.ApiBatch(interval=3600)
+    batch.add('stats', {'model': 1, 'data': {'iteration': 0}})
+    batch.add('logs', {'model': 1, 'data': 'a', 'is_new': True})
+    batch.add('logs', {'model': 1, 'data': 'b', 'is_new': False})
+    batch.add('stats', {'model': 1, 'data': {'iteration': 1}})
+    batch.add('logs', {'model': 2, 'data': 'x', 'is_new': False})
+    batch.add('logs', {'model': 2, 'data': 'y', 'is_new': True})
+    batch.send()
+    assert len(sent) == 1 and sent[0][0].endswith('/api/bulk/')
+    items = sent[0][1]['models']
+    assert [item['model'] for item in items] == [1, 2]
+    assert [s['data']['iteration'] for s in items[0]['stats']] == [0, 1]
+    assert items[0]['logs'] == {'data': 'ab', 'is_new': True}
+    # logs before is_new are replaced anyway
+    assert items[1]['logs'] == {'data': 'y', 'is_new': True}
+    assert batch.requests == 1 and batch.payloads == 6
+    # refused model learns it on the next payload
+    assert batch.add('stats', {'model': 1})
+    assert not batch.add('stats', {'model': 2})
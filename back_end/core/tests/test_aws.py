@@ -0,0 +1,83 @@
+import os
+import pytest
+from unipath import Path
+from ersatz import aws, s3_local
+from ersatz.conf import settings
+
+
+@pytest.fixture
+def s3(tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, 'S3_ROOT', Path(str(tmpdir.join('s3'))))
+    monkeypatch.setattr(settings, 'S3_CACHEDIR',
+                        Path(str(tmpdir.join('cache'))))
+    monkeypatch.setattr(settings, 'S3_PART_SIZE', 100)
+    monkeypatch.setattr(settings, 'S3_MULTIPART_THRESHOLD', 250)
+    monkeypatch.setattr(aws, 'Key', s3_local.Key)
+    monkeypatch.setattr(aws, 'MultiPartUpload', s3_local.MultiPartUpload)
+    monkeypatch.setattr(aws, 'get_bucket',
+                        lambda: s3_local.S3Bucket('bucket'))
+    monkeypatch.setattr(aws, '_cache', None)
+    return aws
+
+
+def content(size):
+    return ''.join(chr(i % 251) for i in range(size))
+
+
+def test_split_parts(s3):
+    assert s3.split_parts(250) == [(0, 100), (100, 100), (200, 50)]
+    assert s3.split_parts(200) == [(0, 100), (100, 100)]
+
+
+def test_download_parallel(s3, tmpdir):
+    data = content(1234)
+    s3.create_key('/data/big').set_contents_from_string(data)
+    local = str(tmpdir.join('big'))
+    progress = []
+    s3.save_to_file('/data/big', local)
+    assert open(local, 'rb').read() == data
+    s3.download_parallel(s3.get_key('/data/big'), local,
+                         cb=lambda done, total: progress.append(done))
+    assert open(local, 'rb').read() == data
+    assert sorted(progress) == progress
+    assert progress[-1] == 1234
+
+
+def test_upload_parallel(s3, tmpdir):
+    data = content(1234)
+    local = str(tmpdir.join('big'))
+    with open(local, 'wb') as f:
+        f.write(data)
+    s3.save_to_s3(local, '/data/big')
+    assert s3.get_data('/data/big') == data
+    assert s3.save_modeldata_to_filename('/data/big2', data) == '/data/big2'
+    assert s3.get_data('/data/big2') == data
+    assert not settings.S3_ROOT.child('.multipart').listdir()
+
+
+def test_gzip_upload(s3):
+    data = content(1234)
+    with s3.GzipUpload('/data/small.gz') as f:
+        f.write(data[:10])
+        f.write(data[10:20])
+    assert not os.path.exists(f.filename)
+    assert s3.get_data('/data/small.gz') == data[:20]
+    # compressed size is over multipart threshold
+    data = os.urandom(1234)
+    upload = s3.GzipUpload('/data/big.gz')
+    for i in range(0, len(data), 100):
+        upload.write(data[i:i + 100])
+    assert upload.close() == '/data/big.gz'
+    assert s3.get_data('/data/big.gz') == data
+    assert not settings.S3_ROOT.child('.multipart').listdir()
+
+
+def test_gzip_upload_error(s3):
+    try:
+        with s3.GzipUpload('/data/failed.gz') as f:
+            f.write('data')
+            raise ValueError
+    except ValueError:
+        pass
+    assert not os.path.exists(f.filename)
+    assert s3.get_key('/data/failed.gz') is None
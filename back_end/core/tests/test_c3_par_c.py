@@ -0,0 +1,266 @@
+import time
+import multiprocessing
+from collections import Counter
+import numpy as np
+from ersatz.data.ragged import RaggedSequences
+from ersatz.mrnn import gnumpy as g
+from ersatz.mrnn.ersatz_dp import DP
+from ersatz.mrnn.util import partition_batches, batch_costs, BatchQueue
+from ersatz.mrnn.opt.hfs.c3_par_c import HF
+from ersatz.mrnn.opt.m.rnn.mrnn import MRNN
+from ersatz.mrnn.opt.utils import nonlin
+from ersatz.mrnn.worker import Worker, merge_accuracy, state_size
+from ersatz.model_cache import ModelCache
+
+
+def make_hf(size):
+    hf = HF.__new__(HF)
+    hf.sh_X = np.frombuffer(multiprocessing.Array('f', size).get_obj(),
+                            dtype=np.float32)
+    hf.sh_X_generation = multiprocessing.RawValue('l', 0)
+    hf._sh_X_key = None
+    hf._reduce_buffer = np.empty(size, dtype=np.float32)
+    hf.X = g.garray(np.arange(size, dtype=np.float32))
+    return hf
+
+
+def make_worker(hf):
+    worker = Worker.__new__(Worker)
+    worker.np_X = hf.sh_X
+    worker.X_generation = hf.sh_X_generation
+    worker.X = None
+    worker.X_cached_generation = None
+    return worker
+
+
+def test_share_X_generation():
+    hf = make_hf(5)
+    worker = make_worker(hf)
+    hf.share_X(hf.X)
+    assert hf.sh_X_generation.value == 1
+    assert np.all(hf.sh_X == np.arange(5))
+    X = worker.get_X()
+    assert np.all(X.asarray() == np.arange(5))
+
+    # unchanged parameters are not copied again, as during CG
+    hf.share_X(hf.X)
+    assert hf.sh_X_generation.value == 1
+    assert worker.get_X() is X
+
+    hf.X += 1
+    hf.share_X(hf.X)
+    assert hf.sh_X_generation.value == 2
+    assert np.all(worker.get_X().asarray() == np.arange(1, 6))
+
+    # temporary parameters of line search are always copied
+    hf.share_X(hf.X + 1)
+    hf.share_X(hf.X + 2)
+    assert hf.sh_X_generation.value == 4
+    assert np.all(worker.get_X().asarray() == np.arange(3, 8))
+    hf.share_X(hf.X)
+    assert hf.sh_X_generation.value == 5
+    assert np.all(worker.get_X().asarray() == np.arange(1, 6))
+
+
+def test_reduce_shared():
+    hf = make_hf(3)
+    slots = [np.ones(3, dtype=np.float32), np.arange(3, dtype=np.float32)]
+    total = hf.reduce_shared(slots)
+    assert np.all(total.asarray() == [1, 2, 3])
+    assert np.all(slots[0] == 1)
+
+
+class FakeDP(object):
+    true_T = 3
+
+    def size(self, batch):
+        return batch[0][0].shape[0]
+
+
+class FakeSettings(object):
+    L2_decay = 1e-3
+
+
+def make_gn_worker(cache_size):
+    rng = np.random.RandomState(5)
+    worker = Worker.__new__(Worker)
+    worker.W = MRNN(4, 6, 5, 3, hid_nonlin=nonlin.Tanh,
+                    out_nonlin=nonlin.Softmax, use_workspace=False)
+    worker.dp = FakeDP()
+    worker.settings = FakeSettings()
+    worker.gauss_newton_cache = ModelCache(cache_size)
+    worker.gauss_newton_version = None
+    batches = {}
+    for bid in (0, 1, 2):
+        sizes = [4, 3, 3, 1]
+        batches[bid] = (
+            [g.garray(rng.randn(n, 4)) for n in sizes],
+            [g.garray(np.eye(3)[rng.randint(3, size=n)]) for n in sizes],
+            [g.ones((n, 1)) for n in sizes])
+    worker.get_batch = batches.__getitem__
+    X = g.garray(rng.randn(worker.W.pack().size) * .3)
+    R = g.garray(rng.randn(X.size))
+    return worker, batches, X, R
+
+
+def count_forward_passes(monkeypatch):
+    passes = []
+    forward_pass = MRNN.forward_pass
+    def counting_forward_pass(self, *args, **kwargs):
+        passes.append(1)
+        return forward_pass(self, *args, **kwargs)
+    monkeypatch.setattr(MRNN, 'forward_pass', counting_forward_pass)
+    return passes
+
+
+def test_gauss_newton_cache(monkeypatch):
+    worker, batches, X, R = make_gn_worker(10 ** 9)
+    passes = count_forward_passes(monkeypatch)
+
+    damping = (0., .5)
+    expected = 0
+    for bid in (0, 1, 2):
+        expected += worker.W.unpack(X).gauss_newton(
+                batches[bid], worker.W.unpack(R), mu=.5).pack()
+        expected += R * worker.dp.size(batches[bid]) * 1e-3
+    del passes[:]
+    # products with several R during CG pay for the states once
+    for i in range(3):
+        gn, tot = worker.gauss_newton([0, 1, 2], X, R, damping, None, 1)
+        assert np.allclose(gn.asarray(), expected.asarray())
+        assert tot == 12
+    assert len(passes) == 3
+    size = worker.gauss_newton_cache.size
+    assert size == sum(state_size(v) for v, _ in
+                       worker.gauss_newton_cache.entries.values())
+    assert size > 0
+
+    # new parameters drop the states
+    worker.gauss_newton([2], X, R, damping, None, 2)
+    assert len(passes) == 4
+    assert worker.gauss_newton_cache.entries.keys() == [(2, 2)]
+    super(Worker, worker).gauss_newton('forget')
+    assert not worker.gauss_newton_cache.entries
+
+
+def test_gauss_newton_cache_size():
+    worker, batches, X, R = make_gn_worker(0)
+    worker.gauss_newton([0, 1], X, R, (0., 0.), None, 1)
+    assert not worker.gauss_newton_cache.entries
+    worker.gauss_newton_cache = ModelCache(10 ** 9)
+    worker.gauss_newton([0], X, R, (0., 0.), None, 1)
+    one = worker.gauss_newton_cache.size
+    # batches have the same shapes, there is room for two of them
+    worker.gauss_newton_cache = ModelCache(int(2.5 * one))
+    worker.gauss_newton([0, 1, 2], X, R, (0., 0.), None, 1)
+    assert worker.gauss_newton_cache.entries.keys() == [(1, 1), (1, 2)]
+
+
+def test_gauss_newton_cache_with_losses(monkeypatch):
+    worker, batches, X, R = make_gn_worker(10 ** 9)
+    passes = count_forward_passes(monkeypatch)
+    hf = make_hf(X.size)
+    hf.X = X
+
+    def gauss_newton():
+        hf.share_X(hf.X)
+        return worker.gauss_newton([0, 1], X, R, (0., 0.), None,
+                                   hf.X_version(hf.X))[0].asarray()
+
+    expected = gauss_newton()
+    # cg evaluates losses at temporary parameters between products
+    for i in range(3):
+        x = hf.X * 0 + i
+        hf.share_X(hf.X + x)
+        assert hf.X_version(hf.X + x) != hf.X_version(hf.X)
+        assert np.all(gauss_newton() == expected)
+    assert hf.sh_X_generation.value == 7
+    assert len(passes) == 2
+    hf.X += 1
+    gauss_newton()
+    assert len(passes) == 4
+
+
+def test_merge_accuracy():
+    a = (np.array([1., .5, 0.]), {0: Counter([0, 1]), 1: Counter([1])},
+         np.array([2, 2, 1]))
+    b = (np.array([0., 1.]), {0: Counter([0]), 1: Counter()},
+         np.array([2, 1]))
+    assert merge_accuracy([]) == (None, None, None)
+    assert merge_accuracy([a]) is a
+    accuracy, confusion, weights = merge_accuracy([a, b])
+    assert np.allclose(accuracy, [.5, 2. / 3, 0.])
+    assert confusion == {0: Counter([0, 0, 1]), 1: Counter([1])}
+    assert weights.tolist() == [4, 3, 1]
+
+
+def test_partition_batches():
+    parts = [partition_batches(range(10), i, 4) for i in range(4)]
+    assert parts == [[0, 1, 2], [3, 4, 5], [6, 7], [8, 9]]
+    assert partition_batches([5], 0, 1) == [5]
+    assert partition_batches([5], 1, 2) == []
+
+
+def test_batch_costs():
+    lengths = [5, 4, 4, 1, 1]
+    ragged = RaggedSequences.from_lengths(
+            np.zeros((sum(lengths), 3), dtype=np.float32), lengths)
+    dense = ragged.to_padded().transpose(1, 0, 2)
+    for data in (ragged, dense):
+        provider = DP({})
+        provider.binary_train_data = provider.binary_test_data = data
+        view = provider.create_view()['train']
+        assert batch_costs(view, 2, 3) == [9, 5, 1]
+
+
+def test_batch_queue_lpt():
+    queue = BatchQueue(2, 10)
+    parts = queue.assign([0, 1, 2, 3, -1], [1., 5., 4., 3., 3.])
+    assert parts == [[1, -1], [2, 3, 0]]
+    assert queue.pop(1) == 2
+    # own batches, then stolen ones from the back
+    assert list(queue.iterate(0)) == [1, -1, 0, 3]
+    assert queue.pop(1) is None
+
+
+def test_batch_queue_reverse():
+    queue = BatchQueue(2, 10)
+    queue.assign([0, 1, 2, 3], [4., 3., 2., 1.])
+    assert queue.pop(0, reverse=True) == 3
+    assert queue.pop(1, reverse=True) == 2
+    assert queue.pop(1, reverse=True) == 1
+    # stolen from the front
+    assert queue.pop(1, reverse=True) == 0
+    assert queue.pop(0) is None
+
+
+def take_batches(queue, worker, results):
+    for batch in queue.iterate(worker):
+        time.sleep(.001 * (worker + 1))
+        results.put((worker, batch))
+    results.put((worker, None))
+
+
+def test_batch_queue_workers():
+    queue = BatchQueue(3, 100)
+    queue.assign(range(60), [1.] * 60)
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=take_batches,
+                                       args=(queue, i, results))
+               for i in range(3)]
+    for worker in workers:
+        worker.start()
+    taken = []
+    done = 0
+    while done < 3:
+        worker, batch = results.get(timeout=10)
+        if batch is None:
+            done += 1
+        else:
+            taken.append((worker, batch))
+    for worker in workers:
+        worker.join()
+    assert sorted(batch for _, batch in taken) == range(60)
+    counts = [sum(1 for w, _ in taken if w == i) for i in range(3)]
+    # the fastest worker stole from the others
+    assert counts[0] > 20
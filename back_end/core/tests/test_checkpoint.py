@@ -0,0 +1,137 @@
+import json
+import cStringIO
+import time
+import threading
+import pytest
+import numpy as np
+from ersatz import checkpoint
+from ersatz.checkpoint import CheckpointUploader, dumps_modeldata, \
+        loads_modeldata
+from ersatz.exception import ApiStoppedTraining
+
+
+MODELDATA = {'X': np.linspace(-1, 1, 1000), 'CG_x': np.zeros(0),
+             'damping': np.array([1., .5]), 'iter': np.int64(3), 'v': 4,
+             '_total_num_cg': 120}
+
+
+def check_modeldata(data, float_dtype=np.float64):
+    assert data['iter'] == 3 and data['v'] == 4
+    assert data['_total_num_cg'] == 120
+    assert data['X'].dtype == float_dtype
+    assert np.allclose(data['X'], MODELDATA['X'])
+    assert data['CG_x'].shape == (0,)
+    assert np.all(data['damping'] == MODELDATA['damping'])
+
+
+def test_modeldata_binary():
+    data = dumps_modeldata(MODELDATA)
+    assert data.startswith(checkpoint.MODELDATA_MAGIC)
+    # raw weights instead of text
+    assert len(data) < 8 * 1000 + 512
+    check_modeldata(loads_modeldata(data))
+    # resume continues from exactly the same parameters
+    assert np.all(loads_modeldata(data)['X'] == MODELDATA['X'])
+
+
+def test_modeldata_float32():
+    data = dumps_modeldata(MODELDATA, float_dtype=np.float32)
+    assert len(data) < 4 * 1000 + 512
+    check_modeldata(loads_modeldata(data), np.float32)
+
+
+def test_modeldata_file(tmpdir):
+    filename = str(tmpdir.join('model.weights'))
+    with open(filename, 'wb') as f:
+        f.write(dumps_modeldata(MODELDATA))
+    data = checkpoint.load_modeldata_file(filename)
+    assert isinstance(data['X'], np.memmap)
+    check_modeldata(data)
+
+
+def test_modeldata_version():
+    data = dumps_modeldata(MODELDATA)
+    prefix = checkpoint.PREFIX.unpack(data[:checkpoint.PREFIX.size])
+    data = checkpoint.PREFIX.pack(prefix[0], prefix[1] + 1, prefix[2]) + \
+        data[checkpoint.PREFIX.size:]
+    with pytest.raises(ValueError):
+        loads_modeldata(data)
+
+
+def test_modeldata_npz():
+    out = cStringIO.StringIO()
+    np.savez(out, X=np.arange(10.), iter=np.asarray(3))
+    data = loads_modeldata(out.getvalue())
+    assert data['iter'] == 3
+    assert np.all(data['X'] == np.arange(10.))
+
+
+def test_modeldata_json():
+    data = loads_modeldata(json.dumps({'X': [1, 2], 'iter': 3}))
+    assert data == {'X': [1, 2], 'iter': 3}
+
+
+def test_checkpoint_uploader_order():
+    uploader = CheckpointUploader()
+    reports = []
+    for i in range(10):
+        upload = (lambda i=i: 'key%d' % i) if i % 3 == 0 else None
+        uploader.submit(lambda key, i=i: reports.append((i, key)), upload)
+    uploader.flush()
+    assert [i for i, _ in reports] == range(10)
+    # uploads may be coalesced, but never report newer model data
+    for i, key in reports:
+        assert key is None or int(key[3:]) <= i
+    assert reports[-1] == (9, 'key9')
+
+
+def test_checkpoint_uploader_coalesce():
+    uploader = CheckpointUploader()
+    release = threading.Event()
+    uploads = []
+    reports = []
+
+    def upload(i):
+        release.wait()
+        uploads.append(i)
+        return 'key%d' % i
+
+    for i in range(5):
+        uploader.submit(lambda key, i=i: reports.append((i, key)),
+                        lambda i=i: upload(i))
+        while not uploader.busy:
+            time.sleep(.001)
+    release.set()
+    uploader.flush()
+    # first upload was running, 1..3 are replaced by the newest one
+    assert uploads == [0, 4]
+    assert uploader.skipped == 3
+    assert reports == [(0, 'key0'), (1, 'key0'), (2, 'key0'), (3, 'key0'),
+                       (4, 'key4')]
+    assert uploader.time_saved > 0
+
+
+def test_checkpoint_uploader_reset():
+    uploader = CheckpointUploader('resume0')
+    reports = []
+    uploader.submit(lambda key: reports.append(key))
+    uploader.submit(lambda key: reports.append(key), lambda: 'key1')
+    uploader.reset('resume1')
+    # next model reports its own resume key until it uploads
+    uploader.submit(lambda key: reports.append(key))
+    uploader.submit(lambda key: reports.append(key), lambda: 'key2')
+    uploader.flush()
+    assert reports == ['resume0', 'key1', 'resume1', 'key2']
+
+
+def test_checkpoint_uploader_error():
+    uploader = CheckpointUploader()
+
+    def report(key):
+        raise ApiStoppedTraining()
+
+    uploader.submit(report)
+    with pytest.raises(ApiStoppedTraining):
+        uploader.flush()
+    uploader.submit(lambda key: None)
+    uploader.flush()
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import signal
+import threading
+import pytest
+from ersatz import listener
+from ersatz.conf import settings
+from ersatz.exception import ProgramSetupError
+from ersatz.listener import ApiListener, Consumer, JobPool, Resources
+from tests import amqp_local
+
+
+def test_resources():
+    resources = Resources(2, [0, 1, 2], memory=1000)
+    a = resources.acquire({'gpu': 2, 'memory': 600})
+    assert a == {'cpu': 1, 'gpus': [0, 1], 'memory': 600}
+    assert not resources.fits({'memory': 600})
+    assert resources.acquire({'gpu': 2}) is None
+    b = resources.acquire({'gpu': 1})
+    assert b['gpus'] == [2]
+    assert resources.acquire({}) is None
+    resources.release(a)
+    assert resources.gpus == [0, 1] and resources.memory == 1000
+    with pytest.raises(ProgramSetupError):
+        resources.check({'gpu': 4})
+
+
+def write_gpus(filename):
+    with open(filename, 'w') as f:
+        f.write(os.environ['ERSATZ_MRNN_GPUS'])
+
+
+def test_job_pool(tmpdir):
+    pool = JobPool(Resources(4, [0, 1]), max_jobs=3)
+    done = []
+    for i in range(2):
+        assert pool.can_start({'gpu': 1})
+        pool.start(write_gpus, str(tmpdir.join(str(i))), {'gpu': 1},
+                   done.append)
+    # gpus are taken by running jobs
+    assert not pool.can_start({'gpu': 1})
+    assert pool.can_start({})
+    pool.drain(interval=.01)
+    assert done == [0, 0]
+    assert sorted(tmpdir.join(str(i)).read() for i in range(2)) == ['0', '1']
+    assert pool.resources.gpus == [0, 1] and len(pool) == 0
+
+
+def test_job_pool_full():
+    pool = JobPool(Resources(4, [0, 1]), max_jobs=0)
+    with pytest.raises(ProgramSetupError):
+        pool.start(write_gpus, 'unused', {'gpu': 1}, None)
+    # slot is not taken by job which was not started
+    assert pool.resources.gpus == [0, 1] and pool.resources.cpus == 4
+
+
+def sleep_job(seconds):
+    time.sleep(seconds)
+
+
+def test_job_sigterm():
+    stopped = []
+    handler = signal.signal(signal.SIGTERM,
+                            lambda signum, frame: stopped.append(signum))
+    try:
+        pool = JobPool(Resources(1, []))
+        done = []
+        p = pool.start(sleep_job, 30, {}, done.append)
+        time.sleep(.2)
+        os.kill(p.pid, signal.SIGTERM)
+        pool.drain(interval=.01)
+    finally:
+        signal.signal(signal.SIGTERM, handler)
+    # job is killed, it does not run listener's handler
+    assert done == [-signal.SIGTERM]
+    assert stopped == []
+
+
+@pytest.fixture
+def broker(monkeypatch):
+    amqp_local.reset()
+    monkeypatch.setattr(listener, 'BlockingConnection',
+                        amqp_local.BlockingConnection)
+    return amqp_local.get_broker()
+
+
+def test_consumer_push(broker):
+    consumer = Consumer()
+    consumer.consume(['train', 'predict'])
+    assert consumer.next_message(timeout=.01) is None
+    publisher = threading.Timer(.05, amqp_local.publish,
+                                args=('predict', json.dumps({'id': 1})))
+    publisher.start()
+    queue, method_frame, body = consumer.next_message(timeout=5)
+    assert queue == 'predict' and body == {'id': 1}
+    # prefetch 1, next message waits for ack
+    amqp_local.publish('predict', json.dumps({'id': 2}))
+    assert consumer.next_message(timeout=.01) is None
+    consumer.ack(method_frame.delivery_tag, consumer.channel)
+    assert consumer.next_message(timeout=1)[2] == {'id': 2}
+
+
+def test_consumer_pause(broker):
+    consumer = Consumer()
+    consumer.consume(['train'], prefetch=2)
+    amqp_local.publish('train', '1')
+    amqp_local.publish('train', '2')
+    _, method_frame, _ = consumer.next_message(timeout=1)
+    consumer.pause('train')
+    # undelivered message goes back to queue, taken one stays with us
+    assert list(broker.queues['train']) == [('2', True)]
+    assert consumer.next_message(timeout=.01) is None
+    consumer.ack(method_frame.delivery_tag)
+    consumer.resume('train')
+    assert consumer.next_message(timeout=1)[2] == 2
+
+
+def test_consumer_reconnect(broker, monkeypatch):
+    monkeypatch.setattr(settings, 'BROKER_RECONNECT_DELAY', .01)
+    consumer = Consumer()
+    consumer.consume(['train'])
+    amqp_local.publish('train', '1')
+    _, method_frame, _ = consumer.next_message(timeout=1)
+    channel = consumer.channel
+    consumer.connection.close()
+    # unacknowledged message is redelivered to renewed subscription
+    _, redelivered, body = consumer.next_message(timeout=1)
+    assert body == 1 and redelivered.redelivered
+    consumer.ack(method_frame.delivery_tag, channel)
+    consumer.ack(redelivered.delivery_tag, consumer.channel)
+    assert not consumer.channel.unacked
+
+
+def sleep_job(body):
+    time.sleep(body)
+
+
+def test_listener_concurrent(broker, monkeypatch):
+    monkeypatch.setattr(settings, 'RUN_IN_SUBPROCESS', True)
+    monkeypatch.setattr(settings, 'LISTENER_MAX_JOBS', 4)
+    monkeypatch.setattr(settings, 'LISTENER_CPUS', 4)
+    monkeypatch.setattr(settings, 'LISTENER_RESOURCES',
+                        {'train': {'gpu': 1}, 'predict': {}})
+    monkeypatch.setattr(listener, 'grab_gpu_boards', lambda: [0])
+    api_listener = ApiListener(runners=((sleep_job, 'train'),
+                                        (sleep_job, 'predict')))
+    acked = []
+    ack = api_listener.consumer.ack
+
+    def record_ack(delivery_tag, channel=None):
+        acked.append(json.loads(channel.unacked[delivery_tag][2]))
+        ack(delivery_tag, channel)
+        if len(acked) == 5:
+            api_listener.stop()
+
+    api_listener.consumer.ack = record_ack
+    for queue, body in (('train', .3), ('train', .4), ('predict', .31),
+                        ('predict', .32), ('predict', .33)):
+        amqp_local.publish(queue, json.dumps(body))
+    start_time = time.time()
+    api_listener.loop()
+    # jobs run at once, except the second training which waits for gpu
+    assert time.time() - start_time < 1.4
+    assert acked.index(.3) < acked.index(.4)
+    assert sorted(acked) == [.3, .31, .32, .33, .4]
+    assert len(api_listener.pool) == 0
+    assert not any(broker.queues.values())
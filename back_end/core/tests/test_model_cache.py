@@ -0,0 +1,50 @@
+import numpy as np
+from ersatz.model_cache import ModelCache, estimate_size
+
+
+class Model(object):
+    def __init__(self, size):
+        self.W = np.zeros(size, dtype=np.uint8)
+        self.name = 'model'
+
+
+def test_estimate_size():
+    assert estimate_size(Model(100)) == 100
+    assert estimate_size({'model': Model(30), 'functions': {}}) == 30
+
+
+def test_model_cache_hit():
+    cache = ModelCache(1000)
+    loads = []
+
+    def load():
+        loads.append(1)
+        return Model(100)
+
+    model = cache.get('a', load)
+    assert cache.get('a', load) is model
+    assert len(loads) == 1
+    stats = cache.stats()
+    assert stats['hits'] == 1 and stats['misses'] == 1
+    assert stats['hit_rate'] == .5
+    assert stats['size'] == 100
+
+
+def test_model_cache_evict_lru():
+    cache = ModelCache(250)
+    a = cache.get('a', lambda: Model(100))
+    cache.get('b', lambda: Model(100))
+    assert cache.get('a', lambda: None) is a
+    cache.get('c', lambda: Model(100))
+    assert cache.get('a', lambda: None) is a
+    assert cache.stats()['evicted'] == 1
+    assert cache.get('b', lambda: None) is None
+
+
+def test_model_cache_too_big():
+    cache = ModelCache(50)
+    cache.get('a', lambda: Model(100))
+    assert cache.stats()['models'] == 0
+    cache = ModelCache(0)
+    cache.get('a', lambda: {})
+    assert cache.stats()['models'] == 0
@@ -0,0 +1,153 @@
+import numpy as np
+import pytest
+from ersatz.conf import settings
+from ersatz.mrnn import gnumpy as g
+from ersatz.mrnn.opt.m.rnn import mrnn
+from ersatz.mrnn.opt.m.rnn.mrnn import MRNN
+from ersatz.mrnn.opt.utils import nonlin
+
+
+def make_batch(rng, v, o):
+    # samples sorted by length, timesteps get shorter
+    sizes = [5, 5, 4, 2, 2, 1]
+    V = [g.garray(rng.randn(n, v)) for n in sizes]
+    O = [g.garray(np.eye(o)[rng.randint(o, size=n)]) for n in sizes]
+    M = [g.ones((n, 1)) for n in sizes]
+    return V, O, M
+
+
+def make_models(rng):
+    W = MRNN(4, 6, 5, 3, hid_nonlin=nonlin.Tanh, out_nonlin=nonlin.Softmax)
+    X = g.garray(rng.randn(W.pack().size) * .5)
+    R = g.garray(rng.randn(X.size))
+    # results of W are views into its workspace, the reference has none
+    per_timestep = MRNN(4, 6, 5, 3, hid_nonlin=nonlin.Tanh,
+                        out_nonlin=nonlin.Softmax, hoist_inputs=False,
+                        use_workspace=False)
+    return W.unpack(X), per_timestep.unpack(X), W.unpack(R)
+
+
+def assert_close(a, b):
+    assert np.allclose(a.as_numpy_array(), b.as_numpy_array(), atol=1e-8)
+
+
+@pytest.fixture
+def rng():
+    return np.random.RandomState(7)
+
+
+def test_hoisted_forward_pass(rng):
+    W, W_t, _ = make_models(rng)
+    V, O, M = make_batch(rng, 4, 3)
+    for a, b in zip(W.forward_pass(V)[-1], W_t.forward_pass(V)[-1]):
+        assert_close(a, b)
+
+
+def test_hoisted_grad(rng):
+    W, W_t, _ = make_models(rng)
+    batch = make_batch(rng, 4, 3)
+    grad, grad2, loss = W.grad(batch, compute_grad2=True)
+    grad_t, grad2_t, loss_t = W_t.grad(batch, compute_grad2=True)
+    assert np.allclose(loss, loss_t)
+    assert_close(grad.pack(), grad_t.pack())
+    assert_close(grad2.pack(), grad2_t.pack())
+    assert W.unpack(W.pack()).hoist_inputs
+    assert not W_t.unpack(W_t.pack()).hoist_inputs
+
+
+def test_hoisted_gauss_newton(rng):
+    W, W_t, R = make_models(rng)
+    batch = make_batch(rng, 4, 3)
+    ans = W.gauss_newton(batch, R, mu=.5)
+    ans_t = W_t.gauss_newton(batch, R, mu=.5)
+    assert_close(ans.pack(), ans_t.pack())
+
+
+def test_workspace_reused(rng):
+    W, W_t, R = make_models(rng)
+    batch = make_batch(rng, 4, 3)
+    grad = W.grad(batch, compute_grad2=True)[0]
+    X = grad.pack()
+    assert_close(X, W_t.grad(batch)[0].pack())
+    # loss and gauss_newton don't touch gradients of the workspace
+    assert np.allclose(W.loss(batch), W_t.loss(batch))
+    assert_close(W.gauss_newton(batch, R).pack(),
+                 W_t.gauss_newton(batch, R).pack())
+    assert_close(grad.pack(), X)
+    # the next grad writes over the same arrays
+    other = W.unpack(W.pack() * .5)
+    grad_2 = other.grad(batch)[0]
+    assert np.all(grad.pack().asarray() == grad_2.pack().asarray())
+    assert_close(grad_2.pack(), W_t.unpack(W.pack() * .5).grad(batch)[0].pack())
+    assert not W_t.unpack(W_t.pack()).use_workspace
+
+
+def test_workspace_cache(rng, monkeypatch):
+    monkeypatch.setattr(settings, 'MRNN_WORKSPACE_CACHE_SIZE', 2)
+    monkeypatch.setattr(mrnn, '_workspaces', {})
+    W = make_models(rng)[0]
+    V = make_batch(rng, 4, 3)[0]
+    first = mrnn.get_workspace(W, V)
+    # batches of the same size share it, whatever their lengths
+    assert mrnn.get_workspace(W, V[:3]) is first
+    assert mrnn.get_workspace(W, V[:1] + V[3:4]) is first
+    smaller = mrnn.get_workspace(W, V[2:])
+    assert smaller is not first and smaller.n == 4
+    assert mrnn.get_workspace(W, V) is first
+    # least recently used batch size is dropped
+    assert mrnn.get_workspace(W, V[3:]) is not smaller
+    assert len(mrnn._workspaces['cache']) == 2
+    assert mrnn.get_workspace(W, V[:2]) is first
+    assert mrnn.get_workspace(W, V[2:]) is not smaller
+
+
+def test_workspace_grows(rng, monkeypatch):
+    monkeypatch.setattr(mrnn, '_workspaces', {})
+    W, W_t, R = make_models(rng)
+    V, O, M = make_batch(rng, 4, 3)
+    # forward passes don't make buffers of R passes and gradients
+    W.loss((V[:2], O[:2], M[:2]))
+    workspace = mrnn.get_workspace(W, V)
+    assert sorted(workspace.buffers) == [('A', 1), ('A', 2), ('HX', 0),
+                                         ('OX', 1), ('OX', 2)]
+    for n in (3, 6, 2):
+        batch = (V[:n], O[:n], M[:n])
+        assert_close(W.grad(batch)[0].pack(), W_t.grad(batch)[0].pack())
+        assert_close(W.gauss_newton(batch, R).pack(),
+                     W_t.gauss_newton(batch, R).pack())
+    assert mrnn.get_workspace(W, V) is workspace
+    assert ('R_OX', 6) in workspace.buffers
+
+
+def test_dot_to():
+    a = g.garray(np.arange(6.).reshape((2, 3)))
+    b = g.garray(np.arange(12.).reshape((3, 4)))
+    out = g.zeros((4, 4))
+    g.dot_to(out[:2], a, b)
+    g.add_dot(out[1:3], a, b)
+    expected = np.zeros((4, 4))
+    expected[:2] = np.dot(a.asarray(), b.asarray())
+    expected[1:3] += np.dot(a.asarray(), b.asarray())
+    assert np.allclose(out.asarray(), expected)
+    with pytest.raises(ValueError):
+        g.dot_to(out, a, b)
+
+
+def test_evaluate(rng):
+    W, W_t, _ = make_models(rng)
+    batch = make_batch(rng, 4, 3)
+    loss, accuracy, grad, grad2 = W.evaluate(batch, compute_grad=True,
+                                             compute_grad2=True)
+    grad_t, grad2_t, loss_t = W_t.grad(batch, compute_grad2=True)
+    assert np.allclose(loss, loss_t)
+    assert_close(grad.pack(), grad_t.pack())
+    assert_close(grad2.pack(), grad2_t.pack())
+    accuracy_t = W_t.get_accuracy(batch)
+    assert np.all(accuracy[0] == accuracy_t[0])
+    assert accuracy[1] == accuracy_t[1]
+    assert np.all(accuracy[2] == accuracy_t[2])
+
+    loss, accuracy, grad, grad2 = W.evaluate(batch)
+    assert grad is None and grad2 is None
+    assert np.allclose(loss, W_t.loss(batch))
+    assert np.all(accuracy[0] == accuracy_t[0])
@@ -0,0 +1,54 @@
+import ctypes
+import numpy as np
+import pytest
+from ersatz.mrnn.npmat import npmat
+from ersatz.mrnn.util import loaded_blas_libraries, set_blas_threads
+
+
+@pytest.fixture(params=[np.float64, np.float32])
+def dtype(request):
+    previous = npmat.__DTYPE__
+    npmat.set_dtype(request.param)
+    yield request.param
+    npmat.set_dtype(previous)
+
+
+def test_dtype(dtype):
+    assert npmat.empty((2, 3)).numpy_array.dtype == dtype
+    assert npmat.CUDAMatrix(np.ones((2, 3))).numpy_array.dtype == dtype
+    assert npmat.empty((2, 3)).numpy_array.flags.f_contiguous
+
+
+def test_dot_target(dtype):
+    A, B = np.random.randn(5, 3), np.random.randn(3, 4)
+    a, b = npmat.CUDAMatrix(A), npmat.CUDAMatrix(B)
+    target = npmat.empty((5, 4))
+    target.numpy_array.fill(np.nan)
+    out = target.numpy_array
+    assert npmat.dot(a, b, target) is target
+    # written in place, not replaced by a new array
+    assert target.numpy_array is out
+    assert np.allclose(out, A.dot(B), atol=1e-5)
+    target.add_dot(a, b)
+    assert np.allclose(out, 2 * A.dot(B), atol=1e-5)
+    target.subtract_dot(a, b)
+    assert target.numpy_array is out
+    assert np.allclose(out, A.dot(B), atol=1e-5)
+    # row major and sliced operands
+    npmat.dot(a.T.T, npmat.CUDAMatrix(B.T).T, target)
+    assert np.allclose(out, A.dot(B), atol=1e-5)
+    rows = npmat.CUDAMatrix(np.vstack((A, A)))
+    rows.numpy_array = rows.numpy_array[:5]
+    npmat.dot(rows, b, target)
+    assert np.allclose(out, A.dot(B), atol=1e-5)
+    with pytest.raises(npmat.CUDAMatException):
+        target.add_dot(b, a)
+
+
+def test_set_blas_threads():
+    libraries = loaded_blas_libraries()
+    assert set_blas_threads(1) == len(libraries)
+    for path in libraries:
+        lib = ctypes.CDLL(path)
+        if hasattr(lib, 'openblas_get_num_threads'):
+            assert lib.openblas_get_num_threads() == 1
@@ -0,0 +1,138 @@
+import numpy as np
+from unipath import Path
+from ersatz import aws, s3_local
+from ersatz.conf import settings
+from ersatz.data.ragged import RaggedSequences
+from ersatz.mrnn import gnumpy as g
+from ersatz.mrnn.opt.m.rnn.mrnn import MRNN
+from ersatz.mrnn.opt.m.rnn.ensemble import MRNNEnsemble
+from ersatz.mrnn.opt.utils import nonlin
+from ersatz.data import utils as data_utils
+from ersatz.predictors import Predictor, RunEnsemblePredictor, remove_nans
+
+
+def make_model(name, h, f, out_nonlin=nonlin.Softmax):
+    W = MRNN(4, h, f, 3, hid_nonlin=nonlin.Tanh, out_nonlin=out_nonlin)
+    W = W.unpack(g.garray(np.random.randn(W.pack().size) * .5))
+    W.model_name = name
+    return W
+
+
+def make_input():
+    # samples sorted by length: 5, 3, 3 and 1 timesteps
+    return [g.garray(np.random.randn(n, 4)) for n in (4, 3, 3, 1, 1)]
+
+
+def reference(W, V, original_order):
+    # what Predictor did for every model before MRNNEnsemble
+    results = [W.out_nonlin(x).as_numpy_array()
+               for x in W.forward_pass(V)[4]]
+    for i in range(1, len(results)):
+        nans = np.tile(np.nan, (results[0].shape[0] - results[i].shape[0],
+                                results[i].shape[1]))
+        results[i] = np.vstack((results[i], nans))
+    results = data_utils.to_normal_shape(np.array(results))
+    results = [x for (_, x) in sorted(zip(original_order, results))]
+    return [[t for t in sample if not np.isnan(t).all()]
+            for sample in results]
+
+
+def test_ensemble_forward_pass():
+    np.random.seed(1)
+    models = [make_model('a', 6, 5), make_model('b', 3, 7)]
+    V = make_input()
+    H, Y = MRNNEnsemble(models).forward_pass(V)
+    for k, W in enumerate(models):
+        _, _, _, H_k, OX_k = W.forward_pass(V)
+        for t in range(len(V)):
+            assert np.allclose(
+                Y[t].as_numpy_array()[:, 3 * k:3 * (k + 1)],
+                W.out_nonlin(OX_k[t]).as_numpy_array(), atol=1e-6)
+            assert np.allclose(
+                MRNNEnsemble(models).hidden(H, k)[t].as_numpy_array(),
+                H_k[t + 1].as_numpy_array(), atol=1e-6)
+
+
+def test_predictor_predict(monkeypatch):
+    np.random.seed(2)
+    predictor = Predictor.__new__(Predictor)
+    models = [make_model('a', 6, 5), make_model('b', 3, 7),
+              make_model('c', 4, 4, out_nonlin=nonlin.Sigmoid)]
+    predictor.models = [(10 + i, i, W) for i, W in enumerate(models)]
+    V = make_input()
+    original_order = np.array([2, 0, 3, 1])
+
+    def load_data(input_data):
+        predictor.input_data = V
+        predictor.original_order = original_order
+    monkeypatch.setattr(predictor, '_load_data', load_data)
+    result = predictor.predict('')
+
+    expected = [reference(W, V, original_order) for W in models]
+    for (iteration_id, _, _), prediction, samples in zip(
+            predictor.models, result['predictions'], expected):
+        assert prediction['iteration'] == iteration_id
+        assert [len(s) for s in prediction['output']] == [3, 1, 5, 3]
+        for sample, expected_sample in zip(prediction['output'], samples):
+            assert np.allclose(sample, expected_sample, atol=1e-6)
+    for i, sample in enumerate(result['ensemble_prediction']):
+        mean = np.mean([samples[i] for samples in expected], axis=0)
+        assert np.allclose(sample, mean, atol=1e-6)
+
+
+def test_remove_nans():
+    data = np.arange(24.).reshape((2, 4, 3))
+    data[0, 2:] = np.nan
+    data[1, 1] = np.nan
+    samples = remove_nans(data)
+    assert [s.tolist() for s in samples] == [
+        data[0, :2].tolist(), data[1, [0, 2, 3]].tolist()]
+
+
+def parse(text):
+    return [[map(float, timestep.split(',')) for timestep in line.split(';')]
+            for line in text.split('\n')]
+
+
+def test_run_ensemble(tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, 'S3_ROOT', Path(str(tmpdir)))
+    monkeypatch.setattr(settings, 'PREDICT_CHUNK_SIZE', 2)
+    monkeypatch.setattr(aws, 'Key', s3_local.Key)
+    monkeypatch.setattr(aws, 'get_bucket',
+                        lambda: s3_local.S3Bucket('bucket'))
+    np.random.seed(3)
+    models = [make_model('a', 6, 5), make_model('b', 3, 7),
+              make_model('c', 4, 4, out_nonlin=nonlin.Sigmoid)]
+    lengths = [2, 5, 1, 3, 3]
+    # 4 inputs and 2 outputs which are not used
+    ragged = RaggedSequences.from_lengths(
+            np.random.randn(sum(lengths), 6), lengths)
+    original_order = np.array([3, 0, 4, 1, 2])
+    # outputs of every model for single samples in original order
+    expected = []
+    for W in models:
+        outputs = [None] * len(lengths)
+        for i, position in enumerate(original_order):
+            V = [g.garray(x[np.newaxis, :4]) for x in ragged[i]]
+            outputs[position] = [W.out_nonlin(x).as_numpy_array()[0]
+                                 for x in W.forward_pass(V)[4]]
+        expected.append(outputs)
+    expected.append([np.mean(samples, axis=0)
+                     for samples in zip(*expected)])
+
+    for data in (ragged, ragged.to_padded()):
+        predictor = RunEnsemblePredictor.__new__(RunEnsemblePredictor)
+        predictor.ensemble = 1
+        predictor.models = [(10 + i, i, W) for i, W in enumerate(models)]
+        predictor.data = data
+        predictor.original_order = original_order
+        predictor.num_inputs = 4
+        result = predictor.run_ensemble()
+        keys = [p['output'] for p in result['predictions']]
+        keys.append(result['ensemble_prediction'])
+        assert [p['iteration'] for p in result['predictions']] == [10, 11, 12]
+        for key, outputs in zip(keys, expected):
+            samples = parse(aws.get_data(key))
+            assert [len(s) for s in samples] == [5, 3, 3, 2, 1]
+            for sample, expected_sample in zip(samples, outputs):
+                assert np.allclose(sample, expected_sample, atol=1e-6)
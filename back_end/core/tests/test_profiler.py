@@ -0,0 +1,59 @@
+import json
+import time
+import threading
+from ersatz import profiler as profiler_module
+from ersatz.profiler import Profiler, NULL_SPAN, monotonic
+
+
+def test_monotonic():
+    start = monotonic()
+    time.sleep(.01)
+    assert .005 < monotonic() - start < 1
+
+
+def test_profiler_spans():
+    profiler = Profiler()
+    for i in range(3):
+        with profiler.span('cg'):
+            with profiler.span('gauss_newton'):
+                time.sleep(.001)
+    thread = threading.Thread(target=profiler.add, args=('upload', 0., 2.))
+    thread.start()
+    thread.join()
+    totals = profiler.pop()
+    assert totals['cg']['count'] == 3
+    assert totals['gauss_newton']['count'] == 3
+    assert totals['cg']['time'] >= totals['gauss_newton']['time'] >= .003
+    assert totals['upload'] == {'time': 2., 'count': 1}
+    assert profiler.pop() == {}
+    assert profiler.take_events() == []
+
+
+def test_profiler_disabled():
+    profiler = Profiler(enabled=False)
+    assert profiler.span('grad') is NULL_SPAN
+    with profiler.span('grad'):
+        pass
+    assert profiler.pop() == {}
+
+
+def test_profiler_trace(tmpdir):
+    profiler = Profiler(trace=True)
+    with profiler.span('grad'):
+        pass
+    profiler.add_events([('compute', 1., 1.5, 42, 1)])
+    filename = str(tmpdir.join('trace', 'model.trace.json'))
+    profiler.write_trace(filename)
+    with open(filename) as f:
+        events = json.load(f)['traceEvents']
+    assert [e['name'] for e in events] == ['grad', 'compute']
+    assert events[1] == {'name': 'compute', 'ph': 'X', 'ts': 1e6,
+                         'dur': 5e5, 'pid': 42, 'tid': 1}
+    assert profiler.take_events() == []
+
+
+def test_get_profiler(monkeypatch):
+    monkeypatch.setattr(profiler_module, '_profiler', {})
+    profiler = profiler_module.get_profiler()
+    assert profiler_module.get_profiler() is profiler
+    assert not profiler.enabled and not profiler.trace
@@ -0,0 +1,106 @@
+import threading
+import time
+from ersatz.reporter import RabbitPipe, RingBuffer
+
+
+class Channel(object):
+    def __init__(self):
+        self.published = []
+        self.threads = set()
+
+    def exchange_declare(self, **kwargs):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body):
+        self.threads.add(threading.current_thread())
+        self.published.append(body)
+
+
+class Connection(object):
+    def __init__(self):
+        self.channel_ = Channel()
+
+    def channel(self, channel_number=None):
+        return self.channel_
+
+
+def test_ring_buffer():
+    buf = RingBuffer(10)
+    buf.write('abcd')
+    buf.write('efgh')
+    buf.write('ijkl')
+    assert len(buf) == 10 and buf.dropped == 2
+    buf.write('x' * 12)
+    assert buf.truncated == 2 and buf.dropped == 12
+    assert buf.take() == ['x' * 10]
+    assert len(buf) == 0 and buf.take() == []
+
+
+def test_pipe_buffered():
+    conn = Connection()
+    saved = []
+    pipe = RabbitPipe(conn, 'logs', buffer_age=-1,
+                      pre_hooks=[lambda data: data.upper()],
+                      post_hooks=[saved.append])
+    for line in ('a\n', 'b\n'):
+        pipe(line)
+    assert conn.channel_.published == []
+    pipe.flush()
+    pipe('c\n')
+    pipe.flush()
+    pipe.close()
+    # every write is published once, together with writes since flush
+    assert conn.channel_.published == ['A\nB\n', 'C\n']
+    assert saved == ['a\nb\n', 'c\n']
+    # channel is used by publisher thread only
+    assert conn.channel_.threads == set([pipe.publisher])
+    metrics = pipe.metrics()
+    assert metrics['written'] == metrics['published'] == 6
+    assert metrics['messages'] == 2 and metrics['dropped'] == 0
+
+
+def test_pipe_messages():
+    conn = Connection()
+    pipe = RabbitPipe(conn, 'livestats')
+    for i in range(20):
+        pipe('{"i": %d}' % i)
+    pipe.flush()
+    assert conn.channel_.published == ['{"i": %d}' % i for i in range(20)]
+    pipe.close()
+
+
+def test_pipe_conditions_and_overflow():
+    conn = Connection()
+    seen = []
+
+    def condition(data):
+        seen.append(data)
+        return 'stat' in data
+
+    pipe = RabbitPipe(conn, 'livestats', buffer_age=-1, max_buffer=8,
+                      publish_conditions=[condition])
+    pipe('no\n')
+    pipe.flush()
+    pipe('0123456789stat')
+    pipe.flush()
+    pipe.close()
+    assert seen == ['no\n', '6789stat']
+    assert conn.channel_.published == ['6789stat']
+    assert pipe.metrics()['truncated'] == 6
+
+
+def test_pipe_buffer_age_changed():
+    conn = Connection()
+    pipe = RabbitPipe(conn, 'livestats')
+    # publisher waits for writes without timeout
+    time.sleep(.05)
+    pipe.buffer_age = .1
+    pipe('a')
+    pipe('b')
+    for i in range(100):
+        if conn.channel_.published:
+            break
+        time.sleep(.02)
+    # published by age, without flush
+    assert conn.channel_.published == ['ab']
+    pipe.close()
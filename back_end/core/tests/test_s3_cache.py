@@ -0,0 +1,118 @@
+import os
+import sqlite3
+import pytest
+from unipath import Path
+from ersatz import aws, s3_local
+from ersatz.conf import settings
+from ersatz.s3_cache import S3Cache
+
+
+@pytest.fixture
+def s3(tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, 'S3_ROOT', Path(str(tmpdir.join('s3'))))
+    monkeypatch.setattr(settings, 'S3_CACHEDIR',
+                        Path(str(tmpdir.join('cache'))))
+    monkeypatch.setattr(settings, 'S3_CACHE_SIZE', 250)
+    monkeypatch.setattr(aws, 'Key', s3_local.Key)
+    monkeypatch.setattr(aws, 'get_bucket',
+                        lambda: s3_local.S3Bucket('bucket'))
+    monkeypatch.setattr(aws, '_cache', None)
+    return aws
+
+
+def put(s3, key, data):
+    s3.create_key(key).set_contents_from_string(data)
+
+
+def test_s3_cache_hit_miss(s3, monkeypatch):
+    put(s3, '/data/a.csv', 'a' * 100)
+    local = s3.S3Key('/data/a.csv').get()
+    assert open(local).read() == 'a' * 100
+    # hit must not read local file
+    monkeypatch.setattr('ersatz.s3_cache.fp_md5', None)
+    assert s3.S3Key('/data/a.csv').get() == local
+    stats = s3.get_cache().stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['size'] == 100
+
+
+def test_s3_cache_stale(s3):
+    put(s3, '/data/a.csv', 'a' * 100)
+    s3.S3Key('/data/a.csv').get()
+    put(s3, '/data/a.csv', 'b' * 50)
+    local = s3.S3Key('/data/a.csv').get()
+    assert open(local).read() == 'b' * 50
+    assert s3.get_cache().stats()['misses'] == 2
+
+
+def test_s3_cache_existing_file(s3):
+    put(s3, '/data/a.csv', 'a' * 100)
+    local = s3.get_cache().local_filename('/data/a.csv')
+    os.makedirs(os.path.dirname(local))
+    with open(local, 'w') as f:
+        f.write('a' * 100)
+    assert s3.S3Key('/data/a.csv').get() == local
+    assert s3.get_cache().stats()['hits'] == 1
+
+
+def test_s3_cache_evict_lru(s3):
+    for name in 'abc':
+        put(s3, '/data/%s.csv' % name, name * 100)
+    a = s3.S3Key('/data/a.csv').get()
+    b = s3.S3Key('/data/b.csv').get()
+    s3.S3Key('/data/a.csv').get()
+    c = s3.S3Key('/data/c.csv').get()
+    assert os.path.exists(a)
+    assert not os.path.exists(b)
+    assert os.path.exists(c)
+    stats = s3.get_cache().stats()
+    assert stats['evicted_bytes'] == 100
+    assert stats['evicted_files'] == 1
+    assert stats['size'] == 200
+
+
+def test_s3_cache_pinned(s3):
+    for name in 'abc':
+        put(s3, '/data/%s.csv' % name, name * 100)
+    a = s3.S3Key('/data/a.csv').get(pin=True)
+    b = s3.S3Key('/data/b.csv').get()
+    s3.S3Key('/data/c.csv').get()
+    assert os.path.exists(a)
+    assert not os.path.exists(b)
+    s3.S3Key('/data/a.csv').unpin()
+    s3.S3Key('/data/b.csv').get()
+    assert not os.path.exists(a)
+
+
+def test_s3_cache_closes_index(tmpdir, monkeypatch):
+    connections = []
+    sqlite_connect = sqlite3.connect
+
+    def connect(*args, **kwargs):
+        connections.append(sqlite_connect(*args, **kwargs))
+        return connections[-1]
+
+    monkeypatch.setattr('ersatz.s3_cache.sqlite3.connect', connect)
+    cache = S3Cache(str(tmpdir), max_size=0)
+    local = cache.local_filename('a')
+    with open(local, 'w') as f:
+        f.write('a')
+    cache._add('a', 'etag', local)
+    assert cache.evict() == 1
+    assert cache.stats()['evicted_files'] == 1
+    for conn in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute('SELECT 1')
+
+
+def test_s3_cache_dead_pin(tmpdir):
+    cache = S3Cache(str(tmpdir), max_size=0)
+    local = cache.local_filename('a')
+    with open(local, 'w') as f:
+        f.write('a')
+    cache._add('a', 'etag', local)
+    # no process can have pid above pid_max
+    cache.pin('a', pid=2 ** 22 + 1)
+    assert cache.evict() == 1
+    assert not os.path.exists(local)
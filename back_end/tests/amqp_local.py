@@ -0,0 +1,221 @@
+"""
+In-process stand-in for rabbitmq, implements part of pika
+BlockingConnection used by listener.
+"""
+import os
+import time
+import errno
+import fcntl
+import select
+import threading
+from collections import defaultdict, deque
+from pika.spec import Basic
+from pika.exceptions import ChannelClosed, ConnectionClosed
+
+
+class Broker(object):
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.queues = defaultdict(deque)
+        # pipes of connections waiting for messages, as sockets of
+        # real connections they are woken up without polling
+        self.waiters = set()
+
+    def publish(self, queue, body, redelivered=False):
+        with self.lock:
+            self.queues[queue].append((body, redelivered))
+            self.notify()
+
+    def notify(self):
+        for fd in self.waiters:
+            try:
+                os.write(fd, 'x')
+            except OSError as e:
+                # pipe is full, connection is woken up anyway
+                if e.errno != errno.EAGAIN:
+                    raise
+
+
+_broker = {}
+
+
+def get_broker():
+    if 'broker' not in _broker:
+        _broker['broker'] = Broker()
+    return _broker['broker']
+
+
+def reset():
+    _broker.clear()
+
+
+def publish(queue, body):
+    get_broker().publish(queue, body)
+
+
+class BlockingConnection(object):
+    def __init__(self, parameters=None):
+        self.broker = get_broker()
+        self.channels = []
+        self.is_closed = False
+        self.pipe = os.pipe()
+        fcntl.fcntl(self.pipe[1], fcntl.F_SETFL, os.O_NONBLOCK)
+        with self.broker.lock:
+            self.broker.waiters.add(self.pipe[1])
+
+    def channel(self):
+        if self.is_closed:
+            raise ConnectionClosed()
+        channel = Channel(self)
+        self.channels.append(channel)
+        return channel
+
+    def process_data_events(self, time_limit=0):
+        """
+        Delivers messages to consumers, waits up to time_limit
+        seconds for the first one.
+        """
+        deadline = time.time() + time_limit
+        while True:
+            with self.broker.lock:
+                if self.is_closed:
+                    raise ConnectionClosed()
+                deliveries = []
+                for channel in self.channels:
+                    deliveries.extend(channel._take())
+            remaining = deadline - time.time()
+            if deliveries or remaining <= 0:
+                break
+            if select.select([self.pipe[0]], [], [], remaining)[0]:
+                os.read(self.pipe[0], 4096)
+        for callback, args in deliveries:
+            callback(*args)
+
+    def close(self):
+        with self.broker.lock:
+            if self.is_closed:
+                return
+            for channel in self.channels:
+                channel._close()
+            self.is_closed = True
+            self.broker.waiters.discard(self.pipe[1])
+            self.broker.notify()
+        map(os.close, self.pipe)
+
+
+class Channel(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.consumers = {}
+        self.unacked = {}
+        self.prefetch_count = 0
+        self.delivery_tag = 0
+        self.is_closed = False
+        self.is_closing = False
+
+    def _check(self):
+        if self.connection.is_closed:
+            raise ConnectionClosed()
+        if self.is_closed:
+            raise ChannelClosed()
+
+    def _next_tag(self):
+        self.delivery_tag += 1
+        return self.delivery_tag
+
+    def _take(self):
+        # called with broker.lock held
+        deliveries = []
+        if self.is_closed:
+            return deliveries
+        for consumer_tag, (queue, callback) in sorted(self.consumers.items()):
+            messages = self.broker.queues[queue]
+            while messages:
+                taken = sum(1 for tag, _, _ in self.unacked.values()
+                            if tag == consumer_tag)
+                if self.prefetch_count and taken >= self.prefetch_count:
+                    break
+                body, redelivered = messages.popleft()
+                delivery_tag = self._next_tag()
+                self.unacked[delivery_tag] = (consumer_tag, queue, body)
+                method = Basic.Deliver(consumer_tag, delivery_tag,
+                                       redelivered, '', queue)
+                deliveries.append((callback, (self, method, None, body)))
+        return deliveries
+
+    def _close(self):
+        # unacknowledged messages go back to queues
+        for _, queue, body in [self.unacked[tag] for tag in
+                               sorted(self.unacked, reverse=True)]:
+            self.broker.queues[queue].appendleft((body, True))
+        self.unacked.clear()
+        self.consumers.clear()
+        self.is_closed = True
+
+    def queue_declare(self, queue='', durable=False, **kwargs):
+        self._check()
+        with self.broker.lock:
+            self.broker.queues[queue]
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0,
+                  all_channels=False):
+        self._check()
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, consumer_callback, queue='', no_ack=False,
+                      exclusive=False, consumer_tag=None, arguments=None):
+        self._check()
+        with self.broker.lock:
+            consumer_tag = consumer_tag or 'ctag%d' % self._next_tag()
+            self.consumers[consumer_tag] = (queue, consumer_callback)
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag='', nowait=False):
+        self._check()
+        with self.broker.lock:
+            self.consumers.pop(consumer_tag, None)
+
+    def basic_get(self, queue=None, no_ack=False):
+        self._check()
+        with self.broker.lock:
+            messages = self.broker.queues[queue]
+            if not messages:
+                return None, None, None
+            body, redelivered = messages.popleft()
+            delivery_tag = self._next_tag()
+            if not no_ack:
+                self.unacked[delivery_tag] = (None, queue, body)
+            method = Basic.GetOk(delivery_tag, redelivered, '', queue,
+                                 len(messages))
+            return method, None, body
+
+    def _settle(self, delivery_tag):
+        self._check()
+        if delivery_tag not in self.unacked:
+            # rabbitmq closes channel with PRECONDITION_FAILED
+            self._close()
+            raise ChannelClosed(406, 'unknown delivery tag %s'
+                                % delivery_tag)
+        return self.unacked.pop(delivery_tag)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        with self.broker.lock:
+            self._settle(delivery_tag)
+
+    def basic_reject(self, delivery_tag=None, requeue=True):
+        with self.broker.lock:
+            _, queue, body = self._settle(delivery_tag)
+            if requeue:
+                self.broker.queues[queue].appendleft((body, True))
+                self.broker.notify()
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False, immediate=False):
+        self._check()
+        self.broker.publish(routing_key, body)
+
+    def close(self):
+        with self.broker.lock:
+            self._close()
+            self.broker.notify()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Compares CsvDataFile and ChunkedCsvDataFile on a generated csv file.
+
+Every loader runs in a fresh process, so peak RSS is not polluted
+by the previous run.
+
+    ERSATZ_SETTINGS=settings.test python tests/bench_csv_loader.py --rows 500000
+"""
+import os
+import time
+import resource
+import argparse
+import multiprocessing
+import numpy as np
+if 'ERSATZ_SETTINGS' not in os.environ:
+    os.environ['ERSATZ_SETTINGS'] = 'settings.test'
+from ersatz.data.csv import GeneralDataset
+from ersatz.shared.fileutils import TempFile
+
+
+CLASSES = ['alpha', 'beta', 'gamma', 'delta']
+
+
+def make_csv(filename, rows, columns):
+    rng = np.random.RandomState(42)
+    with open(filename, 'w') as f:
+        f.write(','.join('x%d' % i for i in range(columns + 1)) + '\n')
+        for _ in xrange(rows):
+            values = ['%.6f' % x for x in rng.rand(columns)]
+            values.append(CLASSES[rng.randint(len(CLASSES))])
+            f.write(','.join(values) + '\n')
+
+
+def run(filename, chunked, params, queue):
+    start = time.time()
+    dataset = GeneralDataset()
+    data = dataset._load_source(filename, chunked=chunked, **params)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((data.shape[0], elapsed, peak))
+
+
+def bench(filename, chunked, params):
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=run,
+                                   args=(filename, chunked, params, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--columns', type=int, default=20)
+    args = parser.parse_args()
+    params = {'num_columns': args.columns + 1,
+              'with_header': True,
+              'dtypes': ['f'] * args.columns + ['S'],
+              'classes': [[]] * args.columns + [sorted(CLASSES)]}
+    with TempFile() as filename:
+        make_csv(filename, args.rows, args.columns)
+        size = os.path.getsize(filename) / 1024. / 1024.
+        print 'File: %d rows, %d columns, %.1f MB' % (args.rows,
+                                                     args.columns + 1, size)
+        for name, chunked in (('genfromtxt', False), ('chunked', True)):
+            rows, elapsed, peak = bench(filename, chunked, params)
+            print '%-12s %10.0f rows/sec %10.1f MB peak RSS' % (
+                name, rows / elapsed, peak / 1024.)
+
+
+if __name__ == '__main__':
+    main()
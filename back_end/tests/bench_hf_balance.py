@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Compares makespan of HF grad round with static partition of batches
+and with BatchQueue (longest batches first, then stealing), on
+sequences of skewed lengths, CPU (npmat) backend.
+
+Grad of every batch is timed once, rounds of workers are replayed
+with measured times, so results don't depend on number of cores.
+
+    ERSATZ_SETTINGS=settings.test python tests/bench_hf_balance.py --workers 4
+"""
+import os
+import time
+import argparse
+import numpy as np
+if 'ERSATZ_SETTINGS' not in os.environ:
+    os.environ['ERSATZ_SETTINGS'] = 'settings.test'
+from ersatz.data.ragged import RaggedSequences
+from ersatz.mrnn import gnumpy as g
+from ersatz.mrnn.ersatz_dp import DP
+from ersatz.mrnn.opt.d.generic import Generic3dData
+from ersatz.mrnn.opt.m.rnn.mrnn import MRNN
+from ersatz.mrnn.opt.utils import nonlin
+from ersatz.mrnn.util import batch_costs, partition_batches, BatchQueue
+
+
+def make_data(samples, max_len, v, o):
+    rng = np.random.RandomState(42)
+    # most sequences are short, few are very long
+    lengths = np.minimum(max_len, 2 + rng.pareto(1., samples) * 5)
+    lengths = lengths.astype(np.int64)
+    values = rng.randn(lengths.sum(), v + o).astype(np.float32)
+    values[:, v:] = np.eye(o)[rng.randint(o, size=len(values))]
+    data = RaggedSequences.from_lengths(values, lengths)
+    # as Timeseries.to_mrnn_format
+    return data.take(data.length_order())
+
+
+def make_provider(data, batch_size, v, o):
+    provider = DP({})
+    provider.binary_train_data = provider.binary_test_data = data
+    dp_data = provider.create_view()
+    for mode in ('train', 'test'):
+        dp_data[mode]['batch_size'] = batch_size
+        dp_data[mode]['num_batches'] = -(-len(data) // batch_size)
+    T = dp_data['train']['shape'][0]
+    return Generic3dData(T, v, o, batch_size, dp_data,
+                         out_nonlin=nonlin.Softmax, num_timesteps=T)
+
+
+def old_partition(L, i, tot):
+    # partition_batches before BatchQueue, last worker got more
+    if len(L) == 1:
+        return L
+    part_size = int(np.ceil(float(len(L) - 1) / tot))
+    return L[i * part_size:(i + 1) * part_size + (i + 1 == tot) * part_size]
+
+
+def replay_static(parts, seconds):
+    return max(sum(seconds[b] for b in part) for part in parts)
+
+
+def replay_queue(queue, workers, seconds):
+    # every free worker pops its next batch, as worker processes do
+    clocks = [0.] * workers
+    done = set()
+    while len(done) < workers:
+        worker = min((w for w in range(workers) if w not in done),
+                     key=lambda w: clocks[w])
+        batch = queue.pop(worker)
+        if batch is None:
+            done.add(worker)
+        else:
+            clocks[worker] += seconds[batch]
+    return max(clocks)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--max-len', type=int, default=200)
+    parser.add_argument('--hidden', type=int, default=50)
+    args = parser.parse_args()
+    v, o = 8, 3
+    data = make_data(args.samples, args.max_len, v, o)
+    provider = make_provider(data, args.batch_size, v, o)
+    batches = provider.train_batches
+    costs = batch_costs(provider.dp_data['train'], args.batch_size,
+                        len(batches))
+
+    W = MRNN(v, args.hidden, args.hidden, o, hid_nonlin=nonlin.Tanh,
+             out_nonlin=nonlin.Softmax)
+    W.initialize_self(15, 1. / np.sqrt(15))
+    X = W.pack()
+    seconds, grads = [], []
+    for b in batches:
+        batch = provider(b)
+        start = time.time()
+        grad, grad2, loss = W.unpack(X).grad(batch, compute_grad2=True)
+        grad = grad.pack()
+        seconds.append(time.time() - start)
+        grads.append(grad.asarray())
+    print '%d batches, length %d..%d, grad %.3f..%.3f s, ' \
+          'corr(cost, time) = %.3f' % (
+              len(batches), data.lengths.min(), data.lengths.max(),
+              min(seconds), max(seconds), np.corrcoef(costs, seconds)[0, 1])
+
+    total = sum(seconds)
+    queue = BatchQueue(args.workers, len(batches))
+    parts = queue.assign(batches, costs)
+    # sums of worker results in any order are the same up to rounding
+    reference = np.sum(grads, axis=0)
+    balanced = np.sum([np.sum([grads[b] for b in part], axis=0)
+                       for part in parts if part], axis=0)
+    assert np.allclose(reference, balanced, rtol=1e-4, atol=1e-4)
+
+    print '%-26s %10s %10s' % ('', 'makespan', 'efficiency')
+    for name, makespan in (
+            ('old partition_batches', replay_static(
+                [old_partition(batches, i, args.workers)
+                 for i in range(args.workers)], seconds)),
+            ('even partition_batches', replay_static(
+                [partition_batches(batches, i, args.workers)
+                 for i in range(args.workers)], seconds)),
+            ('BatchQueue', replay_queue(queue, args.workers, seconds))):
+        print '%-26s %9.3fs %9.1f%%' % (
+            name, makespan, 100. * total / args.workers / makespan)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Compares queue-to-start latency of basic_get polling and pushed
+messages on in-process broker stand-in.
+
+    ERSATZ_SETTINGS=settings.test python tests/bench_listener_latency.py
+"""
+import os
+import json
+import time
+import random
+import threading
+import argparse
+if 'ERSATZ_SETTINGS' not in os.environ:
+    os.environ['ERSATZ_SETTINGS'] = 'settings.test'
+from ersatz import listener
+import amqp_local
+
+
+QUEUES = ('train', 'predict')
+
+
+def publish(count, interval):
+    for i in xrange(count):
+        time.sleep(random.uniform(0, 2 * interval))
+        amqp_local.publish(random.choice(QUEUES), json.dumps(time.time()))
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return [latencies[int(p * (len(latencies) - 1))] for p in (.5, .9, 1)]
+
+
+def bench_polling(consumer, count):
+    # round robin over queues as listener did before push consumers
+    latencies = []
+    while len(latencies) < count:
+        for queue in QUEUES:
+            method_frame, _, sent = consumer.get_message_wait(
+                    queue=queue, seconds_wait=1)
+            if method_frame:
+                latencies.append(time.time() - sent)
+    return latencies
+
+
+def bench_push(consumer, count):
+    consumer.consume(QUEUES, prefetch=1)
+    latencies = []
+    while len(latencies) < count:
+        message = consumer.next_message(timeout=1)
+        if message is not None:
+            latencies.append(time.time() - message[2])
+            consumer.ack(message[1].delivery_tag)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--interval', type=float, default=.5,
+                        help='mean seconds between messages')
+    args = parser.parse_args()
+    listener.BlockingConnection = amqp_local.BlockingConnection
+    print 'Latency of %d messages, seconds   median     90%%      max' % (
+        args.messages)
+    for name, bench in (('basic_get', bench_polling), ('push', bench_push)):
+        amqp_local.reset()
+        consumer = listener.Consumer()
+        publisher = threading.Thread(target=publish,
+                                     args=(args.messages, args.interval))
+        publisher.start()
+        latencies = bench(consumer, args.messages)
+        publisher.join()
+        consumer.close()
+        print '%-34s %8.4f %8.4f %8.4f' % ((name, ) +
+                                           tuple(percentiles(latencies)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Times MRNN grad and Gauss-Newton products on CPU (npmat backend)
+with float64 and float32 matrices, every precision in its own process
+as gnumpy selects it on import.
+
+    ERSATZ_SETTINGS=settings.test python tests/bench_npmat_precision.py
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+
+def run(args):
+    import numpy as np
+    from ersatz.mrnn import gnumpy as g
+    from ersatz.mrnn.npmat import npmat
+    from ersatz.mrnn.util import set_blas_threads
+    from ersatz.mrnn.opt.m.rnn.mrnn import MRNN
+    from ersatz.mrnn.opt.utils import nonlin
+    set_blas_threads(args.threads)
+    rng = np.random.RandomState(42)
+    v, o = 8, 3
+    W = MRNN(v, args.hidden, args.hidden, o, hid_nonlin=nonlin.Tanh,
+             out_nonlin=nonlin.Softmax)
+    W.initialize_self(15, 1. / np.sqrt(15))
+    X = W.pack()
+    V = [g.garray(rng.randn(args.batch_size, v)) for t in range(args.T)]
+    O = [g.garray(np.eye(o)[rng.randint(o, size=args.batch_size)])
+         for t in range(args.T)]
+    M = [g.ones((args.batch_size, 1)) for t in range(args.T)]
+    batch = V, O, M
+    R = W.unpack(g.garray(rng.randn(X.size)))
+    W = W.unpack(X)
+    W.grad(batch)
+    start = time.time()
+    for i in range(args.repeat):
+        W.grad(batch)
+    grad = (time.time() - start) / args.repeat
+    start = time.time()
+    for i in range(args.repeat):
+        W.gauss_newton(batch, R)
+    gn = (time.time() - start) / args.repeat
+    dtype = npmat.__DTYPE__.__name__
+    print '%-8s grad %8.1fms  gauss_newton %8.1fms' % (
+        dtype, grad * 1e3, gn * 1e3)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hidden', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--T', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--run', action='store_true')
+    args = parser.parse_args()
+    if args.run:
+        return run(args)
+    for precision in ('64', '32'):
+        env = dict(os.environ, GNUMPY_USE_GPU='no',
+                   GNUMPY_CPU_PRECISION=precision)
+        subprocess.check_call([sys.executable] + sys.argv + ['--run'],
+                              env=env)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Compares single stream and parallel S3 transfers on s3_local
+throttled to the given latency and per-stream bandwidth.
+
+    ERSATZ_SETTINGS=settings.test python tests/bench_s3_transfer.py --size 64
+"""
+import os
+import time
+import shutil
+import tempfile
+import argparse
+if 'ERSATZ_SETTINGS' not in os.environ:
+    os.environ['ERSATZ_SETTINGS'] = 'settings.test'
+from unipath import Path
+from ersatz import aws, s3_local
+from ersatz.conf import settings
+
+
+def setup(root, latency, bandwidth):
+    settings.S3_ROOT = Path(root)
+    settings.S3_LOCAL_LATENCY = latency
+    settings.S3_LOCAL_BANDWIDTH = bandwidth
+    aws.Key = s3_local.Key
+    aws.MultiPartUpload = s3_local.MultiPartUpload
+    aws.get_bucket = lambda: s3_local.S3Bucket('bucket')
+
+
+def timeit(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def bench_transfer(root, size):
+    filename = os.path.join(root, 'data.bin')
+    with open(filename, 'wb') as f:
+        f.write(os.urandom(size))
+    copy = os.path.join(root, 'copy.bin')
+    result = []
+    for name, threshold in (('single', size), ('parallel', 0)):
+        settings.S3_MULTIPART_THRESHOLD = threshold
+        upload = timeit(lambda: aws.save_to_s3(filename, '/bench/data.bin',
+                                                rewrite=True))
+        download = timeit(lambda: aws.save_to_file('/bench/data.bin', copy))
+        result.append((name, size / upload, size / download))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=64, help='MB')
+    parser.add_argument('--latency', type=float, default=0.05, help='sec')
+    parser.add_argument('--bandwidth', type=float, default=20, help='MB/sec')
+    args = parser.parse_args()
+    root = tempfile.mkdtemp()
+    try:
+        setup(root, args.latency, args.bandwidth * 1024 * 1024)
+        print 'Transfer of %d MB, %d threads, %d MB parts' % (
+            args.size, settings.S3_TRANSFER_THREADS,
+            settings.S3_PART_SIZE / 1024 / 1024)
+        for name, up, down in bench_transfer(root, args.size * 1024 * 1024):
+            print '%-10s upload %8.1f MB/sec  download %8.1f MB/sec' % (
+                name, up / 1024 / 1024, down / 1024 / 1024)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
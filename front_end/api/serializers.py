@@ -300,6 +300,7 @@ class DataSetSerializer(serializers.ModelSerializer):
 
 class LearnModelSerializer(AdminFieldsMixin, serializers.ModelSerializer):
     model_params = JSONSerializerField()
+    training_logs = serializers.Field('get_training_logs')
 
     class Meta(object):
         model = LearnModel
@@ -307,7 +308,7 @@ class LearnModelSerializer(AdminFieldsMixin, serializers.ModelSerializer):
                   'updated', 'state', 'training_time', 'traceback', 'name',
                   'training_logs')
         read_only_fields = ('id', 'created', 'updated', 'state',
-                            'training_time', 'traceback', 'training_logs')
+                            'training_time', 'traceback')
         admin_fields = ('traceback', )
 
     def validate_model_name(self, attrs, source):
@@ -111,3 +111,35 @@ class TestEnsemble(APITestCase):
             response = self.client.get(url, format='json')
         assert response.status_code == status.HTTP_200_OK
         assert len(json.loads(response.content)) == 4
+
+
+@pytest.mark.usefixtures('class_setup')
+class TestLearnModel(APITestCase):
+    def test_model_list(self):
+        s3file = DataFile.objects.create(user=self.user,
+                                         key='uploads/111aaa/test.ts',
+                                         file_format='TIMESERIES')
+        dataset = DataSet.objects.create(
+            name='Ds 1', key='dataset/' + s3file.key,
+            data=s3file, user=s3file.user
+        )
+        ensemble = TrainEnsemble.objects.create(
+            user=dataset.user,
+            train_dataset=dataset,
+            test_dataset=dataset,
+            data_type=TrainEnsemble.TIMESERIES
+        )
+        for i in range(5):
+            model = LearnModel.objects.create(ensemble=ensemble,
+                                              model_name='MRNN')
+            model.append_logs('line 0\n', is_new=True)
+            model.append_logs('line %d\n' % i)
+        url = reverse('model-list') + '?key=' + self.user.apikey.key
+        # log chunks of all models are read in one query
+        with self.assertNumQueries(3):
+            response = self.client.get(url, format='json')
+        assert response.status_code == status.HTTP_200_OK
+        data = json.loads(response.content)
+        assert len(data) == 5
+        assert sorted(m['training_logs'] for m in data) == \
+            ['line 0\nline %d\n' % i for i in range(5)]
@@ -54,3 +54,73 @@ def test_model_to_train(ensemble_all_types, client):
     assert response.status_code == status.HTTP_200_OK
     model_params = LearnModel.objects.get(pk=learn_model.pk).model_params
     assert model_params == data['model_params']
+
+
+def test_bulk_stats_and_logs(ensemble_all_types, client):
+    learn_model = LearnModel.objects.get(model_name='MRNN')
+    ens = learn_model.ensemble
+    ens.queue_key = 'asd'
+    ens.save()
+    ens.user.seconds_paid = 3600
+    ens.user.save()
+    LearnModel.objects.filter(pk=learn_model.pk).update(state='TRAIN')
+    stats = [{'model': learn_model.id,
+              'queue_key': ens.queue_key,
+              's3_data': '/modeldata/%d/%d.weights' % (learn_model.id, i),
+              'data': {'test_accuracy': 0.9, 'train_accuracy': 0.9,
+                       'iteration': i, 'time': 10}} for i in range(2)]
+    data = {
+        'worker_key': settings.WORKER_KEY,
+        'models': [{'model': learn_model.id, 'stats': stats,
+                    'logs': {'data': 'iteration 1\n', 'is_new': True}},
+                   {'model': 0, 'stats': [], 'logs': {'data': 'x'}}],
+    }
+    response = client.post(reverse('api_bulk'), data=json.dumps(data),
+                           content_type='application/json')
+    assert response.status_code == status.HTTP_200_OK
+    results = json.loads(response.content)['models']
+    assert results[str(learn_model.id)] == 'success'
+    assert results['0'] != 'success'
+    learn_model = LearnModel.objects.get(pk=learn_model.pk)
+    assert learn_model.stats.live().count() == 2
+    assert learn_model.get_training_logs() == 'iteration 1\n'
+
+
+def test_logs_append_and_tail(ensemble_all_types, client, get_url):
+    learn_model = LearnModel.objects.get(model_name='MRNN')
+    learn_model.training_logs = 'old\n'
+    learn_model.save()
+    user = learn_model.ensemble.user
+    user.seconds_paid = 3600
+    user.save()
+    for i, is_new in enumerate((True, False, False)):
+        data = {'model': learn_model.id, 'data': 'line %d\n' % i,
+                'is_new': is_new, 'worker_key': settings.WORKER_KEY}
+        response = client.post(reverse('api_logs'), data=json.dumps(data),
+                               content_type='application/json')
+        assert response.status_code == status.HTTP_200_OK
+    learn_model = LearnModel.objects.get(pk=learn_model.pk)
+    # new logs replace old ones, chunks are appended without rewriting
+    assert learn_model.get_training_logs() == 'line 0\nline 1\nline 2\n'
+    assert learn_model.logs_seq == 3
+    assert learn_model.log_chunks.count() == 3
+    url = get_url('model-logs', kwargs={'pk': learn_model.pk},
+                  params=[('key', user.apikey.key), ('tail', 2)])
+    response = client.get(url)
+    assert response.status_code == status.HTTP_200_OK
+    data = json.loads(response.content)
+    assert [c['data'] for c in data['chunks']] == ['line 1\n', 'line 2\n']
+    url = get_url('model-logs', kwargs={'pk': learn_model.pk},
+                  params=[('key', user.apikey.key), ('after', data['next'])])
+    assert json.loads(client.get(url).content)['chunks'] == []
+    # restarted logs continue the numbers, so the cursor sees the new run
+    data = {'model': learn_model.id, 'data': 'restart\n', 'is_new': True,
+            'worker_key': settings.WORKER_KEY}
+    response = client.post(reverse('api_logs'), data=json.dumps(data),
+                           content_type='application/json')
+    assert response.status_code == status.HTTP_200_OK
+    data = json.loads(client.get(url).content)
+    assert data['chunks'] == [{'seq': 3, 'data': 'restart\n'}]
+    learn_model = LearnModel.objects.get(pk=learn_model.pk)
+    assert learn_model.get_training_logs() == 'restart\n'
+    assert learn_model.logs_seq == 4
@@ -7,6 +7,7 @@ urlpatterns = patterns(
     #----worker----
     url(r'^stats/$', 'stats_view', name='api_stats'),
     url(r'^logs/$', 'logs_view', name='api_logs'),
+    url(r'^bulk/$', 'bulk_view', name='api_bulk'),
     url(r'^dataset/update/$', 'dataset_patch'),
     url(r'^ensemble/status/$', 'worker_ensemble_state_view',
         name='api_ensemble_status'),
@@ -256,7 +256,8 @@ class LearnModelViewSet(AuthPermMixin, viewsets.ModelViewSet):
     filter_fields = ('ensemble', )
 
     def get_queryset(self, queryset=None):
-        return LearnModel.objects.visible_to(self.request.user)
+        return LearnModel.objects.visible_to(self.request.user)\
+            .prefetch_related('log_chunks')
 
     def get_serializer(self, instance=None, data=None,
                        files=None, many=False, partial=False):
@@ -353,6 +354,28 @@ class LearnModelViewSet(AuthPermMixin, viewsets.ModelViewSet):
                                  'problem': 'Model not in right state.'})
         return model
 
+    @link()
+    def logs(self, request, pk):
+        """
+        Training logs chunks after seq `after`, or the last `tail` chunks.
+        """
+        obj = self.get_object()
+        try:
+            after = request.QUERY_PARAMS.get('after')
+            after = int(after) if after is not None else None
+            tail = request.QUERY_PARAMS.get('tail')
+            tail = int(tail) if tail is not None else None
+        except ValueError:
+            raise APIBadRequest({'status': 'fail',
+                                 'problem': 'Invalid after or tail.'})
+        chunks = obj.read_logs(after=after, tail=tail)
+        legacy = obj.training_logs if after is None and tail is None else None
+        return Response({
+            'chunks': [{'seq': seq, 'data': data} for seq, data in chunks],
+            'legacy': legacy or '',
+            'next': chunks[-1][0] if chunks else after,
+        })
+
     @link()
     def stats(self, request, pk):
         obj = self.get_object()
@@ -489,17 +512,51 @@ def stats_view(request, data):
 def logs_view(request, data):
     try:
         model = LearnModel.objects.get(pk=data.get('model', 0))
-        if data.get('is_new', False):
-            model.training_logs = data.get('data', '')
-        else:
-            model.training_logs += data.get('data', '')
-        model.save()
+        model.append_logs(data.get('data', ''), data.get('is_new', False))
     except LearnModel.DoesNotExist:
         return None
     return HttpResponse(json.dumps({'status': 'success'}),
                         content_type="application/json")
 
 
+@csrf_exempt
+@require_POST
+@worker_api
+def bulk_view(request, data):
+    """
+    Stats and logs of several models in one request from worker:
+    {'models': [{'model': id, 'stats': [stats_view data, ...],
+                 'logs': {'data': str, 'is_new': bool} or null}]}
+    Responds with 'success' or the problem for every model.
+    """
+    results = {}
+    for item in data.get('models', []):
+        problem = None
+        for stat in item.get('stats', []):
+            form = LearnModelStatForm(stat)
+            if not form.is_valid():
+                problem = form.errors
+                break
+            cdata = form.cleaned_data
+            model = cdata['model']
+            model.add_stat(data=cdata['data'], s3_data=cdata['s3_data'])
+            if not model.pass_requirements_for_worker_processing():
+                problem = 'User out of time'
+                break
+        logs = item.get('logs')
+        if problem is None and logs:
+            try:
+                model = LearnModel.objects.get(pk=item.get('model', 0))
+            except LearnModel.DoesNotExist:
+                problem = 'Model not found'
+            else:
+                model.append_logs(logs.get('data', ''),
+                                  logs.get('is_new', False))
+        results[str(item.get('model'))] = problem or 'success'
+    return HttpResponse(json.dumps({'status': 'success', 'models': results}),
+                        content_type="application/json")
+
+
 @csrf_exempt
 @require_POST
 @worker_api
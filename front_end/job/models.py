@@ -575,7 +575,9 @@ class LearnModel(models.Model):
     training_time = models.FloatField(default=0.)
     readonly = models.BooleanField(default=False)
     name = models.CharField("name", max_length=255, null=True, blank=True)
+    # logs written before LearnModelLogChunk, new logs are appended as chunks
     training_logs = models.TextField('training logs', null=True, blank=True)
+    logs_seq = models.IntegerField('next log chunk number', default=0)
 
     objects = LearnModelManager()
 
@@ -792,6 +794,43 @@ class LearnModel(models.Model):
     def has_many_iters(self):
         return self.model_name in ('MRNN',)
 
+    def append_logs(self, data, is_new=False):
+        """
+        Appends chunk of training logs, is_new starts new logs.
+        Only the chunk and logs_seq are written, not the whole logs.
+        Chunk numbers keep growing after is_new, so clients reading
+        after their last seq get the new logs.
+        """
+        # lock model row, so concurrent flushes don't take the same seq
+        seq = LearnModel.objects.select_for_update().filter(pk=self.pk)\
+            .values_list('logs_seq', flat=True)[0]
+        if is_new:
+            self.log_chunks.all().delete()
+            LearnModel.objects.filter(pk=self.pk).update(training_logs=None)
+            self.training_logs = None
+        LearnModelLogChunk.objects.create(model=self, seq=seq, data=data)
+        LearnModel.objects.filter(pk=self.pk).update(logs_seq=seq + 1)
+        self.logs_seq = seq + 1
+
+    def read_logs(self, after=None, tail=None):
+        """
+        Returns list of (seq, data) of log chunks with seq greater than
+        after, or of the last tail chunks.
+        """
+        chunks = self.log_chunks.all()
+        if after is not None:
+            chunks = chunks.filter(seq__gt=after)
+        if tail is not None:
+            return list(reversed(chunks.order_by('-seq')
+                                 .values_list('seq', 'data')[:tail]))
+        return list(chunks.order_by('seq').values_list('seq', 'data'))
+
+    def get_training_logs(self):
+        # sorted here, so chunks prefetched for a list of models are used
+        chunks = sorted(self.log_chunks.all(), key=lambda c: c.seq)
+        return (self.training_logs or '') + \
+            ''.join(chunk.data for chunk in chunks)
+
 
 class ConvModel(LearnModel):
     class Meta(object):
@@ -900,6 +939,16 @@ class LearnModelStat(models.Model):
         return cls.objects.filter(query)
 
 
+class LearnModelLogChunk(models.Model):
+    model = models.ForeignKey(LearnModel, related_name='log_chunks')
+    seq = models.IntegerField('number of chunk')
+    data = models.TextField('training logs')
+    created = models.DateTimeField('creation time', auto_now_add=True)
+
+    class Meta(object):
+        unique_together = ('model', 'seq')
+
+
 class PredictEnsembleQuerySet(QuerySet):
     def on_worker(self):
         return self.exclude(state__in=('ERROR', 'FINISHED'))\